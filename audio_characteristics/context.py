@@ -0,0 +1,110 @@
+import threading
+
+import librosa
+import numpy as np
+import soundfile as sf
+
+# tempo-cnn features are computed on audio resampled to this rate
+TEMPO_SAMPLE_RATE = 11025
+
+# STFT parameters matching librosa.feature.spectral_centroid's defaults
+CENTROID_N_FFT = 2048
+CENTROID_HOP_LENGTH = 512
+
+
+class AnalysisContext:
+    """
+    Decoded audio for a single snippet, shared by every extractor.
+
+    The PCM is decoded once and each derived form (mono mix, resampled
+    signals, STFT magnitudes) is computed the first time an extractor asks for
+    it and cached for the rest.  Adding a feature therefore costs its own
+    computation only, never another decode.
+    """
+
+    def __init__(self, samples, sr, source=None, res_type='kaiser_best'):
+        """
+        :param samples: float PCM, shaped ``(samples,)`` or ``(samples, channels)``
+        :param sr: sample rate of ``samples``
+        :param source: optional description of where the audio came from, used in messages
+        :param res_type: librosa resampling filter for :meth:`resampled`; the default
+            matches ``librosa.load``, ``'polyphase'`` is about a hundred times faster
+        """
+        self.samples = np.asarray(samples, dtype=np.float32)
+        self.sr = int(sr)
+        self.source = source
+        self.res_type = res_type
+        self._cache = {}
+        # re-entrant: derived forms are computed from other cached forms
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_file(cls, file):
+        """
+        Decodes an audio file (anything libsndfile reads, e.g. WAV) at its native rate.
+
+        :param file: path or file-like object
+        :return: context
+        """
+        samples, sr = sf.read(file, dtype='float32')
+        return cls(samples, sr, source=file if isinstance(file, str) else None)
+
+    def __repr__(self):
+        return f'AnalysisContext(source={self.source!r}, sr={self.sr}, duration={self.duration:.2f}s)'
+
+    @property
+    def channels(self):
+        return 1 if self.samples.ndim == 1 else self.samples.shape[1]
+
+    @property
+    def duration(self):
+        return self.samples.shape[0] / self.sr
+
+    def _cached(self, key, compute):
+        value = self._cache.get(key)
+        if value is None:
+            with self._lock:
+                value = self._cache.get(key)
+                if value is None:
+                    value = compute()
+                    self._cache[key] = value
+        return value
+
+    @property
+    def y(self):
+        """
+        Mono mix at the native sample rate, as ``librosa.load(file, sr=None)`` returns it.
+        """
+        def compute():
+            if self.samples.ndim == 1:
+                return self.samples
+            return librosa.to_mono(self.samples.T)
+        return self._cached('y', compute)
+
+    def resampled(self, sr):
+        """
+        Mono mix resampled to ``sr``, as ``librosa.load(file, sr=sr)`` returns it.
+
+        :param sr: target sample rate
+        :return: float32 signal
+        """
+        if sr == self.sr:
+            return self.y
+        return self._cached(('y', sr), lambda: librosa.resample(
+            self.y, orig_sr=self.sr, target_sr=sr, res_type=self.res_type))
+
+    @property
+    def y_tempo(self):
+        """
+        Mono mix at the 11025 Hz rate tempo-cnn expects.
+        """
+        return self.resampled(TEMPO_SAMPLE_RATE)
+
+    @property
+    def stft_magnitude(self):
+        """
+        Magnitude STFT of the native-rate mono mix with librosa's default
+        2048/512 framing, reusable by any spectral feature.
+        """
+        return self._cached('stft_magnitude', lambda: np.abs(
+            librosa.stft(self.y, n_fft=CENTROID_N_FFT, hop_length=CENTROID_HOP_LENGTH)))
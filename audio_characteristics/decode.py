@@ -0,0 +1,249 @@
+"""
+Decoding of compressed stream audio straight to float32 PCM.
+
+Compressed bytes are piped into an ffmpeg subprocess that writes raw
+little-endian float32 samples back on stdout, which are wrapped as a numpy
+array without touching the disk.  A snippet is decoded once, at its native
+rate; analyzers that need audio at another rate (tempo-cnn wants mono at
+11025 Hz) get it resampled from that PCM with a polyphase filter.
+
+A :class:`StreamDecoder` keeps one ffmpeg process running for a continuous
+stream, fed chunk by chunk from an asyncio event loop.
+"""
+import asyncio
+import re
+import subprocess
+
+import numpy as np
+import soundfile as sf
+
+from audio_characteristics.context import AnalysisContext
+
+FFMPEG = 'ffmpeg'
+
+# audio_type values used in the stations dict -> ffmpeg demuxer
+_FFMPEG_FORMATS = {
+    'mp3': 'mp3',
+    'aac': 'aac',  # ADTS
+}
+
+
+class DecodeError(RuntimeError):
+    """
+    Raised when ffmpeg cannot decode the given bytes.
+    """
+
+
+def _ffmpeg_format(audio_type):
+    try:
+        return _FFMPEG_FORMATS[audio_type]
+    except KeyError:
+        raise ValueError(f"Unsupported audio type '{audio_type}'. Expected one of {sorted(_FFMPEG_FORMATS)}.")
+
+
+def ffmpeg_command(audio_type, sr=None, channels=None, input_args=()):
+    """
+    Builds the ffmpeg command line that decodes ``audio_type`` from stdin to
+    float32 PCM on stdout.
+
+    :param audio_type: ``'mp3'`` or ``'aac'``
+    :param sr: output sample rate, or ``None`` for the native rate
+    :param channels: output channel count, or ``None`` to keep the stream's layout
+    :param input_args: extra arguments placed before ``-i``
+    :return: argument list
+    """
+    command = [FFMPEG, '-hide_banner', '-loglevel', 'error', '-nostdin',
+               '-f', _ffmpeg_format(audio_type), *input_args, '-i', 'pipe:0', '-vn']
+    if channels is not None:
+        command += ['-ac', str(channels)]
+    if sr is not None:
+        command += ['-ar', str(sr)]
+    return command + ['-f', 'f32le', '-acodec', 'pcm_f32le', 'pipe:1']
+
+
+def decode(data, audio_type, sr=None, channels=None):
+    """
+    Decodes compressed audio to float32 PCM.
+
+    :param data: bytes-like mp3 or ADTS aac frames
+    :param audio_type: ``'mp3'`` or ``'aac'``
+    :param sr: output sample rate, or ``None`` for the native rate
+    :param channels: output channel count; ``None`` keeps the stream's layout,
+        in which case the caller must know it to interpret the result
+    :return: float32 array shaped ``(samples,)`` for one channel or ``(samples, channels)``
+    """
+    try:
+        process = subprocess.run(ffmpeg_command(audio_type, sr=sr, channels=channels),
+                                 input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        raise DecodeError(f"'{FFMPEG}' was not found. Install ffmpeg to decode {audio_type} audio.")
+    if process.returncode != 0:
+        raise DecodeError(f'ffmpeg failed to decode {audio_type}: {process.stderr.decode(errors="replace").strip()}')
+
+    pcm = np.frombuffer(process.stdout, dtype='<f4')
+    if channels is not None and channels > 1:
+        pcm = pcm[:len(pcm) - len(pcm) % channels].reshape(-1, channels)
+    return pcm
+
+
+def decode_to_context(data, audio_type, sample_rate, channels, source=None):
+    """
+    Decodes compressed audio at its native rate into an :class:`AnalysisContext`.
+
+    Resampled mono signals requested later by the extractors are computed from
+    the decoded PCM with a polyphase filter, so the bytes are decoded only once.
+
+    :param data: bytes-like mp3 or ADTS aac frames
+    :param audio_type: ``'mp3'`` or ``'aac'``
+    :param sample_rate: native sample rate of the stream
+    :param channels: native channel count of the stream, or ``None`` to decode as stereo
+    :param source: optional description of the audio, see :class:`AnalysisContext`
+    :return: context
+    """
+    channels = channels or 2
+    samples = decode(data, audio_type, sr=sample_rate, channels=channels)
+    return AnalysisContext(samples, sample_rate, source=source, res_type='polyphase')
+
+
+class StreamDecoder:
+    """
+    Long-running ffmpeg process decoding a continuous stream on an asyncio event loop.
+
+    Compressed chunks are written to ffmpeg's stdin as they arrive and PCM is
+    read from its stdout by another task.  If the PCM is not read, ffmpeg
+    stops reading its input, so a slow reader slows the writer down instead of
+    buffering without bound.
+    """
+
+    def __init__(self, audio_type, sr=44100, channels=2):
+        """
+        :param audio_type: ``'mp3'`` or ``'aac'``
+        :param sr: output sample rate; the stream is resampled by ffmpeg if it differs
+        :param channels: output channel count
+        """
+        self.audio_type = audio_type
+        self.sr = sr
+        self.channels = channels
+        self._frame_bytes = 4 * channels
+        self._remainder = b''
+        self._process = None
+
+    async def start(self):
+        # without probing ffmpeg starts writing PCM as soon as the first frames are in
+        command = ffmpeg_command(self.audio_type, sr=self.sr, channels=self.channels,
+                                 input_args=('-probesize', '32768', '-analyzeduration', '0'))
+        try:
+            self._process = await asyncio.create_subprocess_exec(
+                *command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except FileNotFoundError:
+            raise DecodeError(f"'{FFMPEG}' was not found. Install ffmpeg to decode {self.audio_type} audio.")
+        return self
+
+    async def write(self, data):
+        """
+        Feeds compressed bytes, waiting while ffmpeg's input pipe is full.
+        """
+        self._process.stdin.write(data)
+        await self._process.stdin.drain()
+
+    def end(self):
+        """
+        Closes ffmpeg's input, after which :meth:`read` returns what is left and then ``None``.
+        """
+        if not self._process.stdin.is_closing():
+            self._process.stdin.close()
+
+    async def read(self, size):
+        """
+        Reads decoded PCM.
+
+        :param size: most bytes to read
+        :return: float32 array shaped ``(samples, channels)``, or ``None`` once ffmpeg has exited
+        """
+        data = await self._process.stdout.read(size)
+        if not data:
+            return None
+        data = self._remainder + data
+        end = len(data) - len(data) % self._frame_bytes
+        self._remainder = data[end:]
+        return np.frombuffer(data[:end], dtype='<f4').reshape(-1, self.channels)
+
+    async def close(self):
+        if self._process is None:
+            return
+        if self._process.returncode is None:
+            self._process.kill()
+        await self._process.wait()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+_DURATION = re.compile(rb'Duration: (\d+):(\d\d):(\d\d(?:\.\d+)?)')
+
+
+def audio_duration(path):
+    """
+    Duration of an audio file in seconds, read from its header.
+
+    :param path: anything libsndfile reads (WAV, FLAC, OGG, MP3, ...) or ffmpeg can demux (e.g. AAC, M4A)
+    """
+    try:
+        return sf.info(path).duration
+    except RuntimeError:
+        pass  # not a format libsndfile reads
+    try:
+        # with no output given ffmpeg prints the input's header and exits
+        process = subprocess.run([FFMPEG, '-hide_banner', '-nostdin', '-i', path],
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        raise DecodeError(f"'{FFMPEG}' was not found. Install ffmpeg to read {path}.")
+    match = _DURATION.search(process.stderr)
+    if match is None:
+        raise DecodeError(f'Cannot read the duration of {path}')
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def decode_file(path, start=0., seconds=None):
+    """
+    Decodes part of an audio file into an :class:`AnalysisContext`, without
+    decoding the rest.  Files libsndfile cannot read are decoded by ffmpeg as
+    44.1 kHz stereo.
+
+    :param path: audio file
+    :param start: offset in seconds
+    :param seconds: duration to decode, up to the end of the file if ``None``
+    :return: context
+    """
+    source = f'{path}@{start:g}s'
+    try:
+        with sf.SoundFile(path) as f:
+            f.seek(int(start * f.samplerate))
+            frames = -1 if seconds is None else int(seconds * f.samplerate)
+            return AnalysisContext(f.read(frames, dtype='float32'), f.samplerate, source=source)
+    except RuntimeError:
+        pass  # not a format libsndfile reads
+    command = [FFMPEG, '-hide_banner', '-loglevel', 'error', '-nostdin', '-ss', str(start), '-i', path, '-vn']
+    if seconds is not None:
+        command += ['-t', str(seconds)]
+    command += ['-ac', '2', '-ar', '44100', '-f', 'f32le', '-acodec', 'pcm_f32le', 'pipe:1']
+    try:
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        raise DecodeError(f"'{FFMPEG}' was not found. Install ffmpeg to decode {path}.")
+    if process.returncode != 0:
+        raise DecodeError(f'ffmpeg failed to decode {path}: {process.stderr.decode(errors="replace").strip()}')
+    pcm = np.frombuffer(process.stdout, dtype='<f4')
+    return AnalysisContext(pcm[:len(pcm) - len(pcm) % 2].reshape(-1, 2), 44100, source=source)
+
+
+def decode_capture(capture):
+    """
+    Decodes a :class:`radio.capture.Capture` into an :class:`AnalysisContext`.
+    """
+    return decode_to_context(capture.data, capture.audio_type, capture.sample_rate,
+                             capture.channels, source=capture.station)
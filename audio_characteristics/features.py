@@ -0,0 +1,151 @@
+"""
+Mel feature front-end for tempo-cnn.
+
+Computes the same 40-band, 20-5000 Hz mel spectra as
+``librosa.feature.melspectrogram`` (STFT length 1024, hop 512 at 11025 Hz,
+``power=1``), but keeps the mel filterbank and STFT window as precomputed
+state instead of rebuilding them on every call, frames the signal with a
+strided view instead of copying it, and transforms the frames in cache-sized
+blocks of one reusable buffer.  Sliding 256-frame windows over the result are strided views
+as well, so no window is ever copied.
+"""
+import threading
+
+import librosa
+import numpy as np
+from numpy.lib.stride_tricks import as_strided, sliding_window_view
+import scipy.fft
+import scipy.signal
+
+from audio_characteristics.context import TEMPO_SAMPLE_RATE
+
+# STFT frames transformed per FFT call
+FRAMES_PER_BLOCK = 128
+
+
+class MelFeatureExtractor:
+    """
+    Precomputed mel front-end, cheap to call repeatedly.
+    """
+
+    def __init__(self, sr=TEMPO_SAMPLE_RATE, n_fft=1024, hop_length=512, n_mels=40, fmin=20, fmax=5000):
+        self.sr = sr
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.n_mels = n_mels
+        # periodic Hann window, as librosa's STFT uses
+        self.window = scipy.signal.get_window('hann', n_fft, fftbins=True).astype(np.float32)
+        self.mel_basis = librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels,
+                                             fmin=fmin, fmax=fmax).astype(np.float32)
+        self.mel_basis_t = np.ascontiguousarray(self.mel_basis.T)
+
+    @classmethod
+    def scaled(cls, sr):
+        """
+        Extractor for audio at ``sr`` whose STFT frames cover the same time
+        span and frequency bins as tempo-cnn's at 11025 Hz, so its mel spectra
+        match those of the resampled signal without resampling.  Exact when
+        ``sr`` is a multiple of 11025 Hz, e.g. 44100.
+        """
+        ratio = sr / TEMPO_SAMPLE_RATE
+        return cls(sr=sr, n_fft=int(round(1024 * ratio)), hop_length=int(round(512 * ratio)))
+
+    def frame_count(self, n_samples):
+        """
+        Number of STFT frames librosa produces for ``n_samples`` samples with ``center=True``.
+        """
+        return 1 + n_samples // self.hop_length
+
+    def _frames(self, y):
+        # centre the frames by zero-padding half a window on each side, like librosa's STFT
+        padded = np.pad(np.asarray(y, dtype=np.float32), self.n_fft // 2)
+        return sliding_window_view(padded, self.n_fft)[::self.hop_length]
+
+    def _mel(self, ys):
+        counts = [self.frame_count(len(y)) for y in ys]
+        # frames-major so every block's matrix product writes contiguous rows
+        mel = np.empty((sum(counts), self.n_mels), dtype=np.float32)
+        # frames are windowed into one reusable block buffer, which bounds
+        # peak memory and keeps the FFT input cache-sized.  Stacking all
+        # signals' frames into one FFT and one matrix product was measured
+        # slower: the larger fresh arrays cost more in page faults than the
+        # per-block calls they save
+        windowed = np.empty((min(len(mel), FRAMES_PER_BLOCK), self.n_fft), dtype=np.float32)
+        position = 0
+        for y in ys:
+            frames = self._frames(y)
+            for start in range(0, frames.shape[0], FRAMES_PER_BLOCK):
+                block = frames[start:start + FRAMES_PER_BLOCK]
+                count = block.shape[0]
+                np.multiply(block, self.window, out=windowed[:count])
+                # scipy keeps single precision (complex64), numpy's FFT would promote to complex128
+                magnitudes = np.abs(scipy.fft.rfft(windowed[:count], axis=-1))
+                np.matmul(magnitudes, self.mel_basis_t, out=mel[position:position + count])
+                position += count
+        return mel.T, counts
+
+    def mel_frames(self, frames):
+        """
+        Mel spectra of audio that is already framed, e.g. by a caller framing a stream as it arrives.
+
+        :param frames: array shaped ``(count, n_fft)``
+        :return: array shaped ``(n_mels, count)``
+        """
+        magnitudes = np.abs(scipy.fft.rfft(np.multiply(frames, self.window, dtype=np.float32), axis=-1))
+        return (magnitudes @ self.mel_basis_t).T
+
+    def melspectrogram(self, y):
+        """
+        Mel magnitude spectrogram of a mono 11025 Hz signal.
+
+        :param y: signal
+        :return: array shaped ``(n_mels, frames)``
+        """
+        mel, _ = self._mel([y])
+        return mel
+
+    def melspectrograms(self, ys):
+        """
+        Mel spectrograms of several signals, one after the other through the
+        same block buffer; no faster per signal than :meth:`melspectrogram`.
+
+        :param ys: list of mono 11025 Hz signals
+        :return: list of arrays shaped ``(n_mels, frames)``
+        """
+        if len(ys) == 0:
+            return []
+        mel, counts = self._mel(ys)
+        return np.split(mel, np.cumsum(counts)[:-1], axis=1)
+
+
+def sliding_windows(data, window_length, hop_length):
+    """
+    Overlapping windows over the frame axis of ``data`` as a read-only strided view.
+
+    :param data: features shaped ``(1, bands, frames, 1)``
+    :param window_length: frames per window
+    :param hop_length: frames between window starts
+    :return: view shaped ``(windows, bands, window_length, 1)``
+    """
+    total_frames = data.shape[2]
+    count = (total_frames - window_length) // hop_length + 1
+    strides = data.strides
+    return as_strided(data, shape=(count, data.shape[1], window_length, data.shape[3]),
+                      strides=(strides[2] * hop_length, strides[1], strides[2], strides[3]),
+                      writeable=False)
+
+
+_extractor = None
+_extractor_lock = threading.Lock()
+
+
+def mel_extractor():
+    """
+    The process-wide extractor with tempo-cnn's settings.
+    """
+    global _extractor
+    if _extractor is None:
+        with _extractor_lock:
+            if _extractor is None:
+                _extractor = MelFeatureExtractor()
+    return _extractor
@@ -0,0 +1,211 @@
+"""
+Compact content fingerprints and a cache of profiling results keyed by them.
+
+Consecutive snippets of a burst usually land on the same song, and stations
+loop idents, ads and automation fillers.  A fingerprint summarises a snippet's
+harmony (chroma), timbre (band energies), rhythm (onset autocorrelation) and
+level from the STFT magnitude the pitch extractor computes anyway, so it costs
+a few matrix products.  Snippets whose fingerprints are close enough reuse the
+cached result instead of running the tempo model, loudness meter and centroid.
+"""
+import collections
+import functools
+import os
+import threading
+import time
+
+import librosa
+import numpy as np
+
+from audio_characteristics.context import CENTROID_N_FFT
+
+N_CHROMA = 12
+N_BANDS = 12
+N_LAGS = 32
+# lags of the onset autocorrelation, in STFT frames (~11.6 ms at 44.1 kHz): up to ~2 s
+MAX_LAG_FRAMES = 176
+
+# (start, stop) of each part within the fingerprint vector; the last element is the level in dB
+_PARTS = {
+    'chroma': (0, N_CHROMA),
+    'bands': (N_CHROMA, N_CHROMA + N_BANDS),
+    'rhythm': (N_CHROMA + N_BANDS, N_CHROMA + N_BANDS + N_LAGS),
+}
+FINGERPRINT_SIZE = N_CHROMA + N_BANDS + N_LAGS + 1
+
+
+@functools.lru_cache(maxsize=8)
+def _filters(sr):
+    chroma = librosa.filters.chroma(sr=sr, n_fft=CENTROID_N_FFT, n_chroma=N_CHROMA).astype(np.float32)
+    # log-spaced bands from 60 Hz to 16 kHz (or Nyquist), as a 0/1 matrix over the STFT bins
+    freqs = librosa.fft_frequencies(sr=sr, n_fft=CENTROID_N_FFT)
+    edges = np.geomspace(60., min(16000., sr / 2), N_BANDS + 1)
+    bands = ((freqs >= edges[:-1, None]) & (freqs < edges[1:, None])).astype(np.float32)
+    return chroma, bands
+
+
+def _unit(v):
+    norm = np.linalg.norm(v)
+    return v / norm if norm > 0 else v
+
+
+def fingerprint(context):
+    """
+    Fingerprint of a snippet, comparable with :func:`similarity`.
+
+    :param context: :class:`audio_characteristics.context.AnalysisContext`
+    :return: float32 vector of length ``FINGERPRINT_SIZE``
+    """
+    S = context.stft_magnitude
+    power = S ** 2
+    chroma_filter, band_filter = _filters(context.sr)
+
+    chroma = chroma_filter @ power
+    chroma = (chroma / (chroma.max(axis=0, keepdims=True) + 1e-10)).mean(axis=1)
+    bands = np.log10(band_filter @ power.mean(axis=1) + 1e-10)
+
+    # onset strength from positive spectral flux, then its autocorrelation over lags up to ~2 s
+    flux = np.maximum(np.diff(np.log1p(S), axis=1), 0).sum(axis=0)
+    flux -= flux.mean()
+    n = len(flux)
+    spectrum = np.fft.rfft(flux, 2 * n)
+    acf = np.fft.irfft(spectrum * np.conj(spectrum))[1:min(MAX_LAG_FRAMES, n)]
+    rhythm = np.interp(np.linspace(0, len(acf) - 1, N_LAGS), np.arange(len(acf)), acf) if len(acf) else np.zeros(N_LAGS)
+
+    level = 10 * np.log10(power.mean() + 1e-10)
+    return np.concatenate([
+        _unit(chroma),
+        _unit(bands - bands.mean()),
+        _unit(rhythm),
+        [level],
+    ]).astype(np.float32)
+
+
+def similarity(a, b):
+    """
+    Similarity of two fingerprints: the lowest cosine similarity of their parts.
+
+    :param a: fingerprint
+    :param b: fingerprint, or a 2D array of fingerprints (one per row)
+    :return: float, or an array with one similarity per row of ``b``
+    """
+    b = np.atleast_2d(b)
+    parts = [b[:, start:stop] @ a[start:stop] for start, stop in _PARTS.values()]
+    result = np.min(parts, axis=0)
+    return result if result.shape[0] > 1 else float(result[0])
+
+
+class ResultCache:
+    """
+    LRU cache with expiry that maps fingerprints to profiling results and
+    answers lookups with the result of the closest fingerprint, if it is close enough.
+    """
+
+    def __init__(self, max_entries=256, ttl=900., threshold=.97, level_tolerance=1.5, clock=time.monotonic):
+        """
+        :param max_entries: results kept; the least recently used is evicted first
+        :param ttl: seconds a result can be reused for
+        :param threshold: lowest :func:`similarity` counted as the same audio
+        :param level_tolerance: largest level difference in dB counted as the same audio
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.level_tolerance = level_tolerance
+        self.clock = clock
+        # key -> (fingerprint, result, expires at, seconds it took to compute)
+        self._entries = collections.OrderedDict()
+        self._next_key = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._seconds_saved = 0.
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, fp):
+        """
+        :return: a copy of the cached result of the closest fingerprint, or ``None``
+        """
+        with self._lock:
+            self._expire()
+            key = self._closest(fp)
+            if key is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            _, result, _, compute_seconds = self._entries[key]
+            self._hits += 1
+            self._seconds_saved += compute_seconds
+            return dict(result)
+
+    def store(self, fp, result, compute_seconds=0.):
+        """
+        Caches a result for a fingerprint.
+
+        :param compute_seconds: time it took to compute ``result``, counted as
+            saved each time it is reused
+        """
+        with self._lock:
+            self._entries[self._next_key] = (fp, dict(result), self.clock() + self.ttl, compute_seconds)
+            self._next_key += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def _expire(self):
+        now = self.clock()
+        for key in [key for key, (_, _, expires, _) in self._entries.items() if expires <= now]:
+            del self._entries[key]
+
+    def _closest(self, fp):
+        if not self._entries:
+            return None
+        keys = list(self._entries)
+        fps = np.stack([self._entries[key][0] for key in keys])
+        scores = np.atleast_1d(similarity(fp, fps))
+        scores[np.abs(fps[:, -1] - fp[-1]) > self.level_tolerance] = -np.inf
+        best = int(np.argmax(scores))
+        return keys[best] if scores[best] >= self.threshold else None
+
+    def stats(self):
+        """
+        :return: dict with ``entries``, ``hits``, ``misses``, ``hit_rate``,
+            ``evictions`` and ``seconds_saved``
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'entries': len(self._entries),
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': self._hits / lookups if lookups else None,
+                'evictions': self._evictions,
+                'seconds_saved': self._seconds_saved,
+            }
+
+
+_cache = None
+_cache_configured = False
+_cache_lock = threading.Lock()
+
+
+def result_cache():
+    """
+    Process-wide result cache, configured from the ``RESULT_CACHE_*`` environment
+    variables, or ``None`` when ``RESULT_CACHE_TTL`` is 0.
+    """
+    global _cache, _cache_configured
+    if not _cache_configured:
+        with _cache_lock:
+            if not _cache_configured:
+                ttl = float(os.getenv('RESULT_CACHE_TTL', '900'))
+                if ttl > 0:
+                    _cache = ResultCache(
+                        max_entries=int(os.getenv('RESULT_CACHE_SIZE', '256')),
+                        ttl=ttl,
+                        threshold=float(os.getenv('RESULT_CACHE_THRESHOLD', '0.97')))
+                _cache_configured = True
+    return _cache
@@ -0,0 +1,108 @@
+"""
+Cheap checks on decoded PCM that run before the expensive extractors.
+
+A station that is off air sends silence, a broken feed can send static, and
+an overdriven one sends clipped audio.  Profiling silence makes the loudness
+meter return ``-inf``, and tempo estimated from static is meaningless, so
+such snippets are caught here with a few vectorised block statistics: block
+RMS, peak level, runs of clipped samples and spectral flatness.
+"""
+import collections
+import enum
+import threading
+
+import numpy as np
+
+BLOCK_SIZE = 2048
+
+# a block is silent below this RMS level (dBFS); a snippet is silent when fewer
+# than SOUNDING_FRACTION of its blocks are above it
+SILENCE_DB = -60.
+SOUNDING_FRACTION = .05
+
+# three samples in a row at or above this level count as clipping
+CLIP_LEVEL = .99
+CLIPPED_FRACTION = .001
+
+# spectral flatness is about 0.56 for white noise and well below 0.3 for music;
+# static is also steady, unlike drums, whose blocks are flat but vary in level
+NOISE_FLATNESS = .4
+NOISE_LEVEL_SPREAD_DB = 3.
+# sounding blocks the flatness is measured on, evenly spread over the snippet
+FLATNESS_BLOCKS = 32
+
+
+class Status(enum.Enum):
+    OK = 'ok'
+    SILENT = 'silent'
+    CLIPPED = 'clipped'
+    NOISE = 'noise'
+
+
+# snippets with these statuses are not profiled; clipped audio is still
+# profiled, as its tempo and pitch are usable
+REJECTED = frozenset({Status.SILENT, Status.NOISE})
+
+GateResult = collections.namedtuple('GateResult', 'status rms_db peak clipped_fraction flatness')
+
+_counts = collections.Counter()
+_counts_lock = threading.Lock()
+
+
+def _blocks(y):
+    n = len(y) // BLOCK_SIZE
+    if n == 0:
+        return np.pad(y, (0, BLOCK_SIZE - len(y)))[np.newaxis]
+    return y[:n * BLOCK_SIZE].reshape(n, BLOCK_SIZE)
+
+
+def _flatness(blocks):
+    power = np.abs(np.fft.rfft(blocks * np.hanning(BLOCK_SIZE).astype(np.float32), axis=1)) ** 2 + 1e-10
+    return np.exp(np.log(power).mean(axis=1)) / power.mean(axis=1)
+
+
+def check(context):
+    """
+    Classifies a snippet as ok, silent, clipped or noise.
+
+    :param context: :class:`audio_characteristics.context.AnalysisContext`
+    :return: :class:`GateResult` with the :class:`Status` and the statistics it is based on
+    """
+    samples = context.samples
+    blocks = _blocks(context.y)
+    block_db = 10 * np.log10(np.mean(blocks ** 2, axis=1) + 1e-12)
+    sounding = block_db > SILENCE_DB
+    rms_db = float(10 * np.log10(np.mean(blocks ** 2) + 1e-12))
+    peak = float(np.abs(samples).max()) if samples.size else 0.
+
+    at_limit = np.abs(samples) >= CLIP_LEVEL
+    runs = at_limit[:-2] & at_limit[1:-1] & at_limit[2:]
+    clipped_fraction = float(runs.mean()) if runs.size else 0.
+
+    flatness = None
+    if sounding.mean() < SOUNDING_FRACTION:
+        status = Status.SILENT
+    else:
+        loud = blocks[sounding]
+        loud = loud[np.linspace(0, len(loud) - 1, min(FLATNESS_BLOCKS, len(loud))).astype(int)]
+        flatness = float(np.median(_flatness(loud)))
+        if flatness > NOISE_FLATNESS and block_db[sounding].std() < NOISE_LEVEL_SPREAD_DB:
+            status = Status.NOISE
+        elif clipped_fraction > CLIPPED_FRACTION:
+            status = Status.CLIPPED
+        else:
+            status = Status.OK
+
+    with _counts_lock:
+        _counts[status.value] += 1
+    return GateResult(status, rms_db, peak, clipped_fraction, flatness)
+
+
+def gate_counts():
+    """
+    Snippets checked in this process, by status.
+
+    :return: dict of status value to count
+    """
+    with _counts_lock:
+        return {status.value: _counts[status.value] for status in Status}
@@ -1,45 +1,186 @@
-from audio_characteristics.tempo import get_tempo
+import time
+
+from audio_characteristics.context import AnalysisContext
+from audio_characteristics.fingerprint import fingerprint, result_cache
+from audio_characteristics.gate import REJECTED, check
+from audio_characteristics.tempo import get_classifier, get_tempo, read_features, read_features_batch
+from audio_characteristics.timing import failure, record, timer
 import pyloudnorm as pyln
 import librosa
-import numpy as np
-import soundfile as sf
 
 # locates loudness of music, adjusted for human perception
 # will be used to determine saturation of color
-def loudness(file):
-    # load audio (with shape (samples, channels))
-    data, rate = sf.read(file)
-    meter = pyln.Meter(rate)  # create BS.1770 meter
-    perceived_loudness = meter.integrated_loudness(data)  # measure loudness
+def loudness(context):
+    # samples are shaped (samples, channels), as BS.1770 expects
+    meter = pyln.Meter(context.sr)  # create BS.1770 meter
+    perceived_loudness = meter.integrated_loudness(context.samples)  # measure loudness
 
     return perceived_loudness
 
 # locates spectral centroid which corresponds to 'brightness' of tone
 # will be used to find lightness to darkness of color
-def pitch(file):
-    y, sr = librosa.load(file, sr=None)
-
-    # get spectral centroid, mean of that, and masked mean using librosa
-    centroid = librosa.feature.spectral_centroid(y=y, sr=sr)
-    centroid_arr = centroid[0]
-    regular_mean = centroid_arr.mean()
-    masked = np.ma.masked_equal(centroid, 0)
-    masked_mean = masked.mean()
+def pitch(context):
+    # get spectral centroid and its mean, reusing the context's STFT
+    centroid = librosa.feature.spectral_centroid(S=context.stft_magnitude, sr=context.sr)
+    regular_mean = centroid[0].mean()
 
     return regular_mean
 
-def get_audio_characteristics(file_name):
+def _cached_result(context, cache):
+    """
+    Fingerprints a snippet and looks it up in the result cache.
+
+    :return: ``(fingerprint, cached result or None)``
+    """
+    if cache is None:
+        return None, None
+    with timer('fingerprint', context.source):
+        fp = fingerprint(context)
+        return fp, cache.lookup(fp)
+
+# status of results profiled without running the gate
+UNCHECKED = 'unchecked'
+
+def _gate(context):
+    """
+    Runs the silence/clipping/noise gate on a snippet.
+
+    :return: the snippet's :class:`audio_characteristics.gate.GateResult`
+    """
+    with timer('gate', context.source):
+        result = check(context)
+    if result.status in REJECTED:
+        print(f'Skipping {context}: it is {result.status.value}')
+    return result
+
+def _rejected(gate_result):
+    # what a snippet the gate rejected comes back as: its status, but no values
+    return {'station': '', 'status': gate_result.status.value}
+
+def get_audio_characteristics(source, use_cache=True, gate=True):
+    """
+    Profiles a snippet.  source is either a path to a WAV file or an AnalysisContext; either way the audio is decoded once and shared by the tempo, loudness and pitch extractors.
+
+    Every result has a 'status': 'ok', or 'clipped' for a snippet that clips but is still profiled, as its tempo and pitch are usable, or 'unchecked' when the gate is off.  Silent snippets and static are caught by the gate first and come back with their status, 'silent' or 'noise', and no values, without running any extractor.  None means profiling failed.  A snippet whose fingerprint matches one profiled recently (e.g. the same song a few seconds later) gets the cached result without running the extractors.
+    """
     try:
-        return {
+        context = source if isinstance(source, AnalysisContext) else AnalysisContext.from_file(source)
+        status = UNCHECKED
+        if gate:
+            gate_result = _gate(context)
+            if gate_result.status in REJECTED:
+                return _rejected(gate_result)
+            status = gate_result.status.value
+        cache = result_cache() if use_cache else None
+        fp, cached = _cached_result(context, cache)
+        if cached is not None:
+            return {**cached, 'status': status}
+
+        start = time.perf_counter()
+        with timer('tempo', context.source):
+            tempo = get_tempo('cnn', context)
+        with timer('loudness', context.source):
+            perceived_loudness = loudness(context)
+        with timer('pitch', context.source):
+            mean_pitch = pitch(context)
+        audio_stats = {
                 'station': '',
-                'tempo': int(get_tempo('cnn', f'{file_name}')),
-                'loudness': int(loudness(f'{file_name}')),
-                'pitch': int(pitch(f'{file_name}'))
+                'tempo': int(tempo),
+                'loudness': int(perceived_loudness),
+                'pitch': int(mean_pitch),
+                'status': status
             }
+        if cache is not None:
+            cache.store(fp, audio_stats, time.perf_counter() - start)
+        return audio_stats
     except Exception as e:
         print(f'Exception occurred in get_colour method within colour.py. It is: {e}')
 
+def _tempo_alone(context, model_name, interpolate):
+    """
+    Estimates one snippet's tempo on its own, after the batch it was in failed.
+
+    :return: the tempo, or None if it fails too
+    """
+    try:
+        with timer('tempo', context.source):
+            return get_classifier(model_name).estimate_tempo(read_features(context), interpolate=interpolate)
+    except Exception as e:
+        failure('tempo', context.source)
+        print(f'Exception occurred estimating the tempo of {context} in get_audio_characteristics_batch. It is: {e}')
+
+def get_audio_characteristics_batch(sources, model_name='cnn', interpolate=False, batch_size=None, use_cache=True, gate=True):
+    """
+    Profiles several snippets (paths or AnalysisContexts), e.g. one per station, running the tempo model once for all of them.  The result list lines up with sources, and the results are as get_audio_characteristics returns them: a snippet rejected by the gate comes back with its status and no values, and one that fails is reported and comes back as None, without affecting the others.
+
+    Snippets found in the result cache are left out of the tempo model batch and get the cached result.
+    """
+    cache = result_cache() if use_cache else None
+    contexts, results = [], [None] * len(sources)
+    for i, source in enumerate(sources):
+        try:
+            context = source if isinstance(source, AnalysisContext) else AnalysisContext.from_file(source)
+            status = UNCHECKED
+            if gate:
+                gate_result = _gate(context)
+                if gate_result.status in REJECTED:
+                    results[i] = _rejected(gate_result)
+                    continue
+                status = gate_result.status.value
+            fp, cached = _cached_result(context, cache)
+            if cached is not None:
+                results[i] = {**cached, 'status': status}
+                continue
+            with timer('resample', context.source):
+                context.y_tempo  # decode/resample now so a bad snippet fails on its own
+            contexts.append((i, context, fp, status))
+        except Exception as e:
+            failure('profile', getattr(source, 'source', source))
+            print(f'Exception occurred reading features of {source} in get_audio_characteristics_batch. It is: {e}')
+
+    if not contexts:
+        return results
+
+    start = time.perf_counter()
+    try:
+        features = read_features_batch([context for _, context, _, _ in contexts])
+        features_seconds = time.perf_counter() - start
+        tempi = get_classifier(model_name).estimate_tempo_batch(features, interpolate=interpolate, batch_size=batch_size)
+        inference_seconds = time.perf_counter() - start - features_seconds
+        batched = True
+    except Exception as e:
+        # one bad snippet mustn't cost the others their results, so each is tried on its own
+        print(f'Exception occurred estimating the tempo of {len(contexts)} snippets in get_audio_characteristics_batch, estimating them one by one. It is: {e}')
+        tempi = [_tempo_alone(context, model_name, interpolate) for _, context, _, _ in contexts]
+        batched = False
+    tempo_seconds = (time.perf_counter() - start) / len(contexts)
+
+    for (i, context, fp, status), tempo in zip(contexts, tempi):
+        if tempo is None:
+            continue
+        if batched:
+            # every snippet is charged an equal share of the batched calls
+            record('features', context.source, features_seconds / len(contexts))
+            record('inference', context.source, inference_seconds / len(contexts))
+        try:
+            start = time.perf_counter()
+            with timer('loudness', context.source):
+                perceived_loudness = loudness(context)
+            with timer('pitch', context.source):
+                mean_pitch = pitch(context)
+            results[i] = {
+                'station': '',
+                'tempo': int(tempo),
+                'loudness': int(perceived_loudness),
+                'pitch': int(mean_pitch),
+                'status': status
+            }
+            if cache is not None:
+                cache.store(fp, results[i], tempo_seconds + time.perf_counter() - start)
+        except Exception as e:
+            failure('profile', context.source)
+            print(f'Exception occurred profiling {context} in get_audio_characteristics_batch. It is: {e}')
+    return results
 
 if __name__ == "__main__":
     print('boogeyman')
-    
\ No newline at end of file
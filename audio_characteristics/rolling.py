@@ -0,0 +1,203 @@
+"""
+Rolling analysis of a continuous stream.
+
+Instead of profiling a fresh snippet every time, a :class:`RollingAnalyzer`
+is fed the PCM of a stream as it is decoded and keeps everything it needs
+up to date incrementally:
+
+- a rolling mel spectrogram, of which only the frames of the newest audio are
+  computed; every 128 new frames complete another 256-frame window for
+  tempo-cnn (about 6 s at 11025 Hz framing);
+- a tempo distribution, the decaying average of the model's predictions for
+  those windows, or a weighted mean of predictions for the latest audio when
+  a short capture is evaluated as it grows, see :meth:`RollingAnalyzer.latest_window`;
+- loudness and spectral centroid accumulators, see
+  :mod:`audio_characteristics.streaming`.
+
+The analyzer does not run the model itself, so that a caller following many
+stations can predict the new windows of all of them in one batch.  Its
+methods hold a lock, so blocks can be added on a worker thread while another
+thread takes the windows and values.
+"""
+import threading
+
+import numpy as np
+
+from audio_characteristics.features import MelFeatureExtractor
+from audio_characteristics.streaming import CentroidAccumulator, LoudnessAccumulator
+
+# tempo-cnn's window and the hop between windows, in mel frames, as read_features uses them
+WINDOW_FRAMES = 256
+WINDOW_HOP_FRAMES = 128
+
+# tempo-cnn's classes are 1 BPM apart; the confidence is the probability within this many BPM of the peak
+CONFIDENCE_WIDTH = 2
+
+
+class RollingAnalyzer:
+    """
+    Tempo, loudness and brightness of a continuous stream of PCM blocks.
+    """
+
+    def __init__(self, sr=44100, channels=2, half_life=60., source=None):
+        """
+        :param sr: sample rate of the blocks; multiples of 11025 Hz give the
+            same mel spectra as the resampled signal, see :meth:`MelFeatureExtractor.scaled`
+        :param channels: channels of the blocks
+        :param half_life: seconds of audio after which a window's prediction
+            has half the weight in the tempo average; ``None`` for a weighted
+            mean, see :meth:`add_predictions`
+        :param source: optional description of the stream, used in messages
+        """
+        self.sr = sr
+        self.channels = channels
+        self.source = source
+        self.loudness = LoudnessAccumulator(sr, channels)
+        self.centroid = CentroidAccumulator(sr)
+        self._mel = MelFeatureExtractor.scaled(sr)
+        # librosa centres the first frame on the first sample by padding with zeros
+        self._buffer = np.zeros(self._mel.n_fft // 2, dtype=np.float32)
+        self._spectrum = np.zeros((self._mel.n_mels, 0), dtype=np.float32)
+        self._latest = self._spectrum
+        self._windows = []
+        window_seconds = WINDOW_HOP_FRAMES * self._mel.hop_length / sr
+        self._decay = None if half_life is None else .5 ** (window_seconds / half_life)
+        self._distribution = None
+        self._weight = 0.
+        self.samples = 0
+        self.predicted_windows = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'RollingAnalyzer(source={self.source!r}, duration={self.duration:.1f}s)'
+
+    @property
+    def duration(self):
+        return self.samples / self.sr
+
+    def add(self, block):
+        """
+        Feeds the next PCM block.
+
+        :param block: float PCM shaped ``(samples, channels)``, or ``(samples,)`` for mono
+        """
+        block = np.asarray(block, dtype=np.float32)
+        with self._lock:
+            self._add(block)
+
+    def _add(self, block):
+        self.samples += len(block)
+        self.loudness.add(block)
+        mono = block.mean(axis=1) if block.ndim == 2 else block
+        self.centroid.add(mono)
+
+        self._buffer = np.concatenate((self._buffer, mono))
+        n_fft, hop_length = self._mel.n_fft, self._mel.hop_length
+        if len(self._buffer) < n_fft:
+            return
+        frames = np.lib.stride_tricks.sliding_window_view(self._buffer, n_fft)[::hop_length]
+        mel = self._mel.mel_frames(frames)
+        self._spectrum = np.concatenate((self._spectrum, mel), axis=1)
+        self._latest = np.concatenate((self._latest, mel), axis=1)[:, -WINDOW_FRAMES:]
+        self._buffer = self._buffer[len(frames) * hop_length:]
+
+        while self._spectrum.shape[1] >= WINDOW_FRAMES:
+            self._windows.append(self._spectrum[:, :WINDOW_FRAMES].copy())
+            self._spectrum = self._spectrum[:, WINDOW_HOP_FRAMES:]
+
+    def take_windows(self):
+        """
+        Takes the windows completed since the last call.
+
+        :return: features shaped ``(windows, 40, 256, 1)``, as
+            :func:`audio_characteristics.tempo.read_features` returns them, or ``None``
+        """
+        with self._lock:
+            if not self._windows:
+                return None
+            windows, self._windows = self._windows, []
+        return np.stack(windows)[..., np.newaxis]
+
+    def latest_window(self):
+        """
+        The latest 256 frames, zero-padded at the end while there are fewer,
+        as read_features pads a short snippet.  Lets a caller evaluate a
+        growing capture before it fills a whole window.
+
+        :return: ``(features, fullness)`` - features shaped ``(1, 40, 256, 1)``
+            and the fraction of the window holding audio, or ``None`` before the first frame
+        """
+        with self._lock:
+            latest = self._latest
+        frames = latest.shape[1]
+        if frames == 0:
+            return None
+        window = np.zeros((1, self._mel.n_mels, WINDOW_FRAMES, 1), dtype=np.float32)
+        window[0, :, :frames, 0] = latest
+        return window, frames / WINDOW_FRAMES
+
+    def add_predictions(self, predictions, weights=None):
+        """
+        Folds the model's predictions into the tempo average.
+
+        :param predictions: tempo distributions, one row per window in the order they were taken
+        :param weights: with ``half_life=None``, the weight of each prediction
+            in the mean, e.g. the fullness of windows from :meth:`latest_window`; 1 by default
+        """
+        if weights is None:
+            weights = [1.] * len(predictions)
+        with self._lock:
+            for prediction, weight in zip(predictions, weights):
+                prediction = np.asarray(prediction, dtype=np.float64)
+                if self._distribution is None:
+                    self._distribution = prediction
+                elif self._decay is None:
+                    self._distribution = self._distribution + (prediction - self._distribution) * weight / (self._weight + weight)
+                else:
+                    self._distribution = self._decay * self._distribution + (1 - self._decay) * prediction
+                self._weight += weight
+                self.predicted_windows += 1
+
+    def confidence(self):
+        """
+        Probability the averaged distribution puts within 2 BPM of its peak,
+        between 0 and 1; ``None`` before the first prediction.
+        """
+        distribution = self._distribution
+        if distribution is None:
+            return None
+        peak = int(np.argmax(distribution))
+        return float(distribution[max(0, peak - CONFIDENCE_WIDTH):peak + CONFIDENCE_WIDTH + 1].sum())
+
+    def tempo(self, classifier):
+        """
+        :param classifier: :class:`audio_characteristics.tempo.TempoClassifier` that made the predictions
+        :return: tempo in BPM, or ``None`` before the first prediction
+        """
+        distribution = self._distribution
+        if distribution is None:
+            return None
+        return classifier.to_bpm(np.argmax(distribution))
+
+    def values(self, classifier):
+        """
+        Current values in the form :func:`audio_characteristics.profile.get_audio_characteristics`
+        returns them.  Loudness and pitch cover the audio since the previous
+        call, whose measurements are restarted.
+
+        :return: dict, or ``None`` while there is no tempo yet or the audio since the previous call was silent
+        """
+        with self._lock:
+            tempo = self.tempo(classifier)
+            loudness = self.loudness.integrated()
+            pitch = self.centroid.integrated()
+            self.loudness.restart()
+            self.centroid.restart()
+        if tempo is None or not np.isfinite(loudness) or not np.isfinite(pitch):
+            return None
+        return {
+            'station': '',
+            'tempo': int(tempo),
+            'loudness': int(loudness),
+            'pitch': int(pitch),
+        }
@@ -0,0 +1,264 @@
+"""
+Streaming loudness and spectral centroid.
+
+:func:`audio_characteristics.profile.loudness` and
+:func:`audio_characteristics.profile.pitch` need the whole snippet in memory.
+The accumulators here take PCM blocks of any size as they arrive and can
+report a value at any point, at a cost per block that does not grow with the
+length of the stream.
+
+:class:`LoudnessAccumulator` follows ITU-R BS.1770 as pyloudnorm implements
+it: the same K-weighting filters, run with their state carried from block to
+block, and 400 ms gating blocks with 75 % overlap, i.e. one every 100 ms.
+The block energies go into a histogram over loudness, so the two gates of the
+integrated loudness are applied to a fixed number of bins rather than to every
+block seen so far.
+
+:class:`CentroidAccumulator` frames the mono mix like librosa's STFT and keeps
+running sums of the per-frame centroids.
+"""
+import collections
+
+import numpy as np
+import pyloudnorm as pyln
+import scipy.signal
+
+from audio_characteristics.context import CENTROID_HOP_LENGTH, CENTROID_N_FFT
+
+# BS.1770 channel weights for L, R, C, Ls, Rs
+CHANNEL_GAINS = (1., 1., 1., 1.41, 1.41)
+
+# gating blocks are four 100 ms sub-blocks; short-term loudness covers 3 s
+SUB_BLOCKS_PER_SECOND = 10
+MOMENTARY_SUB_BLOCKS = 4
+SHORT_TERM_SUB_BLOCKS = 30
+
+ABSOLUTE_GATE = -70.
+RELATIVE_GATE = -10.
+
+# histogram of gating block loudness; blocks above the top go into the last bin,
+# which only affects the relative gate's decision on them, not their energy
+HISTOGRAM_TOP = 10.
+HISTOGRAM_BIN = .01
+
+MOMENTARY_SECONDS = .4
+SHORT_TERM_SECONDS = 3.
+
+
+def _lufs(energy):
+    with np.errstate(divide='ignore'):
+        return float(-0.691 + 10 * np.log10(energy))
+
+
+class LoudnessAccumulator:
+    """
+    BS.1770 momentary, short-term and integrated loudness of a stream of PCM blocks.
+    """
+
+    def __init__(self, sr, channels=2):
+        """
+        :param sr: sample rate of the blocks
+        :param channels: channels per sample, at most five
+        """
+        if not 1 <= channels <= len(CHANNEL_GAINS):
+            raise ValueError(f'BS.1770 loudness supports 1 to {len(CHANNEL_GAINS)} channels, got {channels}')
+        self.sr = int(sr)
+        self.channels = channels
+        self._gains = np.array(CHANNEL_GAINS[:channels])
+        # pyloudnorm's K-weighting: a high shelf followed by a high pass
+        meter = pyln.Meter(self.sr)
+        self._filters = [(f.passband_gain, f.b, f.a) for f in meter._filters.values()]
+        self._filter_states = [np.zeros((max(len(a), len(b)) - 1, channels)) for _, b, a in self._filters]
+
+        self.samples = 0
+        self._sub_blocks = 0
+        self._partial = 0.
+        self._recent = collections.deque(maxlen=SHORT_TERM_SUB_BLOCKS)
+
+        bins = int(round((HISTOGRAM_TOP - ABSOLUTE_GATE) / HISTOGRAM_BIN))
+        self._bin_loudness = ABSOLUTE_GATE + (np.arange(bins) + .5) * HISTOGRAM_BIN
+        self._bin_counts = np.zeros(bins, dtype=np.int64)
+        self._bin_energy = np.zeros(bins)
+
+    def _sub_block_end(self, index):
+        return (index + 1) * self.sr // SUB_BLOCKS_PER_SECOND
+
+    def add(self, block):
+        """
+        Feeds the next PCM block.
+
+        :param block: float PCM shaped ``(samples,)`` or ``(samples, channels)``
+        """
+        block = np.asarray(block, dtype=np.float64)
+        if block.ndim == 1:
+            block = block[:, np.newaxis]
+        if block.shape[1] != self.channels:
+            raise ValueError(f'expected {self.channels} channels, got {block.shape[1]}')
+        for i, (gain, b, a) in enumerate(self._filters):
+            block, self._filter_states[i] = scipy.signal.lfilter(b, a, block, axis=0, zi=self._filter_states[i])
+            block = gain * block
+        power = (block ** 2) @ self._gains
+
+        position = 0
+        while position < len(power):
+            end = min(len(power), position + self._sub_block_end(self._sub_blocks) - self.samples)
+            self._partial += power[position:end].sum()
+            self.samples += end - position
+            position = end
+            if self.samples == self._sub_block_end(self._sub_blocks):
+                self._close_sub_block()
+
+    def _close_sub_block(self):
+        self._recent.append(self._partial)
+        self._partial = 0.
+        self._sub_blocks += 1
+        if self._sub_blocks >= MOMENTARY_SUB_BLOCKS:
+            energy = self._energy(MOMENTARY_SUB_BLOCKS)
+            loudness = _lufs(energy)
+            if loudness >= ABSOLUTE_GATE:
+                index = min(int((loudness - ABSOLUTE_GATE) / HISTOGRAM_BIN), len(self._bin_counts) - 1)
+                self._bin_counts[index] += 1
+                self._bin_energy[index] += energy
+
+    def restart(self):
+        """
+        Starts a new integrated measurement from the next gating block on.
+        The filters keep their state, and momentary and short-term loudness
+        still cover the audio before the restart.
+        """
+        self._bin_counts[:] = 0
+        self._bin_energy[:] = 0
+
+    def _energy(self, sub_blocks):
+        recent = list(self._recent)[-sub_blocks:]
+        return sum(recent) / (len(recent) * self.sr / SUB_BLOCKS_PER_SECOND)
+
+    @property
+    def duration(self):
+        return self.samples / self.sr
+
+    def momentary(self):
+        """
+        Loudness of the last 400 ms in LUFS, ``-inf`` until that much audio was added.
+        """
+        if self._sub_blocks < MOMENTARY_SUB_BLOCKS:
+            return float('-inf')
+        return _lufs(self._energy(MOMENTARY_SUB_BLOCKS))
+
+    def short_term(self):
+        """
+        Loudness of the last 3 s in LUFS, or of everything added if that is shorter but at least 400 ms.
+        """
+        if self._sub_blocks < MOMENTARY_SUB_BLOCKS:
+            return float('-inf')
+        return _lufs(self._energy(SHORT_TERM_SUB_BLOCKS))
+
+    def integrated(self):
+        """
+        Gated loudness of everything added so far (or since :meth:`restart`)
+        in LUFS, as ``pyloudnorm.Meter.integrated_loudness`` measures it on the
+        whole signal; ``-inf`` if no block is above the absolute gate.
+        """
+        blocks = self._bin_counts.sum()
+        if blocks == 0:
+            return float('-inf')
+        threshold = _lufs(self._bin_energy.sum() / blocks) + RELATIVE_GATE
+        gated = self._bin_loudness > threshold
+        blocks = self._bin_counts[gated].sum()
+        if blocks == 0:
+            return float('-inf')
+        return _lufs(self._bin_energy[gated].sum() / blocks)
+
+
+class CentroidAccumulator:
+    """
+    Spectral centroid of a stream of PCM blocks, framed like
+    ``librosa.feature.spectral_centroid`` frames a whole signal.
+    """
+
+    def __init__(self, sr, n_fft=CENTROID_N_FFT, hop_length=CENTROID_HOP_LENGTH):
+        """
+        :param sr: sample rate of the blocks
+        """
+        self.sr = int(sr)
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self._window = scipy.signal.get_window('hann', n_fft).astype(np.float32)
+        self._frequencies = np.fft.rfftfreq(n_fft, 1 / self.sr)
+        # librosa centres the first frame on the first sample by padding with zeros
+        self._buffer = np.zeros(n_fft // 2, dtype=np.float32)
+        self.samples = 0
+        self.frames = 0
+        # frames since the last restart, and their sum
+        self._frames = 0
+        self._sum = 0.
+        self._recent = collections.deque(maxlen=int(np.ceil(SHORT_TERM_SECONDS * self.sr / hop_length)))
+        self._momentary_frames = int(np.ceil(MOMENTARY_SECONDS * self.sr / hop_length))
+
+    def _centroids(self, signal):
+        frames = np.lib.stride_tricks.sliding_window_view(signal, self.n_fft)[::self.hop_length]
+        magnitude = np.abs(np.fft.rfft(frames * self._window, axis=1))
+        total = magnitude.sum(axis=1)
+        weighted = magnitude @ self._frequencies
+        # librosa leaves frames without energy unnormalised, which makes their centroid 0
+        return np.divide(weighted, total, out=np.zeros_like(weighted), where=total > np.finfo(np.float32).tiny)
+
+    def add(self, block):
+        """
+        Feeds the next PCM block.
+
+        :param block: float PCM shaped ``(samples,)`` or ``(samples, channels)``; channels are averaged
+        """
+        block = np.asarray(block, dtype=np.float32)
+        if block.ndim == 2:
+            block = block.mean(axis=1)
+        self.samples += len(block)
+        self._buffer = np.concatenate((self._buffer, block))
+        if len(self._buffer) < self.n_fft:
+            return
+        centroids = self._centroids(self._buffer)
+        self._buffer = self._buffer[len(centroids) * self.hop_length:]
+        self.frames += len(centroids)
+        self._frames += len(centroids)
+        self._sum += float(centroids.sum())
+        self._recent.extend(centroids.tolist())
+
+    def restart(self):
+        """
+        Starts a new integrated measurement from the next frame on.
+        """
+        self._frames = 0
+        self._sum = 0.
+
+    def _recent_mean(self, frames):
+        if not self._recent:
+            return float('nan')
+        recent = list(self._recent)[-frames:]
+        return sum(recent) / len(recent)
+
+    def momentary(self):
+        """
+        Mean centroid in Hz of the frames in the last 400 ms.
+        """
+        return self._recent_mean(self._momentary_frames)
+
+    def short_term(self):
+        """
+        Mean centroid in Hz of the frames in the last 3 s.
+        """
+        return self._recent_mean(len(self._recent))
+
+    def integrated(self):
+        """
+        Mean centroid in Hz of everything added so far (or since
+        :meth:`restart`), including the frames at the end that librosa pads
+        with zeros, so it matches :func:`audio_characteristics.profile.pitch`
+        on the same signal.
+        """
+        tail = 1 + self.samples // self.hop_length - self.frames
+        total, frames = self._sum, self._frames
+        if tail > 0:
+            padded = np.concatenate((self._buffer, np.zeros(self.n_fft // 2, dtype=np.float32)))
+            centroids = self._centroids(padded)[:tail]
+            total, frames = total + float(centroids.sum()), frames + len(centroids)
+        return total / frames if frames else float('nan')
@@ -1,15 +1,30 @@
 import librosa as librosa
-import tensorflow as tf
 import numpy as np
 from pathlib import Path
 import pkgutil
 import logging
+import os
+import threading
+import time
 import urllib.request
 from urllib.error import HTTPError
 import sys
 
+import psutil
+
+from audio_characteristics.context import AnalysisContext, TEMPO_SAMPLE_RATE
+from audio_characteristics.features import mel_extractor, sliding_windows
+from audio_characteristics.tflite import TFLiteModel, ensure_tflite_model
+
 logger = logging.getLogger('tempocnn.classifier')
 
+BACKENDS = ('keras', 'tflite')
+
+# defaults for the registry; the TFLite backend avoids importing TensorFlow where tflite_runtime is installed
+DEFAULT_BACKEND = os.getenv('TEMPO_BACKEND', 'keras')
+DEFAULT_QUANTIZATION = os.getenv('TEMPO_QUANTIZATION') or None
+DEFAULT_NUM_THREADS = int(os.getenv('TEMPO_NUM_THREADS', '0')) or None
+
 
 def std_normalizer(data):
     """
@@ -37,7 +52,8 @@ def max_normalizer(data):
     """
     m = np.max(data)
     if m != 0:
-        data /= m
+        # not in place: features may be overlapping strided views of one spectrogram
+        data = data / m
     return data
 
 
@@ -46,12 +62,20 @@ class TempoClassifier:
     Classifier that can estimate musical tempo in different formats.
     """
 
-    def __init__(self, model_name='fcn'):
+    def __init__(self, model_name='fcn', backend='keras', quantization=None, num_threads=None):
         """
         Initializes this classifier with a Keras model.
 
         :param model_name: model name from sub-package models. E.g. 'fcn', 'cnn', or 'ismir2018'
+        :param backend: ``'keras'`` runs the ``.h5`` model; ``'tflite'`` converts it
+            once to a TFLite model stored next to it and runs that instead
+        :param quantization: TFLite only; one of :data:`audio_characteristics.tflite.QUANTIZATIONS`
+        :param num_threads: TFLite only; interpreter threads
         """
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend '{backend}'. Expected one of {BACKENDS}.")
+        if backend == 'keras' and quantization is not None:
+            raise ValueError('Quantization is only available with the tflite backend.')
         if 'fma' in model_name:
             # fma model uses log BPM scale
             factor = 256. / np.log(10)
@@ -79,14 +103,18 @@ class TempoClassifier:
             else max_normalizer
 
         resource = _to_model_resource(model_name)
-        print('resource', resource)
         try:
             file = _extract_from_package(resource)
         except Exception as e:
             print('Failed to find a model named \'{}\'. Please check the model name.'.format(model_name),
                   file=sys.stderr)
             raise e
-        self.model = tf.keras.models.load_model(file)
+        self.backend = backend
+        if backend == 'tflite':
+            self.model = TFLiteModel(ensure_tflite_model(file, quantization), num_threads=num_threads)
+        else:
+            import tensorflow as tf
+            self.model = tf.keras.models.load_model(file)
 
     def estimate_tempo(self, data, interpolate=False):
         """
@@ -98,6 +126,21 @@ class TempoClassifier:
         :return: a single tempo
         """
         prediction = self.estimate(data)
+        return self._to_tempo(prediction, interpolate)
+
+    def estimate_tempo_batch(self, datas, interpolate=False, batch_size=None):
+        """
+        Estimates the pre-dominant global tempo of several snippets with a single model call.
+
+        :param datas: list of feature tensors, e.g. one per station
+        :param interpolate: see :meth:`estimate_tempo`
+        :param batch_size: number of windows per forward pass, all of them by default
+        :return: list of tempi, one per feature tensor
+        """
+        return [self._to_tempo(prediction, interpolate)
+                for prediction in self.estimate_batch(datas, batch_size=batch_size)]
+
+    def _to_tempo(self, prediction, interpolate):
         averaged_prediction = np.average(prediction, axis=0)
         if interpolate:
             index, _ = self.quad_interpol_argmax(averaged_prediction)
@@ -105,24 +148,73 @@ class TempoClassifier:
             index = np.argmax(averaged_prediction)
         return self.to_bpm(index)
 
-    def estimate(self, data):
+    def estimate(self, data, batch_size=None):
         """
         Estimate a tempo distribution.
         Probabilities are indexed, starting with 30 BPM and ending with 286 BPM.
 
         :param data: features
+        :param batch_size: number of windows per forward pass, all of them by default
         :return: tempo probability distribution
         """
-        assert len(
-            data.shape) == 4, 'Input data must be four dimensional. Actual shape was ' + str(data.shape)
-        assert data.shape[1] == 40, 'Second dim of data must be 40. Actual shape was ' + \
-            str(data.shape)
-        assert data.shape[2] == 256, 'Third dim of data must be 256. Actual shape was ' + \
-            str(data.shape)
-        assert data.shape[3] == 1, 'Fourth dim of data must be 1. Actual shape was ' + \
-            str(data.shape)
+        _check_shape(data)
         norm_data = self.normalize(data)
-        return self.model.predict(norm_data, norm_data.shape[0])
+        return self.model.predict(norm_data, batch_size or norm_data.shape[0])
+
+    def estimate_batch(self, datas, batch_size=None):
+        """
+        Estimate tempo distributions for several feature tensors at once.
+
+        Every tensor is normalized on its own, exactly as :meth:`estimate` would,
+        then the sliding windows of all tensors are concatenated into one
+        prediction call and the result is split back per tensor.  This pays the
+        model's fixed per-call cost once instead of once per snippet.
+
+        :param datas: list of feature tensors
+        :param batch_size: number of windows per forward pass, all of them by default
+        :return: list of tempo probability distributions, one per feature tensor
+        """
+        if len(datas) == 0:
+            return []
+        for data in datas:
+            _check_shape(data)
+        norm_data = np.concatenate([self.normalize(data) for data in datas], axis=0)
+        prediction = self.model.predict(norm_data, batch_size or norm_data.shape[0])
+        return np.split(prediction, np.cumsum([data.shape[0] for data in datas])[:-1])
+
+    @staticmethod
+    def quad_interpol_argmax(y, x=None):
+        """
+        Find argmax for quadratic interpolation around argmax of y.
+
+        :param x: x corresponding to y
+        :param y: array
+        :return: float (index) of interpolated max, strength
+        """
+        if x is None:
+            x = np.arange(y.shape[0])
+        ind = np.argmax(y)
+        if ind == 0 or ind == y.shape[0] - 1:
+            return x[ind], y[ind]
+        (a, b, c) = np.polyfit(x[ind - 1:ind + 2], y[ind - 1:ind + 2], 2)
+        if a >= 0:
+            # not max
+            return x[ind], y[ind]
+        # where the derivative is zero
+        max_index = -b / (2 * a)
+        max_value = a * max_index ** 2 + b * max_index + c
+        return max_index, max_value
+
+
+def _check_shape(data):
+    assert len(
+        data.shape) == 4, 'Input data must be four dimensional. Actual shape was ' + str(data.shape)
+    assert data.shape[1] == 40, 'Second dim of data must be 40. Actual shape was ' + \
+        str(data.shape)
+    assert data.shape[2] == 256, 'Third dim of data must be 256. Actual shape was ' + \
+        str(data.shape)
+    assert data.shape[3] == 1, 'Fourth dim of data must be 1. Actual shape was ' + \
+        str(data.shape)
 
 
 def _to_model_resource(model_name):
@@ -137,7 +229,7 @@ def _to_model_resource(model_name):
 def _extract_from_package(resource):
     # check local cache
     cache_path = Path(Path.home(), '.tempocnn', resource)
-    print('cache path', cache_path)
+    logger.debug(f"Looking for model in cache {cache_path}")
     if cache_path.exists():
         return str(cache_path)
 
@@ -197,16 +289,36 @@ def read_features(file, frames=256, hop_length=128, zero_pad=False):
     at the back in order to make the calculation of BPM values for the first
     and the last window possible.
 
-    :param file: file
+    :param file: file or :class:`AnalysisContext` holding the decoded audio
     :param frames: 256
     :param hop_length: 128 or shorter
     :param zero_pad: adds 128 zero frames both at the front and back
     :param normalize: normalization function
     :return: feature tensor for the whole file
     """
-    y, sr = librosa.load(file, sr=11025)
-    data = librosa.feature.melspectrogram(y=y, sr=11025, n_fft=1024, hop_length=512,
-                                          power=1, n_mels=40, fmin=20, fmax=5000)
+    data = mel_extractor().melspectrogram(_load_tempo_signal(file))
+    return _to_windows(data, frames, hop_length, zero_pad)
+
+
+def read_features_batch(files, frames=256, hop_length=128, zero_pad=False):
+    """
+    Same as :func:`read_features` for several files or :class:`AnalysisContext`
+    objects, whose windows are then predicted together, see :meth:`TempoClassifier.estimate_batch`.
+
+    :return: list of feature tensors, one per file
+    """
+    spectra = mel_extractor().melspectrograms([_load_tempo_signal(file) for file in files])
+    return [_to_windows(data, frames, hop_length, zero_pad) for data in spectra]
+
+
+def _load_tempo_signal(file):
+    if isinstance(file, AnalysisContext):
+        return file.y_tempo
+    y, _ = librosa.load(file, sr=TEMPO_SAMPLE_RATE)
+    return y
+
+
+def _to_windows(data, frames, hop_length, zero_pad):
     data = np.reshape(data, (1, data.shape[0], data.shape[1], 1))
 
     # add frames/2 zero frames before and after the data
@@ -238,30 +350,124 @@ def _add_zeros(data, zeros):
 
 
 def _to_sliding_window(data, window_length, hop_length):
-    total_frames = data.shape[2]
-    windowed_data = []
-    for offset in range(0, ((total_frames - window_length) // hop_length + 1) * hop_length, hop_length):
-        windowed_data.append(
-            np.copy(data[:, :, offset:window_length + offset, :]))
-    return np.concatenate(windowed_data, axis=0)
+    # windows are views into data, not copies
+    return sliding_windows(data, window_length, hop_length)
+
+
+"""
+Process-wide registry of loaded classifiers.
+
+Loading a Keras model costs far more than running it on a few seconds of
+audio, so every caller in this process shares one warm
+:class:`TempoClassifier` per model name.
+"""
+
+_classifiers = {}
+_classifiers_lock = threading.Lock()
+_model_load_stats = {}
+
+
+def get_classifier(model_name='cnn', backend=None, quantization=None, num_threads=None):
+    """
+    Returns the shared classifier for ``model_name``, loading it on first use.
+    Each backend, quantization and thread count gets its own instance.
+
+    Safe to call from several threads; concurrent first calls for the same
+    model wait for a single load instead of loading it twice.
+
+    :param model_name: model name, see :class:`TempoClassifier`
+    :param backend: ``'keras'`` or ``'tflite'``, ``$TEMPO_BACKEND`` (default keras) if ``None``
+    :param quantization: TFLite quantization, ``$TEMPO_QUANTIZATION`` if ``None``
+    :param num_threads: TFLite threads, ``$TEMPO_NUM_THREADS`` if ``None``
+    :return: warm classifier
+    """
+    backend = backend or DEFAULT_BACKEND
+    if backend == 'tflite':
+        quantization = quantization or DEFAULT_QUANTIZATION
+        num_threads = num_threads or DEFAULT_NUM_THREADS
+    key = _registry_key(model_name, backend, quantization, num_threads)
+    classifier = _classifiers.get(key)
+    if classifier is not None:
+        return classifier
+
+    with _classifiers_lock:
+        classifier = _classifiers.get(key)
+        if classifier is None:
+            process = psutil.Process()
+            rss_before = process.memory_info().rss
+            start = time.perf_counter()
+            classifier = TempoClassifier(model_name, backend=backend, quantization=quantization,
+                                         num_threads=num_threads)
+            _model_load_stats[key] = {
+                'load_seconds': time.perf_counter() - start,
+                'rss_bytes': process.memory_info().rss - rss_before,
+            }
+            logger.info(f"Loaded tempo model '{key}' in "
+                        f"{_model_load_stats[key]['load_seconds']:.2f}s "
+                        f"(+{_model_load_stats[key]['rss_bytes'] / 2 ** 20:.1f} MiB RSS)")
+            _classifiers[key] = classifier
+    return classifier
+
+
+def _registry_key(model_name, backend, quantization, num_threads=None):
+    if backend == 'keras':
+        return model_name
+    # an interpreter's thread count is fixed when it is created, so each count gets its own
+    return (f'{model_name}:{backend}' + (f'-{quantization}' if quantization else '')
+            + (f'x{num_threads}' if num_threads else ''))
+
+
+def preload_classifiers(model_names=('cnn',)):
+    """
+    Loads the given models into the registry ahead of the first analysis.
+
+    :param model_names: iterable of model names
+    :return: load statistics, see :func:`model_load_stats`
+    """
+    for model_name in model_names:
+        get_classifier(model_name)
+    return model_load_stats()
+
+
+def model_load_stats():
+    """
+    Load time and resident memory growth for every model loaded so far.
+
+    :return: dict mapping model name (suffixed with the backend unless it is
+        Keras, e.g. ``'cnn:tflite-float16'``) to ``{'load_seconds', 'rss_bytes'}``
+    """
+    with _classifiers_lock:
+        return {name: dict(stats) for name, stats in _model_load_stats.items()}
 
 
 def get_tempo(model_name, file_path):
+    """
+    Estimates the global tempo of a file or an already decoded :class:`AnalysisContext`.
+    """
     try:
-        # initialize the model (may be re-used for multiple files)
-        classifier = TempoClassifier(model_name)
+        # the model is loaded once per process and re-used for every file
+        classifier = get_classifier(model_name)
 
         # read the file's features
         features = read_features(file_path)
 
         # # estimate the global tempo
         tempo = classifier.estimate_tempo(features, interpolate=False)
-        print(tempo)
         return tempo
-    except CouldntDecodeError:
-        print('Could not decode.')
-    except Error as e:
-        print(f'line 264, tempo: {e}')
+    except Exception as e:
+        print(f'Exception occurred in get_tempo: {e}')
+
+
+def get_tempo_batch(model_name, file_paths, interpolate=False, batch_size=None):
+    """
+    Estimates the global tempo of several files or :class:`AnalysisContext` objects
+    with one model call, see :meth:`TempoClassifier.estimate_tempo_batch`.
+
+    :return: list of tempi in the order of ``file_paths``
+    """
+    classifier = get_classifier(model_name)
+    features = read_features_batch(file_paths)
+    return classifier.estimate_tempo_batch(features, interpolate=interpolate, batch_size=batch_size)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,173 @@
+"""
+TFLite inference backend for the tempo-cnn models.
+
+The cached Keras ``.h5`` models are converted once into TFLite flatbuffers
+stored next to them (``~/.tempocnn/models/cnn.tflite``,
+``cnn.float16.tflite``, ``cnn.int8.tflite``, ``cnn.int8-full.tflite``) and run through the TFLite
+interpreter, which starts faster and needs far less memory than Keras.  When
+a standalone runtime (``tflite_runtime`` or ``ai_edge_litert``) is installed
+it is used for inference, so TensorFlow itself is only imported for the
+one-off conversion.
+"""
+import logging
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger('tempocnn.tflite')
+
+# 'int8' quantizes the weights only, 'int8-full' the activations too, calibrated on representative data
+QUANTIZATIONS = (None, 'float16', 'int8', 'int8-full')
+
+
+def tflite_model_path(h5_file, quantization=None):
+    """
+    Location of the TFLite artifact for a cached Keras model.
+
+    :param h5_file: path of the ``.h5`` model
+    :param quantization: one of :data:`QUANTIZATIONS`
+    :return: path next to ``h5_file``
+    """
+    _check_quantization(quantization)
+    suffix = '.tflite' if quantization is None else f'.{quantization}.tflite'
+    return Path(h5_file).with_suffix(suffix)
+
+
+def convert(h5_file, quantization=None, representative_data=None):
+    """
+    Converts a Keras model to TFLite and stores it next to the original.
+
+    :param h5_file: path of the ``.h5`` model
+    :param quantization: ``None`` keeps float32 weights; ``'float16'`` halves
+        the weights; ``'int8'`` quantizes the weights (dynamic range, float
+        input and output); ``'int8-full'`` quantizes weights and activations,
+        with int8 input and output
+    :param representative_data: normalized feature windows shaped
+        ``(n, 40, 256, 1)`` used to calibrate ``'int8-full'``, which needs them
+    :return: path of the TFLite model
+    """
+    import tensorflow as tf
+
+    if quantization == 'int8-full' and representative_data is None:
+        raise ValueError("'int8-full' quantization needs representative_data to calibrate the activations.")
+
+    target = tflite_model_path(h5_file, quantization)
+    model = tf.keras.models.load_model(h5_file)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    elif quantization == 'int8-full':
+        def representative_dataset():
+            for window in representative_data:
+                yield [np.asarray(window[np.newaxis], dtype=np.float32)]
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.int8
+        converter.inference_output_type = tf.int8
+    flatbuffer = converter.convert()
+
+    # write atomically, other processes may be converting the same model
+    temporary = target.with_name(f'{target.name}.{os.getpid()}.tmp')
+    temporary.write_bytes(flatbuffer)
+    os.replace(temporary, target)
+    logger.info(f'Converted {h5_file} to {target} ({len(flatbuffer) / 2 ** 20:.1f} MiB)')
+    return target
+
+
+def ensure_tflite_model(h5_file, quantization=None):
+    """
+    Returns the TFLite artifact for ``h5_file``, converting it on first use.
+    An ``'int8-full'`` model must have been converted with representative data before.
+    """
+    target = tflite_model_path(h5_file, quantization)
+    if not target.exists():
+        if quantization == 'int8-full':
+            raise FileNotFoundError(f'{target} is missing, convert it with representative data first')
+        convert(h5_file, quantization)
+    return target
+
+
+def _interpreter_class():
+    # prefer the standalone runtimes, which don't pull in TensorFlow
+    try:
+        from tflite_runtime.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        pass
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        pass
+    import tensorflow as tf
+    return tf.lite.Interpreter
+
+
+def _check_quantization(quantization):
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization '{quantization}'. Expected one of {QUANTIZATIONS}.")
+
+
+class TFLiteModel:
+    """
+    Runs a TFLite tempo model with the ``predict(data, batch_size)`` interface
+    of a Keras model, so :class:`TempoClassifier` can use either.
+    """
+
+    def __init__(self, path, num_threads=None):
+        """
+        :param path: TFLite model file
+        :param num_threads: interpreter threads, ``None`` lets TFLite decide
+        """
+        self.path = str(path)
+        self.interpreter = _interpreter_class()(model_path=self.path, num_threads=num_threads)
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        self._batch_size = None
+        # an interpreter holds its tensors as state and must not be invoked concurrently
+        self._lock = threading.Lock()
+
+    def _resize(self, batch_size):
+        if batch_size != self._batch_size:
+            shape = [batch_size, *self._input['shape'][1:]]
+            self.interpreter.resize_tensor_input(self._input['index'], shape)
+            self.interpreter.allocate_tensors()
+            self._input = self.interpreter.get_input_details()[0]
+            self._output = self.interpreter.get_output_details()[0]
+            self._batch_size = batch_size
+
+    def _quantize(self, data):
+        if self._input['dtype'] == np.float32:
+            return np.ascontiguousarray(data, dtype=np.float32)
+        scale, zero_point = self._input['quantization']
+        info = np.iinfo(self._input['dtype'])
+        return np.clip(np.round(data / scale + zero_point), info.min, info.max).astype(self._input['dtype'])
+
+    def _dequantize(self, data):
+        if self._output['dtype'] == np.float32:
+            return data
+        scale, zero_point = self._output['quantization']
+        return (data.astype(np.float32) - zero_point) * scale
+
+    def predict(self, data, batch_size=None):
+        """
+        :param data: normalized features shaped ``(windows, 40, 256, 1)``
+        :param batch_size: windows per interpreter invocation, all of them by default
+        :return: tempo distributions shaped ``(windows, classes)``
+        """
+        batch_size = batch_size or data.shape[0]
+        predictions = []
+        with self._lock:
+            for start in range(0, data.shape[0], batch_size):
+                batch = data[start:start + batch_size]
+                self._resize(batch.shape[0])
+                self.interpreter.set_tensor(self._input['index'], self._quantize(batch))
+                self.interpreter.invoke()
+                predictions.append(self._dequantize(self.interpreter.get_tensor(self._output['index'])))
+        return np.concatenate(predictions, axis=0)
@@ -0,0 +1,85 @@
+"""
+Optional per-stage timings of the analysis functions.
+
+The extractors time themselves with :func:`timer`, which costs a function call
+and a flag check while recording is off.  When it is on, every stage's
+duration and every failure is appended to a process-local list, which the
+caller drains, e.g. an analysis worker that sends them to the process serving
+the metrics.
+"""
+import time
+
+_recording = False
+_stages = []
+_failures = []
+
+
+class _Timer:
+    __slots__ = ('stage', 'station', 'start')
+
+    def __init__(self, stage, station):
+        self.stage = stage
+        self.station = station
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _stages.append((self.stage, self.station, time.perf_counter() - self.start))
+        if exc_type is not None:
+            _failures.append((self.stage, self.station))
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(stage, station=None):
+    """
+    Context manager timing one stage for one station; an exception leaving it is counted as a failure of the stage.
+    """
+    return _Timer(stage, station) if _recording else _NULL_TIMER
+
+
+def record(stage, station, seconds):
+    """
+    Records a stage duration measured elsewhere, e.g. a share of a batched call.
+    """
+    if _recording:
+        _stages.append((stage, station, seconds))
+
+
+def failure(stage, station=None):
+    if _recording:
+        _failures.append((stage, station))
+
+
+def start_recording():
+    global _recording
+    _recording = True
+
+
+def recording():
+    return _recording
+
+
+def drain():
+    """
+    Takes everything recorded so far.
+
+    :return: ``(stages, failures)``: lists of ``(stage, station, seconds)`` and ``(stage, station)``
+    """
+    global _stages, _failures
+    stages, failures = _stages, _failures
+    _stages, _failures = [], []
+    return stages, failures
@@ -0,0 +1,85 @@
+"""
+Captures fixture streams with radio.adaptive and compares the audio each
+capture needed, its tempo and its confidence with a fixed 6 s capture.
+
+Every fixture is served looped by its own local stream stand-in, paced at
+``--speed`` times real time, with ``--stations`` stations per fixture.
+
+    python -m benchmarks.bench_adaptive --stations 5 --speed 4
+"""
+import argparse
+import contextlib
+import io
+import logging
+import time
+
+import numpy as np
+
+from audio_characteristics.decode import decode_to_context
+from audio_characteristics.profile import get_audio_characteristics
+from audio_characteristics.tempo import get_classifier
+from benchmarks.fixtures import SAMPLE_RATE, click_track, encode, noise, song
+from benchmarks.servers import StreamStandIn
+from radio.adaptive import AdaptiveCapture
+
+FIXTURES = {
+    'song 80': (80, lambda seconds: song(80, seconds)),
+    'song 120': (120, lambda seconds: song(120, seconds, root=3)),
+    'song 160': (160, lambda seconds: song(160, seconds, root=5)),
+    'clicks 100': (100, lambda seconds: click_track(100, seconds)),
+    'noise': (None, lambda seconds: noise(seconds)),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--stations', type=int, default=5, help='stations per fixture')
+    parser.add_argument('--speed', type=float, default=4., help='stream pacing, times real time')
+    parser.add_argument('--threshold', type=float, default=.6)
+    parser.add_argument('--max-seconds', type=float, default=20.)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    payloads = {name: encode(make(30.), SAMPLE_RATE, 'mp3') for name, (_, make) in FIXTURES.items()}
+    fixed = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name, (_, make) in FIXTURES.items():
+            context = decode_to_context(encode(make(6.), SAMPLE_RATE, 'mp3'), 'mp3', SAMPLE_RATE, 2)
+            fixed[name] = get_audio_characteristics(context, use_cache=False)
+        # the first prediction builds the model's graph; the daemon pays for it once, in its first burst
+        get_classifier().estimate(np.zeros((1, 40, 256, 1), dtype=np.float32))
+
+    adaptive = AdaptiveCapture(threshold=args.threshold, max_seconds=args.max_seconds)
+    with contextlib.ExitStack() as stack:
+        servers = {name: stack.enter_context(StreamStandIn(payload, speed=args.speed))
+                   for name, payload in payloads.items()}
+        stations = {f'{name}/{i}': {'stream_url': server.url(f'station{i}'), 'audio_type': 'mp3'}
+                    for name, server in servers.items() for i in range(args.stations)}
+        start = time.perf_counter()
+        # keras prints a progress bar per prediction
+        with contextlib.redirect_stdout(io.StringIO()):
+            results, failures = adaptive.run(stations)
+        elapsed = time.perf_counter() - start
+    stats = adaptive.stats()
+    adaptive.close()
+
+    print(f'{len(stations)} stations at {args.speed:g}x in {elapsed:.1f}s, {len(failures)} failed, '
+          f'{stats["evaluations"]} evaluations')
+    print(f'{"fixture":<12}{"fixed 6s":>10}{"adaptive":>10}{"confidence":>12}{"seconds":>10}')
+    for name, (bpm, _) in FIXTURES.items():
+        values = [values for station, values in results.items() if station.split('/')[0] == name]
+        fixed_tempo = fixed[name]['tempo'] if fixed[name] else None
+        if not values:
+            print(f'{name:<12}{fixed_tempo!s:>10}{"-":>10}')
+            continue
+        tempi = sorted({v['tempo'] for v in values})
+        confidence = np.mean([v['confidence'] for v in values])
+        print(f'{name:<12}{fixed_tempo!s:>10}{"/".join(map(str, tempi)):>10}{confidence:>12.2f}'
+              f'{np.mean([v["seconds"] for v in values]):>10.1f}')
+    audio = stats['seconds']
+    print(f'{stats["confident"]} confident, {stats["at_max"]} at the maximum; {audio:.0f}s of audio captured, '
+          f'{stats["mean_seconds"]:.1f}s per capture against 6s fixed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Follows stations continuously with radio.continuous and reports what an
+update costs and how close its values are to the batch profile.
+
+Every station is served the same looped fixture by a local stream stand-in,
+paced at ``--speed`` times real time, so a run covers several minutes of
+audio in less wall time.  The update interval is scaled the same way.
+
+    python -m benchmarks.bench_continuous --stations 20 --speed 4 --audio-seconds 120
+"""
+import argparse
+import contextlib
+import io
+import logging
+import threading
+import time
+
+import numpy as np
+import psutil
+
+from audio_characteristics.decode import decode_to_context
+from audio_characteristics.profile import get_audio_characteristics
+from benchmarks.fixtures import SAMPLE_RATE, encode, song
+from benchmarks.servers import StreamStandIn
+from radio.continuous import ContinuousEngine
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--stations', type=int, default=20)
+    parser.add_argument('--bpm', type=int, default=120)
+    parser.add_argument('--speed', type=float, default=4., help='stream pacing, times real time')
+    parser.add_argument('--audio-seconds', type=float, default=120., help='seconds of audio per station')
+    parser.add_argument('--interval', type=float, default=30., help='seconds of audio between updates')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    payload = encode(song(args.bpm, 30.), SAMPLE_RATE, 'mp3')
+    with contextlib.redirect_stdout(io.StringIO()):
+        batch = get_audio_characteristics(decode_to_context(payload, 'mp3', SAMPLE_RATE, 2), use_cache=False)
+
+    engine = ContinuousEngine(interval=args.interval / args.speed)
+    updates = []
+
+    def on_values(station, values):
+        updates.append((time.perf_counter(), station, values))
+
+    process = psutil.Process()
+    with StreamStandIn(payload, speed=args.speed) as streams:
+        stations = {f'station{i}': {'stream_url': streams.url(f'station{i}'), 'audio_type': 'mp3'}
+                    for i in range(args.stations)}
+        stopper = threading.Timer(args.audio_seconds / args.speed, engine.stop)
+        stopper.start()
+        cpu_before = sum(process.cpu_times()[:2])
+        start = time.perf_counter()
+        # keras prints a progress bar per prediction
+        with contextlib.redirect_stdout(io.StringIO()):
+            engine.run_forever(stations, on_values)
+        elapsed = time.perf_counter() - start
+        cpu = sum(process.cpu_times()[:2]) - cpu_before
+    stats = engine.stats()
+
+    audio = args.stations * args.audio_seconds
+    print(f'{args.stations} stations, {args.audio_seconds:.0f}s of audio each at {args.speed:g}x in {elapsed:.1f}s')
+    print(f'connections {stats["connects"]}, failures {stats["failures"]}, updates {stats["updates"]}, '
+          f'windows predicted {stats["windows"]}, values published {stats["published"]}')
+    print(f'CPU {cpu:.1f}s for {audio:.0f}s of audio: {cpu / audio * 1000:.1f}ms per second of audio, '
+          f'{cpu / audio * 100:.2f}% of a core per station')
+    print(f'last update {stats["last_update_seconds"] * 1000:.1f}ms for {stats["last_update_windows"]} windows '
+          f'({stats["last_inference_seconds"] * 1000:.1f}ms inference)')
+    if updates:
+        tempi = [values['tempo'] for _, _, values in updates]
+        loudness = [values['loudness'] for _, _, values in updates]
+        pitch = [values['pitch'] for _, _, values in updates]
+        print(f'batch profile of the mp3: tempo {batch["tempo"]}, loudness {batch["loudness"]}, pitch {batch["pitch"]}')
+        print(f'continuous: tempo correct {np.mean([abs(t - args.bpm) <= 2 for t in tempi]):.0%}, '
+              f'loudness {min(loudness)}..{max(loudness)}, pitch {min(pitch)}..{max(pitch)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Compares the ffmpeg pipe decoder with the old pydub -> WAV -> librosa path.
+
+The old path decoded the capture with pydub, exported a WAV to disk and then
+decoded that WAV again with librosa at 11025 Hz (tempo) and at its native
+rate (loudness and pitch).  The new path decodes the compressed bytes once,
+inside ffmpeg, and resamples that PCM to 11025 Hz mono.
+
+    python -m benchmarks.bench_decode --seconds 6 --repeat 10
+"""
+import argparse
+import io
+import os
+import tempfile
+import time
+
+import librosa
+import numpy as np
+import soundfile as sf
+from pydub import AudioSegment
+
+from audio_characteristics.context import TEMPO_SAMPLE_RATE
+from audio_characteristics.decode import decode_to_context
+from benchmarks.fixtures import SAMPLE_RATE, encode, tone
+
+
+def pydub_wav_librosa(data, audio_type):
+    with tempfile.TemporaryDirectory() as directory:
+        wav_file = os.path.join(directory, 'snippet.wav')
+        AudioSegment.from_file(io.BytesIO(data), format=audio_type).export(wav_file, format='wav')
+        y_tempo, _ = librosa.load(wav_file, sr=TEMPO_SAMPLE_RATE)
+        samples, sr = sf.read(wav_file)
+        return samples, y_tempo
+
+
+def ffmpeg_pipe(data, audio_type):
+    context = decode_to_context(data, audio_type, SAMPLE_RATE, 2)
+    return context.samples, context.y_tempo
+
+
+def time_path(path, data, audio_type, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        path(data, audio_type)
+        timings.append(time.perf_counter() - start)
+    return np.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=6.)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    samples = tone(args.seconds)
+    print(f'{"audio_type":<12}{"pydub+wav+librosa":>20}{"ffmpeg pipe":>14}{"speed-up":>10}')
+    for audio_type in ('mp3', 'aac'):
+        data = encode(samples, SAMPLE_RATE, audio_type)
+        old = time_path(pydub_wav_librosa, data, audio_type, args.repeat)
+        new = time_path(ffmpeg_pipe, data, audio_type, args.repeat)
+        print(f'{audio_type:<12}{old * 1000:>18.1f}ms{new * 1000:>12.1f}ms{old / new:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
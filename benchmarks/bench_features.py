@@ -0,0 +1,80 @@
+"""
+Compares the tempo-cnn feature front-end with the original implementation.
+
+The original built the mel basis inside librosa.feature.melspectrogram on
+every call and copied every 256-frame window in a Python loop before
+concatenating them.  The new front-end keeps the basis and window as state,
+returns the windows as strided views.  read_features_batch is timed as well;
+it saves nothing per snippet, its point is the batched prediction after it.
+Both are checked for equal output before they are timed.
+
+    python -m benchmarks.bench_features --seconds 6 --snippets 5 --repeat 20
+"""
+import argparse
+import time
+import tracemalloc
+
+import librosa
+import numpy as np
+
+from audio_characteristics.context import AnalysisContext, TEMPO_SAMPLE_RATE
+from audio_characteristics.tempo import _ensure_length, read_features, read_features_batch
+
+
+def legacy_read_features(y, frames=256, hop_length=128):
+    data = librosa.feature.melspectrogram(y=y, sr=TEMPO_SAMPLE_RATE, n_fft=1024, hop_length=512,
+                                          power=1, n_mels=40, fmin=20, fmax=5000)
+    data = np.reshape(data, (1, data.shape[0], data.shape[1], 1))
+    if data.shape[2] < frames:
+        data = _ensure_length(data, frames)
+    windowed_data = []
+    for offset in range(0, ((data.shape[2] - frames) // hop_length + 1) * hop_length, hop_length):
+        windowed_data.append(np.copy(data[:, :, offset:frames + offset, :]))
+    return np.concatenate(windowed_data, axis=0)
+
+
+def measure(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return np.median(timings), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=6.)
+    parser.add_argument('--snippets', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    signals = [0.1 * rng.standard_normal(int(args.seconds * TEMPO_SAMPLE_RATE)).astype(np.float32)
+               for _ in range(args.snippets)]
+    contexts = [AnalysisContext(y, TEMPO_SAMPLE_RATE) for y in signals]
+
+    for y, context in zip(signals, contexts):
+        expected, actual = legacy_read_features(y), read_features(context)
+        assert expected.shape == actual.shape, (expected.shape, actual.shape)
+        error = np.max(np.abs(expected - actual)) / np.max(np.abs(expected))
+        assert error < 1e-4, f'features differ by {error:.2e} (relative)'
+
+    cases = [
+        ('legacy, per snippet', lambda: [legacy_read_features(y) for y in signals]),
+        ('extractor, per snippet', lambda: [read_features(c) for c in contexts]),
+        ('extractor, read_features_batch', lambda: read_features_batch(contexts)),
+    ]
+    print(f'{args.snippets} snippets of {args.seconds:.0f}s')
+    print(f'{"front-end":<34}{"latency":>12}{"peak memory":>14}')
+    for name, function in cases:
+        latency, peak = measure(function, args.repeat)
+        print(f'{name:<34}{latency * 1000:>10.2f}ms{peak / 2 ** 20:>11.2f}MiB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Compares what the silence/clipping/noise gate costs with the full profiling
+pipeline it saves for rejected snippets.
+
+Each fixture is checked by the gate and profiled by get_audio_characteristics
+with the gate and result cache turned off, on a fresh context every time so
+no derived form is reused between runs.  For silence the full pipeline also
+shows what happened before the gate: the loudness meter returns -inf and the
+result is lost to an exception.
+
+    python -m benchmarks.bench_gate --seconds 6 --repeat 5
+"""
+import argparse
+import contextlib
+import io
+import time
+
+import numpy as np
+
+from audio_characteristics.context import AnalysisContext
+from audio_characteristics.gate import check
+from audio_characteristics.profile import get_audio_characteristics
+from audio_characteristics.tempo import preload_classifiers
+from benchmarks.fixtures import SAMPLE_RATE, click_track, noise, song
+
+
+def fixtures(seconds):
+    music = song(120, seconds)
+    return {
+        'silence': np.zeros((int(seconds * SAMPLE_RATE), 2), dtype=np.float32),
+        'static': noise(seconds),
+        'clicks': click_track(120, seconds),
+        'music': music,
+        'clipped music': np.clip(4 * music, -1., 1.),
+    }
+
+
+def median_time(function, samples, repeat):
+    timings = []
+    for _ in range(repeat):
+        context = AnalysisContext(samples, SAMPLE_RATE)
+        start = time.perf_counter()
+        result = function(context)
+        timings.append(time.perf_counter() - start)
+    return np.median(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=6.)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    preload_classifiers(('cnn',))
+    print(f'{"fixture":<15}{"status":>9}{"gate":>10}{"pipeline":>11}{"share":>8}  pipeline result')
+    for name, samples in fixtures(args.seconds).items():
+        gate_seconds, gate = median_time(check, samples, args.repeat)
+        # the pipeline prints its own exception messages, keep the table readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            pipeline_seconds, result = median_time(
+                lambda context: get_audio_characteristics(context, use_cache=False, gate=False),
+                samples, args.repeat)
+        print(f'{name:<15}{gate.status.value:>9}{gate_seconds * 1000:>8.2f}ms{pipeline_seconds * 1000:>9.1f}ms'
+              f'{gate_seconds / pipeline_seconds:>8.1%}  {result}')
+
+
+if __name__ == '__main__':
+    main()
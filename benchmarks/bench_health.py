@@ -0,0 +1,113 @@
+"""
+Runs bursts of captures over stations of which some are dead, with and
+without radio.health, and reports how long each burst takes, how many
+captures it gets, and how the dead stations' circuits open, are probed and
+close again.
+
+Besides healthy stand-in stations there are stations refusing connections,
+stations whose server accepts connections but never answers, so that every
+attempt waits out the read timeout, and one station that is down for the
+first few bursts and then comes back.
+
+    python -m benchmarks.bench_health --stations 40 --refused 10 --stalled 10 --bursts 8
+"""
+import argparse
+import logging
+import socket
+import time
+
+from benchmarks.fixtures import synthetic_mp3
+from benchmarks.servers import StreamStandIn
+from radio.health import StationHealth
+from radio.ingest import IngestEngine
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run(stations, bursts, interval, health, args, recover):
+    """
+    :param recover: callable run before the burst of that index, bringing the returning station up
+    :return: list of ``(seconds, captured, failed, skipped, health stats)`` per burst
+    """
+    engine = IngestEngine(seconds=args.seconds, max_concurrency=args.concurrency,
+                          connection_limit=args.concurrency, connect_timeout=2., read_timeout=args.read_timeout,
+                          health=health)
+    rows = []
+    for index in range(bursts):
+        recover(index)
+        start = time.perf_counter()
+        results, failures = engine.run(stations, lambda captures: [len(capture) for capture in captures])
+        elapsed = time.perf_counter() - start
+        skipped = len(stations) - len(results) - len(failures)
+        rows.append((elapsed, len(results), len(failures), skipped, health.stats() if health else None))
+        time.sleep(max(0., interval - elapsed))
+    engine.close()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--stations', type=int, default=40, help='healthy stations')
+    parser.add_argument('--refused', type=int, default=10, help='stations refusing connections')
+    parser.add_argument('--stalled', type=int, default=10, help='stations that never answer')
+    parser.add_argument('--bursts', type=int, default=8)
+    parser.add_argument('--returns-at', type=int, default=3, help='burst at which the returning station comes back')
+    parser.add_argument('--interval', type=float, default=10., help='seconds from one burst to the next')
+    parser.add_argument('--seconds', type=float, default=2.)
+    parser.add_argument('--read-timeout', type=float, default=5.)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--backoff', type=float, default=15., help='initial seconds a circuit stays open')
+    args = parser.parse_args()
+    # every failed capture and opened circuit is logged as a warning, the tables below sum them up
+    logging.basicConfig(level=logging.ERROR)
+
+    payload = synthetic_mp3(seconds=30.)
+    # a listening socket that never accepts: connections complete in the backlog and no response ever comes
+    stall = socket.socket()
+    stall.bind(('127.0.0.1', 0))
+    stall.listen(args.stalled * args.bursts * 2 + 16)
+    stall_port = stall.getsockname()[1]
+
+    print(f'{args.stations} healthy, {args.refused} refused, {args.stalled} stalled and 1 returning station, '
+          f'{args.concurrency} captures at a time, {args.seconds:g}s captures, {args.read_timeout:g}s read timeout')
+    with StreamStandIn(payload) as server:
+        stations = {f'station{i}': {'stream_url': server.url(f'station{i}'), 'audio_type': 'mp3'}
+                    for i in range(args.stations)}
+        stations.update({f'refused{i}': {'stream_url': f'http://127.0.0.1:{free_port()}/stream', 'audio_type': 'mp3'}
+                         for i in range(args.refused)})
+        stations.update({f'stalled{i}': {'stream_url': f'http://127.0.0.1:{stall_port}/stream', 'audio_type': 'mp3'}
+                         for i in range(args.stalled)})
+
+        for label, health in (('without health', None),
+                              ('with health', StationHealth(failure_threshold=2, initial_backoff=args.backoff))):
+            returning = StreamStandIn(payload, port=free_port())
+            stations['returning'] = {'stream_url': returning.url('returning'), 'audio_type': 'mp3'}
+
+            def recover(index):
+                if index == args.returns_at:
+                    returning.start()
+
+            rows = run(stations, args.bursts, args.interval, health, args, recover)
+            returning.stop()
+            print(f'\n{label}')
+            print(f'{"burst":>6}{"seconds":>9}{"captured":>10}{"failed":>8}{"skipped":>9}   circuits')
+            for index, (elapsed, captured, failed, skipped, stats) in enumerate(rows):
+                circuits = (f'{stats["healthy"]} healthy, {stats["probing"]} probing, {stats["open"]} open, '
+                            f'returning {stats["stations"]["returning"]["state"]}') if stats else ''
+                print(f'{index:>6}{elapsed:>9.1f}{captured:>10}{failed:>8}{skipped:>9}   {circuits}')
+            total = sum(row[0] for row in rows)
+            print(f'{total:.0f}s capturing, {sum(row[1] for row in rows)} captures, '
+                  f'{sum(row[2] for row in rows)} failed attempts')
+            if health is not None:
+                ttfb = [status['ttfb'] for status in health.stats()['stations'].values() if status['ttfb'] is not None]
+                print(f'time to first byte of the stations that answered: '
+                      f'mean {sum(ttfb) / len(ttfb) * 1000:.1f}ms, max {max(ttfb) * 1000:.1f}ms')
+    stall.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+Watches stand-in stations' ICY titles with radio.tracks for a simulated
+stretch of airtime and compares the analyses it runs, and the tracks they
+cover, with the fixed schedule of four snippets every six minutes.  Also
+measures how fast radio.icy strips the metadata out of a stream.
+
+Every station plays its own random mix of songs, short interludes and, on
+some, the station's name shown between songs, paced at ``--speed`` times
+real time.  One more station sends metadata blocks without titles and one
+sends no metadata at all.
+
+    python -m benchmarks.bench_icy --stations 4 --minutes 60 --speed 30
+"""
+import argparse
+import contextlib
+import io
+import logging
+import threading
+import time
+
+import numpy as np
+
+from benchmarks.fixtures import SAMPLE_RATE, encode, song
+from benchmarks.servers import StreamStandIn
+from radio.icy import IcyDemuxer
+from radio.tracks import TrackWatcher
+from radio.workers import analyze_captures
+
+BURST = (0, 20, 40, 60)
+CADENCE = 360
+METAINT = 16000
+
+
+def playlist(station, minutes, rng, station_ids):
+    """
+    :return: list of ``(title, seconds)`` covering at least ``minutes`` of airtime
+    """
+    tracks, total, index = [], 0., 0
+    while total < minutes * 60:
+        seconds = rng.uniform(30, 90) if rng.random() < .25 else rng.uniform(150, 300)
+        tracks.append((f'{station} artist {index} - track {index}', seconds))
+        index += 1
+        total += seconds
+        if station_ids:
+            tracks.append((f'{station} radio', 10.))
+            total += 10.
+    return tracks
+
+
+def played(tracks, minutes):
+    """
+    :return: list of ``(title, start, end)`` of the tracks aired in the first ``minutes``
+    """
+    aired, start = [], 0.
+    for title, seconds in tracks:
+        if start >= minutes * 60:
+            break
+        aired.append((title, start, start + seconds))
+        start += seconds
+    return aired
+
+
+def demux_throughput(megabytes=64, chunk_bytes=64 * 1024):
+    audio = np.random.default_rng(0).integers(0, 256, METAINT * 64, dtype=np.uint8).tobytes()
+    stream = bytearray()
+    for i in range(0, len(audio), METAINT):
+        stream += audio[i:i + METAINT] + StreamStandIn.metadata_block(f'title {i}' if i % (METAINT * 8) == 0 else None)
+    stream = bytes(stream)
+    chunks = [stream[i:i + chunk_bytes] for i in range(0, len(stream), chunk_bytes)]
+    repeats = max(1, int(megabytes * 2 ** 20 / len(stream)))
+    start = time.perf_counter()
+    for _ in range(repeats):
+        demuxer = IcyDemuxer(METAINT)
+        for chunk in chunks:
+            demuxer.feed(chunk)
+    elapsed = time.perf_counter() - start
+    return repeats * len(stream) / 2 ** 20 / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--stations', type=int, default=4, help='stations with titles')
+    parser.add_argument('--minutes', type=float, default=60., help='simulated airtime')
+    parser.add_argument('--speed', type=float, default=30., help='stream pacing, times real time')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    print(f'demuxing: {demux_throughput():.0f} MB/s of stream, audio passed on as views without copies')
+
+    rng = np.random.default_rng(0)
+    payload = encode(song(120, 30.), SAMPLE_RATE, 'mp3')
+    playlists = {f'station{i}': playlist(f'station{i}', args.minutes, rng, station_ids=i % 2 == 1)
+                 for i in range(args.stations)}
+    playlists['untitled'] = [(None, args.minutes * 60)]
+
+    # the watcher's captures are analyzed in this process, one batch at a time
+    analyses = []
+    analyzing = threading.Lock()
+
+    def analyze(captures):
+        with analyzing, contextlib.redirect_stdout(io.StringIO()):
+            return analyze_captures(captures)
+
+    def on_results(pairs):
+        analyses.extend((capture.station, capture.title, result) for capture, result in pairs)
+
+    watcher = TrackWatcher(fallback_seconds=CADENCE, report_every=3600.)
+    with contextlib.ExitStack() as stack:
+        servers = {station: stack.enter_context(StreamStandIn(payload, speed=args.speed, metaint=METAINT,
+                                                              tracks=tracks))
+                   for station, tracks in playlists.items()}
+        servers['no metadata'] = stack.enter_context(StreamStandIn(payload, speed=args.speed))
+        stations = {station: {'stream_url': server.url(station), 'audio_type': 'mp3'}
+                    for station, server in servers.items()}
+        stopper = threading.Timer(args.minutes * 60 / args.speed, watcher.stop)
+        stopper.start()
+        start = time.perf_counter()
+        watcher.run_forever(stations, analyze, on_results)
+        elapsed = time.perf_counter() - start
+    stats = watcher.stats()
+
+    hours = args.minutes / 60
+    watched = [station for station in stations if station not in stats['without_metadata']]
+    fixed = len(watched) * len(BURST) * 3600 / CADENCE * hours
+    print(f'{len(stations)} stations for {args.minutes:g} minutes of airtime at {args.speed:g}x in {elapsed:.0f}s; '
+          f'without metadata: {", ".join(stats["without_metadata"]) or "none"}')
+    print(f'{stats["analyses"]} analyses ({stats["title"]} on a new title, {stats["fallback"]} as fallback), '
+          f'{stats["title_changes"]} title changes, {stats["repeats"]} repeated titles skipped, '
+          f'{sum(result is not None for _, _, result in analyses)} profiled')
+    print(f'{stats["analyses"] / hours:.0f} analyses per hour where the fixed schedule runs {fixed / hours:.0f}: '
+          f'{(fixed - stats["analyses"]) / hours:.0f} saved per hour')
+
+    # which songs each approach profiles at least once; station names between songs don't count
+    analyzed_titles = {title for _, title, _ in analyses}
+    fixed_samples = [cycle + offset for cycle in range(0, int(args.minutes * 60), CADENCE) for offset in BURST]
+    songs = covered_fixed = covered_watched = short_missed_fixed = 0
+    for station in playlists:
+        for title, start, end in played(playlists[station], args.minutes):
+            if title is None or title.endswith(' radio') or end > args.minutes * 60:
+                continue
+            songs += 1
+            sampled = any(start <= sample and sample + 6 <= end for sample in fixed_samples)
+            covered_fixed += sampled
+            covered_watched += title in analyzed_titles
+            short_missed_fixed += not sampled and end - start < 90
+    print(f'{songs} complete tracks aired: {covered_watched / songs:.0%} analyzed on title changes, '
+          f'{covered_fixed / songs:.0%} by the fixed schedule, which missed {short_missed_fixed} short tracks')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Measures how the asyncio capture engine scales with the number of stations.
+
+Every station is served by a local stand-in server that paces a fixture
+stream at its bitrate like Icecast does.  Analysis is replaced by a stub that
+takes a fixed time per capture, so the numbers show capture throughput and how
+much of the analysis overlaps with capturing.
+
+    python -m benchmarks.bench_ingest --stations 10 50 100 200 --seconds 6 --analysis-ms 20
+"""
+import argparse
+import time
+
+from benchmarks.fixtures import synthetic_mp3
+from benchmarks.servers import StreamStandIn
+from radio.ingest import IngestEngine
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--stations', type=int, nargs='+', default=[10, 50, 100, 200])
+    parser.add_argument('--seconds', type=float, default=6.)
+    parser.add_argument('--speed', type=float, default=1., help='stream pacing, 1 is real time')
+    parser.add_argument('--analysis-ms', type=float, default=20., help='stub analysis time per capture')
+    parser.add_argument('--concurrency', type=int, default=500)
+    args = parser.parse_args()
+
+    def analyze(captures):
+        time.sleep(args.analysis_ms / 1000 * len(captures))
+        return [len(capture) for capture in captures]
+
+    payload = synthetic_mp3(seconds=30.)
+    print(f'{args.seconds:.0f}s captures paced at {args.speed:g}x real time, '
+          f'{args.analysis_ms:g}ms stub analysis per capture')
+    print(f'{"stations":>9}{"burst":>10}{"captures/s":>12}{"MiB/s":>8}{"failed":>8}')
+    with StreamStandIn(payload, speed=args.speed) as server:
+        for count in args.stations:
+            stations = {f'station{i}': {'stream_url': server.url(f'station{i}'), 'audio_type': 'mp3'}
+                        for i in range(count)}
+            engine = IngestEngine(seconds=args.seconds, max_concurrency=args.concurrency,
+                                  connection_limit=args.concurrency)
+            start = time.perf_counter()
+            results, failures = engine.run(stations, analyze)
+            elapsed = time.perf_counter() - start
+            engine.close()
+            captured_bytes = sum(len(capture) for capture, _ in results)
+            print(f'{count:>9}{elapsed:>9.2f}s{len(results) / elapsed:>12.1f}'
+                  f'{captured_bytes / elapsed / 2 ** 20:>8.2f}{len(failures):>8}')
+
+
+if __name__ == '__main__':
+    main()
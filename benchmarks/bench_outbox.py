@@ -0,0 +1,94 @@
+"""
+Measures the disk-backed outbox: what appending costs the analysis path under
+each fsync policy, and how fast a backlog built up during an outage of the
+websocket server is replayed once it is back.
+
+Appending only puts the record on a list, so the caller is blocked for the
+same time whatever the policy; the policy changes how long it takes until the
+records are on disk.
+
+    python -m benchmarks.bench_outbox --records 20000 --stations 400
+"""
+import argparse
+import json
+import logging
+import tempfile
+import time
+
+from benchmarks.servers import WebSocketStandIn
+from radio.outbox import FSYNC_POLICIES, Outbox
+from radio.publisher import WebSocketPublisher
+
+
+def audio_values(i, stations):
+    return {'station': f'station{i % stations}', 'tempo': 120, 'loudness': -14, 'pitch': 2000, 'seq': i}
+
+
+def wait_until(condition, timeout=60.):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError('outbox did not catch up')
+        time.sleep(.005)
+
+
+def append_benchmark(records, stations, fsync):
+    with tempfile.TemporaryDirectory() as directory:
+        outbox = Outbox(directory, fsync=fsync).start()
+        start = time.perf_counter()
+        for i in range(records):
+            outbox.append(audio_values(i, stations))
+        blocked = time.perf_counter() - start
+        wait_until(lambda: outbox.stats()['written'] == records)
+        written = time.perf_counter() - start
+        outbox.stop()
+        stats = outbox.stats()
+    print(f'{fsync:<10}{blocked / records * 1e6:>14.2f}us{records / blocked:>14.0f}{written * 1000:>14.1f}ms'
+          f'{stats["fsyncs"]:>8}{stats["bytes"] / 2 ** 20:>9.1f}')
+
+
+def replay_benchmark(records, stations, batched):
+    # find a free port, then keep the server down while the backlog builds up
+    with WebSocketStandIn() as probe:
+        port = probe.port
+    url = f'ws://127.0.0.1:{port}'
+    with tempfile.TemporaryDirectory() as directory, \
+            WebSocketPublisher(url, initial_backoff=.05, max_backoff=.2) as publisher, \
+            Outbox(directory, publisher, batched=batched) as outbox:
+        for i in range(records):
+            outbox.append(audio_values(i, stations))
+        wait_until(lambda: outbox.stats()['written'] == records)
+        with WebSocketStandIn(port=port) as server:
+            start = time.perf_counter()
+            wait_until(lambda: outbox.stats()['backlog'] == 0)
+            elapsed = time.perf_counter() - start
+            key = 'audio_values_batch' if batched else 'audio_values'
+            delivered = []
+            for message in server.messages:
+                values = json.loads(message)[key]
+                delivered.extend(values if batched else [values])
+        in_order = [values['seq'] for values in delivered] == list(range(records))
+        print(f'{"batched" if batched else "per record":<12}{elapsed:>10.2f}s{records / elapsed:>12.0f}'
+              f'{len(server.messages):>10}{"yes" if in_order else "NO":>10}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--stations', type=int, default=400)
+    args = parser.parse_args()
+    # the publisher logs every failed reconnect while the server is down
+    logging.basicConfig(level=logging.ERROR)
+    logging.getLogger('websocket').setLevel(logging.CRITICAL)
+
+    print(f'{"fsync":<10}{"append":>16}{"appends/s":>14}{"on disk":>16}{"fsyncs":>8}{"MiB":>9}')
+    for fsync in FSYNC_POLICIES:
+        append_benchmark(args.records, args.stations, fsync)
+
+    print(f'\n{"replay":<12}{"drained in":>11}{"records/s":>12}{"messages":>10}{"in order":>10}')
+    for batched in (True, False):
+        replay_benchmark(args.records, args.stations, batched)
+
+
+if __name__ == '__main__':
+    main()
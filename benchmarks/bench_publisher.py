@@ -0,0 +1,80 @@
+"""
+Compares the persistent WebSocket publisher with a connection per message.
+
+The old send_via_ws opened a connection, sent one result, waited for the
+server's reply and closed the connection again, all on the analysis thread.
+The publisher keeps one connection open and sends from a background thread,
+so the caller only pays for putting the result on a queue.
+
+    python -m benchmarks.bench_publisher --messages 200 --reply-delay 0.005
+"""
+import argparse
+import json
+import time
+
+import websocket
+
+from benchmarks.servers import WebSocketStandIn
+from radio.publisher import WebSocketPublisher
+
+
+def audio_values(i):
+    return {'station': f'station{i % 40}', 'tempo': 120, 'loudness': -14, 'pitch': 2000}
+
+
+def connection_per_message(url, messages):
+    for i in range(messages):
+        ws = websocket.WebSocket()
+        ws.connect(url)
+        ws.send(json.dumps({'audio_values': audio_values(i)}).encode('utf-8'))
+        ws.recv()
+        ws.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--reply-delay', type=float, default=0.)
+    parser.add_argument('--burst', type=int, default=40, help='results per batched message')
+    args = parser.parse_args()
+
+    print(f'{"path":<26}{"caller blocked":>16}{"delivered in":>14}{"connections":>13}')
+
+    with WebSocketStandIn(reply_delay=args.reply_delay) as server:
+        start = time.perf_counter()
+        connection_per_message(server.url, args.messages)
+        elapsed = time.perf_counter() - start
+        print(f'{"connection per message":<26}{elapsed * 1000:>14.1f}ms{elapsed * 1000:>12.1f}ms'
+              f'{server.connections:>13}')
+
+    with WebSocketStandIn(reply_delay=args.reply_delay) as server:
+        with WebSocketPublisher(server.url) as publisher:
+            start = time.perf_counter()
+            for i in range(args.messages):
+                publisher.publish(audio_values(i))
+            blocked = time.perf_counter() - start
+            server.wait_for(args.messages)
+            delivered = time.perf_counter() - start
+            stats = publisher.stats()
+        print(f'{"persistent publisher":<26}{blocked * 1000:>14.1f}ms{delivered * 1000:>12.1f}ms'
+              f'{server.connections:>13}')
+
+    with WebSocketStandIn(reply_delay=args.reply_delay) as server:
+        with WebSocketPublisher(server.url) as publisher:
+            batches = [[audio_values(i) for i in range(start, min(start + args.burst, args.messages))]
+                       for start in range(0, args.messages, args.burst)]
+            start = time.perf_counter()
+            for batch in batches:
+                publisher.publish_batch(batch)
+            blocked = time.perf_counter() - start
+            server.wait_for(len(batches))
+            delivered = time.perf_counter() - start
+        print(f'{"batched publisher":<26}{blocked * 1000:>14.1f}ms{delivered * 1000:>12.1f}ms'
+              f'{server.connections:>13}')
+
+    print(f'publisher send latency p50 {stats["latency_p50"] * 1000:.2f}ms, '
+          f'p99 {stats["latency_p99"] * 1000:.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
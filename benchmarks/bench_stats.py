@@ -0,0 +1,131 @@
+"""
+Feeds simulated results to radio.stats and reports the cost of an update,
+memory per station, how far its percentiles are from exact ones over the
+same window, how well it flags injected outliers, and the checkpoint's size.
+
+Every station plays songs whose tempo, loudness and pitch scatter around its
+own typical values, in bursts of four snippets every six minutes, with a
+share of glitched snippets (e.g. a jingle or dead air) mixed in.
+
+    python -m benchmarks.bench_stats --stations 50 --days 14
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from radio.stats import METRICS, StationStatistics
+
+BURST = (0, 20, 40, 60)
+CADENCE = 360
+
+
+def simulate(stations, days, outlier_share, seed=0):
+    """
+    :return: list of ``(time, station, values, is_outlier)`` in time order
+    """
+    rng = np.random.default_rng(seed)
+    typical = {f'station{i}': (rng.uniform(90, 140), rng.uniform(-20, -10), rng.uniform(1500, 3500))
+               for i in range(stations)}
+    results = []
+    for cycle in range(int(days * 86400 / CADENCE)):
+        for station, (tempo, loudness, pitch) in typical.items():
+            song = (rng.normal(tempo, 12), rng.normal(loudness, 2), rng.normal(pitch, 300))
+            for offset in BURST:
+                glitch = rng.random() < outlier_share
+                if glitch:
+                    values = (rng.choice((60, 250)), -45., 8000.)
+                else:
+                    values = (song[0] + rng.normal(0, 1), song[1] + rng.normal(0, .5), song[2] + rng.normal(0, 50))
+                results.append((cycle * CADENCE + offset, station,
+                                dict(zip(METRICS, (int(round(v)) for v in values))), glitch))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--stations', type=int, default=50)
+    parser.add_argument('--days', type=float, default=14.)
+    parser.add_argument('--window-days', type=float, default=7.)
+    parser.add_argument('--outliers', type=float, default=.02, help='share of glitched snippets')
+    args = parser.parse_args()
+
+    results = simulate(args.stations, args.days, args.outliers)
+    statistics = StationStatistics(window_seconds=args.window_days * 86400, burst_gap=60.)
+    observed = []
+    start = time.perf_counter()
+    for now, station, values, _ in results:
+        observed.append(statistics.observe(station, values, now))
+    elapsed = time.perf_counter() - start
+    print(f'{len(results)} results of {args.stations} stations over {args.days:g} days: '
+          f'{elapsed / len(results) * 1e6:.0f}us per result')
+
+    history = statistics._stations['station0']
+    nbytes = sum(h.counts.nbytes + h.moments.nbytes + h.bucket_ids.nbytes + h.total.nbytes for h in history.values())
+    print(f'memory per station {nbytes / 1024:.1f} KiB, whatever the length of history')
+
+    # exact percentiles of the last results against each station's window, which slides by whole buckets
+    end = results[-1][0]
+    window_start = (int(end // statistics.bucket_seconds) - statistics.buckets + 1) * statistics.bucket_seconds
+    errors = {metric: [] for metric in METRICS}
+    last = {}
+    for (now, station, values, _), result in zip(results, observed):
+        last[station] = (now, values, result)
+    by_station = {}
+    for t, station, values, _ in results:
+        by_station.setdefault(station, []).append((t, values))
+    for station, (now, values, result) in last.items():
+        window = [v for t, v in by_station[station] if window_start <= t < now]
+        for metric in METRICS:
+            exact = np.mean([v[metric] < values[metric] for v in window]) + .5 * np.mean(
+                [v[metric] == values[metric] for v in window])
+            errors[metric].append(abs(result['percentiles'][metric] - exact))
+    print('percentile error against exact, mean/max: ' + ', '.join(
+        f'{metric} {np.mean(e):.3f}/{np.max(e):.3f}' for metric, e in errors.items()))
+
+    warm = [(glitch, result) for (now, _, _, glitch), result in zip(results, observed) if now > 86400]
+    flagged = np.array([any(result['outliers'].values()) for _, result in warm])
+    glitches = np.array([glitch for glitch, _ in warm])
+    print(f'outliers: {flagged[glitches].mean():.1%} of glitches flagged, '
+          f'{flagged[~glitches].mean():.2%} of normal snippets flagged')
+
+    # a glitch pulls a burst's mean off, the consolidated value shouldn't follow it
+    bursts, glitched = {}, []
+    for (_, station, values, glitch), result in zip(results, observed):
+        if result['consolidated']['snippets'] == 1:
+            bursts[station] = []
+        bursts[station].append((values, glitch))
+        if len(bursts[station]) == len(BURST) and any(g for _, g in bursts[station]):
+            clean = [v['tempo'] for v, g in bursts[station] if not g]
+            if clean:
+                glitched.append((result['consolidated']['tempo'], np.mean([v['tempo'] for v, _ in bursts[station]]),
+                                 np.median(clean)))
+    if glitched:
+        consolidated, mean, clean = np.array(glitched).T
+        print(f'{len(glitched)} bursts with a glitch: tempo off the clean median by '
+              f'{np.mean(np.abs(consolidated - clean)):.1f} BPM consolidated, {np.mean(np.abs(mean - clean)):.1f} BPM averaged')
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'stats.npz')
+        start = time.perf_counter()
+        statistics.checkpoint(path)
+        written = time.perf_counter() - start
+        restored = StationStatistics(window_seconds=args.window_days * 86400, burst_gap=60.)
+        start = time.perf_counter()
+        restored.restore(path)
+        read = time.perf_counter() - start
+        same = all(restored.summary(station, end) == statistics.summary(station, end) for station in last)
+        print(f'checkpoint {os.path.getsize(path) / 1024:.0f} KiB, written in {written * 1000:.0f}ms, '
+              f'restored in {read * 1000:.0f}ms, identical summaries: {same}')
+        # a daemon stopped before its first result checkpoints no stations
+        empty = StationStatistics(window_seconds=args.window_days * 86400)
+        empty.checkpoint(path)
+        restored = StationStatistics(window_seconds=args.window_days * 86400)
+        print(f'empty checkpoint restored: {restored.restore(path) and not restored.stations}')
+    print(f'station0: {statistics.summary("station0", end)}')
+
+
+if __name__ == '__main__':
+    main()
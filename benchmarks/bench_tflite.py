@@ -0,0 +1,126 @@
+"""
+Compares the Keras and TFLite tempo backends.
+
+Every backend runs in a fresh interpreter so that startup time (imports plus
+model load) and resident memory are measured the way a new worker process
+would see them.  The TFLite artifacts are converted up front, so conversion is
+not counted as startup.  Accuracy is reported against the Keras distributions
+and against the known tempo of synthetic click tracks.
+
+    python -m benchmarks.bench_tflite --model cnn --threads 1 --repeat 20
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+CONFIGURATIONS = (
+    ('keras', None),
+    ('tflite', None),
+    ('tflite', 'float16'),
+    ('tflite', 'int8'),
+    ('tflite', 'int8-full'),
+)
+
+BPMS = (80, 100, 120, 140, 160)
+
+
+def fixture_features():
+    from audio_characteristics.context import AnalysisContext
+    from audio_characteristics.tempo import read_features_batch
+    from benchmarks.fixtures import SAMPLE_RATE, click_track
+    contexts = [AnalysisContext(click_track(bpm, seconds=12.), SAMPLE_RATE) for bpm in BPMS]
+    return read_features_batch(contexts)
+
+
+def child(args):
+    start = time.perf_counter()
+    from audio_characteristics.tempo import TempoClassifier
+    classifier = TempoClassifier(args.model, backend=args.backend, quantization=args.quantization,
+                                 num_threads=args.threads)
+    startup = time.perf_counter() - start
+
+    import psutil
+    features = fixture_features()
+    classifier.estimate_batch(features)  # warm up
+    timings = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        predictions = classifier.estimate_batch(features)
+        timings.append(time.perf_counter() - start)
+
+    np.savez(args.output, *predictions)
+    print(json.dumps({
+        'startup_seconds': startup,
+        'latency_seconds': float(np.median(timings)),
+        'rss_bytes': psutil.Process().memory_info().rss,
+        'tempi': [float(classifier.to_bpm(np.argmax(np.average(p, axis=0)))) for p in predictions],
+    }))
+
+
+def prepare_artifacts(model_name):
+    from audio_characteristics.tempo import _extract_from_package, _to_model_resource, max_normalizer
+    from audio_characteristics.tflite import convert, ensure_tflite_model, tflite_model_path
+
+    h5_file = _extract_from_package(_to_model_resource(model_name))
+    ensure_tflite_model(h5_file)
+    ensure_tflite_model(h5_file, 'float16')
+    ensure_tflite_model(h5_file, 'int8')
+    if not tflite_model_path(h5_file, 'int8-full').exists():
+        # calibrate activations on the same normalized features the classifier will see
+        representative = np.concatenate([max_normalizer(data) for data in fixture_features()])
+        convert(h5_file, 'int8-full', representative_data=representative)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--model', default='cnn')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--child', nargs=2, metavar=('BACKEND', 'QUANTIZATION'), help=argparse.SUPPRESS)
+    parser.add_argument('--output', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        args.backend = args.child[0]
+        args.quantization = None if args.child[1] == 'none' else args.child[1]
+        child(args)
+        return
+
+    prepare_artifacts(args.model)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for backend, quantization in CONFIGURATIONS:
+            output = os.path.join(directory, f'{backend}-{quantization}.npz')
+            command = [sys.executable, '-m', 'benchmarks.bench_tflite', '--model', args.model,
+                       '--repeat', str(args.repeat), '--output', output,
+                       '--child', backend, quantization or 'none']
+            if args.threads:
+                command += ['--threads', str(args.threads)]
+            stdout = subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout
+            stats = json.loads(stdout.decode().strip().splitlines()[-1])
+            with np.load(output) as predictions:
+                stats['predictions'] = [predictions[name] for name in predictions.files]
+            results[(backend, quantization)] = stats
+
+    reference = results[('keras', None)]
+    print(f'{len(BPMS)} click tracks at {", ".join(map(str, BPMS))} BPM')
+    print(f'{"backend":<18}{"startup":>10}{"latency":>11}{"RSS":>10}{"max |dp|":>10}'
+          f'{"= keras":>9}{"= truth":>9}')
+    for (backend, quantization), stats in results.items():
+        difference = max(np.max(np.abs(p - r)) for p, r in zip(stats['predictions'], reference['predictions']))
+        agree = np.mean([a == b for a, b in zip(stats['tempi'], reference['tempi'])])
+        correct = np.mean([abs(tempo - bpm) <= 2 for tempo, bpm in zip(stats['tempi'], BPMS)])
+        name = backend + (f'-{quantization}' if quantization else '')
+        print(f'{name:<18}{stats["startup_seconds"]:>9.2f}s{stats["latency_seconds"] * 1000:>9.1f}ms'
+              f'{stats["rss_bytes"] / 2 ** 20:>7.0f}MiB{difference:>10.4f}{agree:>9.0%}{correct:>9.0%}')
+
+
+if __name__ == '__main__':
+    main()
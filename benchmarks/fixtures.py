@@ -0,0 +1,113 @@
+"""
+Deterministic audio fixtures for the benchmarks.
+
+Everything is synthesised from a fixed seed, so runs are comparable between
+machines and commits.  Encoded fixtures need ffmpeg on the PATH.
+"""
+import subprocess
+
+import numpy as np
+
+from audio_characteristics.decode import FFMPEG
+
+SAMPLE_RATE = 44100
+
+
+def tone(seconds=6., sr=SAMPLE_RATE, frequency=440., amplitude=0.25, channels=2, seed=0, noise_amplitude=0.01):
+    """
+    A sine tone with a little noise, shaped ``(samples, channels)``.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sr)) / sr
+    y = amplitude * np.sin(2 * np.pi * frequency * t) + noise_amplitude * rng.standard_normal(len(t))
+    return np.repeat(y[:, np.newaxis], channels, axis=1).astype(np.float32)
+
+
+def encode(samples, sr, audio_type, bitrate='128k'):
+    """
+    Encodes float PCM to mp3 or ADTS aac bytes, the way a station would stream it.
+
+    :param samples: float PCM shaped ``(samples, channels)``
+    :param sr: sample rate
+    :param audio_type: ``'mp3'`` or ``'aac'``
+    :return: encoded bytes
+    """
+    channels = 1 if samples.ndim == 1 else samples.shape[1]
+    output_format = 'adts' if audio_type == 'aac' else 'mp3'
+    process = subprocess.run(
+        [FFMPEG, '-hide_banner', '-loglevel', 'error', '-f', 'f32le', '-ar', str(sr),
+         '-ac', str(channels), '-i', 'pipe:0', '-b:a', bitrate, '-f', output_format, 'pipe:1'],
+        input=np.ascontiguousarray(samples, dtype='<f4').tobytes(),
+        stdout=subprocess.PIPE, check=True)
+    return process.stdout
+
+
+def click_track(bpm, seconds=6., sr=SAMPLE_RATE, amplitude=0.5, channels=2, seed=0):
+    """
+    Short decaying noise bursts on every beat at ``bpm``, shaped ``(samples, channels)``.
+    """
+    rng = np.random.default_rng(seed)
+    y = np.zeros(int(seconds * sr), dtype=np.float32)
+    click_length = int(0.03 * sr)
+    click = amplitude * rng.standard_normal(click_length) * np.exp(-np.linspace(0., 8., click_length))
+    for onset in np.arange(0., seconds, 60. / bpm):
+        start = int(onset * sr)
+        end = min(start + click_length, len(y))
+        y[start:end] += click[:end - start]
+    return np.repeat(y[:, np.newaxis], channels, axis=1)
+
+
+def song(bpm, seconds=6., sr=SAMPLE_RATE, root=0, channels=2, seed=0):
+    """
+    A click track over a four-chord progression that changes chord every bar,
+    shaped ``(samples, channels)``.
+
+    :param root: semitones above A2 of the first chord
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sr)) / sr
+    y = 0.6 * click_track(bpm, seconds, sr, channels=1, seed=seed)[:, 0]
+    bar = 4 * 60. / bpm
+    for i, start in enumerate(np.arange(0., seconds, bar)):
+        a, b = int(start * sr), min(int((start + bar) * sr), len(t))
+        frequency = 110. * 2 ** ((root + (0, 5, 7, 3)[i % 4]) / 12)
+        for interval in (0, 4, 7, 12):
+            y[a:b] += 0.08 * np.sin(2 * np.pi * frequency * 2 ** (interval / 12) * t[a:b])
+    y += 0.005 * rng.standard_normal(len(y))
+    return np.repeat(y[:, np.newaxis], channels, axis=1).astype(np.float32)
+
+
+def tone_at_loudness(lufs, seconds=6., sr=SAMPLE_RATE):
+    """
+    A stereo 997 Hz sine that measures ``lufs`` under BS.1770: a full-scale
+    sine on both channels reads 0 LUFS.
+    """
+    return tone(seconds, sr, frequency=997., amplitude=10 ** (lufs / 20), channels=2, noise_amplitude=0.)
+
+
+def noise(seconds=6., sr=SAMPLE_RATE, amplitude=0.1, channels=2, seed=0):
+    """
+    White noise, like a station sending static, shaped ``(samples, channels)``.
+    """
+    rng = np.random.default_rng(seed)
+    return (amplitude * rng.standard_normal((int(seconds * sr), channels))).astype(np.float32)
+
+
+def synthetic_mp3(seconds=6., bitrate=128000, sr=SAMPLE_RATE, seed=0):
+    """
+    MPEG-1 layer III frames with valid headers and random payloads.
+
+    Not decodable audio, but enough for anything that only walks frames, like
+    the capture code, and needs no encoder.
+    """
+    rng = np.random.default_rng(seed)
+    bitrate_index = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320).index(bitrate // 1000)
+    sample_rate_index = (44100, 48000, 32000).index(sr)
+    frames = []
+    for i in range(int(np.ceil(seconds * sr / 1152))):
+        # pad every other frame, close to the nominal bitrate at 44.1 kHz
+        padding = i % 2
+        length = 144 * bitrate // sr + padding
+        header = bytes((0xFF, 0xFB, (bitrate_index << 4) | (sample_rate_index << 2) | (padding << 1), 0x44))
+        frames.append(header + rng.integers(0, 255, length - 4, dtype=np.uint8).tobytes())
+    return b''.join(frames)
@@ -0,0 +1,222 @@
+"""
+Local stand-ins for the services the daemon talks to, for benchmarks and
+manual testing without touching real stations or the deployed server.
+"""
+import asyncio
+import threading
+
+import websockets
+from aiohttp import web
+
+
+class WebSocketStandIn:
+    """
+    WebSocket server on localhost that records every message it receives and,
+    like the deployed server, acknowledges each one.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, reply_delay=0.):
+        """
+        :param port: port to listen on, any free one by default
+        :param reply_delay: seconds to wait before acknowledging a message
+        """
+        self.host = host
+        self.port = port
+        self.reply_delay = reply_delay
+        self.messages = []
+        self.connections = 0
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._received = threading.Condition()
+
+    @property
+    def url(self):
+        return f'ws://{self.host}:{self.port}'
+
+    async def _handle(self, websocket, *args):
+        self.connections += 1
+        try:
+            async for message in websocket:
+                with self._received:
+                    self.messages.append(message)
+                    self._received.notify_all()
+                if self.reply_delay:
+                    await asyncio.sleep(self.reply_delay)
+                await websocket.send('ok')
+        except websockets.ConnectionClosed:
+            pass
+
+    def start(self):
+        started = threading.Event()
+
+        async def serve():
+            self._server = await websockets.serve(self._handle, self.host, self.port)
+            self.port = self._server.sockets[0].getsockname()[1]
+            started.set()
+            await self._server.wait_closed()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(serve())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name='websocket-stand-in', daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._server.close)
+        self._thread.join()
+
+    def wait_for(self, count, timeout=30.):
+        """
+        Blocks until ``count`` messages have been received.
+
+        :return: ``True`` if they arrived within ``timeout``
+        """
+        with self._received:
+            return self._received.wait_for(lambda: len(self.messages) >= count, timeout)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class StreamStandIn:
+    """
+    HTTP server on localhost that serves fixture streams the way Icecast does:
+    a burst of data on connect, then the rest paced at the stream's bitrate.
+
+    Every path serves the same payload, looped, so one server can stand in
+    for any number of stations (``/station0``, ``/station1``, ...).
+
+    Given ``metaint``, a client that asks for ``Icy-MetaData`` gets a
+    metadata block after every ``metaint`` bytes of audio, holding the
+    ``StreamTitle`` of the track playing when it changed and empty otherwise,
+    with the tracks following each other by stream time.
+    """
+
+    def __init__(self, payload, bitrate=128000, speed=1., burst_bytes=64 * 1024, chunk_bytes=4096,
+                 content_type='audio/mpeg', host='127.0.0.1', port=0, metaint=None, tracks=None):
+        """
+        :param payload: encoded stream bytes, e.g. from :func:`benchmarks.fixtures.encode`
+        :param bitrate: bits per second the payload is paced at
+        :param speed: pacing multiplier; ``0`` sends as fast as possible
+        :param burst_bytes: bytes sent immediately on connect
+        :param metaint: audio bytes between ICY metadata blocks; no metadata by default
+        :param tracks: list of ``(title, seconds)`` played in a loop, ``None`` titles for empty metadata
+        """
+        self.payload = payload
+        self.bitrate = bitrate
+        self.speed = speed
+        self.burst_bytes = burst_bytes
+        self.chunk_bytes = chunk_bytes
+        self.content_type = content_type
+        self.host = host
+        self.port = port
+        self.metaint = metaint
+        self.tracks = tracks or [(None, 3600.)]
+        self.connections = 0
+        self._loop = None
+        self._runner = None
+        self._thread = None
+
+    def url(self, path='stream'):
+        return f'http://{self.host}:{self.port}/{path}'
+
+    def title_at(self, seconds):
+        """
+        Title of the track playing ``seconds`` into a stream.
+        """
+        seconds %= sum(length for _, length in self.tracks)
+        for title, length in self.tracks:
+            if seconds < length:
+                return title
+            seconds -= length
+
+    @staticmethod
+    def metadata_block(title):
+        """
+        An ICY metadata block announcing ``title``, with its length byte; a single zero byte for ``None``.
+        """
+        if title is None:
+            return b'\0'
+        text = f"StreamTitle='{title}';".encode('utf-8')
+        text += b'\0' * (-len(text) % 16)
+        return bytes([len(text) // 16]) + text
+
+    async def _handle(self, request):
+        self.connections += 1
+        icy = self.metaint is not None and request.headers.get('Icy-MetaData') == '1'
+        headers = {'Content-Type': self.content_type}
+        if icy:
+            headers.update({'icy-metaint': str(self.metaint), 'icy-br': str(self.bitrate // 1000)})
+        response = web.StreamResponse(headers=headers)
+        await response.prepare(request)
+        payload = memoryview(self.payload)
+        position, sent, start = 0, 0, self._loop.time()
+        until_metadata, announced = self.metaint, None
+        try:
+            while True:
+                size = self.burst_bytes if sent == 0 else self.chunk_bytes
+                chunk = payload[position:position + size]
+                position = (position + len(chunk)) % len(payload)
+                if not icy:
+                    await response.write(chunk.tobytes())
+                    sent += len(chunk)
+                while icy and len(chunk):
+                    piece, chunk = chunk[:until_metadata], chunk[until_metadata:]
+                    await response.write(piece.tobytes())
+                    sent += len(piece)
+                    until_metadata -= len(piece)
+                    if until_metadata == 0:
+                        title = self.title_at(sent * 8 / self.bitrate)
+                        await response.write(self.metadata_block(title if title != announced else None))
+                        announced, until_metadata = title, self.metaint
+                if self.speed:
+                    due = start + (sent - self.burst_bytes) * 8 / self.bitrate / self.speed
+                    delay = due - self._loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        return response
+
+    def start(self):
+        started = threading.Event()
+
+        async def serve():
+            app = web.Application()
+            app.router.add_get('/{station}', self._handle)
+            self._runner = web.AppRunner(app)
+            await self._runner.setup()
+            site = web.TCPSite(self._runner, self.host, self.port)
+            await site.start()
+            self.port = self._runner.addresses[0][1]
+            started.set()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(serve())
+            self._loop.run_forever()
+            self._loop.run_until_complete(self._runner.cleanup())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name='stream-stand-in', daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -1,181 +1,287 @@
-import schedule
-import time
-from multiprocessing import Process
-import requests
+import logging
 import os
-from pydub import AudioSegment
-import websocket
-import json
-from glob import glob
+import threading
+import time
 
 from dotenv import load_dotenv
 load_dotenv()
 
-from audio_characteristics.profile import get_audio_characteristics
-
-stations = {
-    'DDR': { 'stream_url': 'https://dublindigitalradio.out.airtime.pro/dublindigitalradio_a',
-            'audio_type': 'mp3'},
-    'KUTX': { 'stream_url': 'https://kut.streamguys1.com/kutx-web',
-            'audio_type': 'mp3'},
-    'KOOP': { 'stream_url': 'https://streaming.koop.org/stream.aac',
-            'audio_type': 'aac'},
-    'WPRB': { 'stream_url': 'https://wprb.streamguys1.com/live',
-            'audio_type': 'mp3'},
-    'BFF': { 'stream_url': 'https://stream.bff.fm/1/mp3.mp3',
-            'audio_type': 'mp3'}
-}
-
-def stream_to_audio_file(station_url, file_name):
-    """
-    Takes in a streaming url as input and writes the data coming from that stream to either an mp3 or aac file, which can the be converted to a wav file.  It does so with the help of the iter library to read it in in chunks. This method gets cut off once the time.sleep() method within analyze_audio concludes and is currently set to 5 seconds.  Therefore, roughly 5 second audio snippets will be extracted from a radio station then analyzed.
-
-    Notes:
-    - stream=True inside of requests.get() allows for the radio streams to properly be read in.
-    """
-
-    if (file_name[-3:] == "mp3"):
-        with requests.get(station_url, stream=True) as r:
-            with open(f'{file_name}', 'wb') as f:
-                try:
-                    for block in r.iter_content(1024):
-                        f.write(block)
-                except KeyboardInterrupt:
-                    f.close()
-    elif (file_name[-3:] == "aac"):
-        with requests.get(station_url, stream=True) as r:
-            with open(f'{file_name}', 'wb') as f:
-                try:
-                    for block in r.iter_content(1024):
-                        f.write(block)
-                except KeyboardInterrupt:
-                    f.close()
-
-def audio_file_to_wav(file):
-    """
-    Turns an audio file of mp3 or aac format into a wav file, which is the file format necessary for later processing.
-    """
-    
-    src = file
-    dst = f'{file[:-4]}.wav'
+from radio import metrics
+from radio.health import StationHealth
+from radio.ingest import IngestEngine
+from radio.outbox import Outbox
+from radio.publisher import WebSocketPublisher
+from radio.scheduler import Scheduler, load_station_config
+from radio.stats import StationStatistics
+from radio.tracks import TrackWatcher
+from radio.workers import AnalysisPool
+
+# stream URLs, audio types and the cadence/burst pattern each station is analyzed on
+STATIONS_CONFIG = os.getenv('STATIONS_CONFIG', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stations.json'))
+stations = load_station_config(STATIONS_CONFIG)
+
+# seconds of complete frames captured from each station per analysis
+CAPTURE_SECONDS = 6
+
+# streams read at the same time; stations beyond this wait for a free slot
+CAPTURE_CONCURRENCY = int(os.getenv('CAPTURE_CONCURRENCY', '100'))
+
+# analysis worker processes (one per core by default) and the jobs each handles before it is replaced
+ANALYSIS_WORKERS = int(os.getenv('ANALYSIS_WORKERS', '0')) or None
+ANALYSIS_JOBS_PER_WORKER = int(os.getenv('ANALYSIS_JOBS_PER_WORKER', '200'))
+
+# send each run's results as one batched message instead of one message per station
+PUBLISH_BATCHED = os.getenv('PUBLISH_BATCHED', '').lower() in ('1', 'true', 'yes')
+
+# results are journaled here before they are sent, so they survive an outage of the websocket server
+OUTBOX_DIR = os.getenv('OUTBOX_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'outbox'))
+# when the journal is fsynced: 'batch', 'interval' (at most once a second) or 'none'
+OUTBOX_FSYNC = os.getenv('OUTBOX_FSYNC', 'interval')
+
+# every station's results are ranked against its history over this many days; the history is
+# checkpointed to STATS_CHECKPOINT every STATS_CHECKPOINT_SECONDS and on shutdown
+STATS_WINDOW_DAYS = float(os.getenv('STATS_WINDOW_DAYS', '7'))
+STATS_CHECKPOINT = os.getenv('STATS_CHECKPOINT', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stats.npz'))
+STATS_CHECKPOINT_SECONDS = float(os.getenv('STATS_CHECKPOINT_SECONDS', '300'))
+
+# analyses of different stations allowed to run at the same time
+SCHEDULER_WORKERS = int(os.getenv('SCHEDULER_WORKERS', '8'))
+
+# 'bursts' captures snippets on the schedule in the stations config; 'continuous' keeps every
+# enabled station's stream open and publishes its rolling values every CONTINUOUS_INTERVAL seconds;
+# 'adaptive' captures each station once per cycle until its tempo is confident, see analyze_adaptively;
+# 'tracks' analyzes a station when its ICY track title changes, see analyze_on_track_changes
+ANALYSIS_MODE = os.getenv('ANALYSIS_MODE', 'bursts')
+CONTINUOUS_INTERVAL = float(os.getenv('CONTINUOUS_INTERVAL', '30'))
+
+# an adaptive capture stops once this share of the tempo distribution is within 2 BPM of its peak,
+# or after ADAPTIVE_MAX_SECONDS of audio on material that never gets there
+ADAPTIVE_CONFIDENCE = float(os.getenv('ADAPTIVE_CONFIDENCE', '0.6'))
+ADAPTIVE_MAX_SECONDS = float(os.getenv('ADAPTIVE_MAX_SECONDS', '20'))
 
+# seconds of a new track skipped before it is captured, and within which a title the station comes back to isn't analyzed again
+TRACK_SETTLE_SECONDS = float(os.getenv('TRACK_SETTLE_SECONDS', '15'))
+TRACK_REPEAT_SECONDS = float(os.getenv('TRACK_REPEAT_SECONDS', '1800'))
+
+# a station failing this many captures or connections in a row is skipped for STATION_INITIAL_BACKOFF
+# seconds, then probed once; every failed probe doubles the wait, up to STATION_MAX_BACKOFF seconds
+STATION_FAILURE_THRESHOLD = int(os.getenv('STATION_FAILURE_THRESHOLD', '3'))
+STATION_INITIAL_BACKOFF = float(os.getenv('STATION_INITIAL_BACKOFF', '30'))
+STATION_MAX_BACKOFF = float(os.getenv('STATION_MAX_BACKOFF', '3600'))
+
+# serve Prometheus metrics on this local port; metrics are off when it isn't set
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0')) or None
+
+health = StationHealth(failure_threshold=STATION_FAILURE_THRESHOLD, initial_backoff=STATION_INITIAL_BACKOFF,
+                       max_backoff=STATION_MAX_BACKOFF)
+engine = IngestEngine(seconds=CAPTURE_SECONDS, max_concurrency=CAPTURE_CONCURRENCY, health=health)
+
+# started by lights_on(); the workers keep the tempo models loaded between runs and the
+# publisher keeps one connection to the websocket server open, fed by the outbox
+analysis_pool = None
+publisher = None
+outbox = None
+statistics = None
+next_checkpoint = 0.
+checkpoint_lock = threading.Lock()
+
+def journal(station, audio_stats, title=None):
+    """
+    Ranks a station's values against its history and appends them to the outbox along with their percentiles, their outlier flags, the consolidated values of the burst they belong to, i.e. the median of the burst's snippets that aren't outliers, and the title of the track if the station sends one.
+    """
+    global next_checkpoint
+    record = {**audio_stats, **statistics.observe(station, audio_stats), 'station' : station.lower()}
+    if title is not None:
+        record['title'] = title
+    outbox.append(record)
+    with checkpoint_lock:
+        if time.monotonic() < next_checkpoint:
+            return
+        next_checkpoint = time.monotonic() + STATS_CHECKPOINT_SECONDS
     try:
-        audSeg = AudioSegment.from_file(src, format=file[-3:])
-        audSeg.export(dst, format="wav")
-        return dst
-    except FileNotFoundError as f:
-        print("Couldn't find that file homie")
+        statistics.checkpoint(STATS_CHECKPOINT)
     except Exception as e:
-        print(f'Exception {e} in audio_file_to_wav function')
-
-def send_via_ws(data):
-    """
-    This method is rather self-explanatory, creating a websocket connection to the fastapi websocket server deployed through Railway.app.  It's just a helper method that DRYs up code inside of analyze_audio. 
-    """
-    # send this to websocket server
-    websocket.enableTrace(True)
-    ws = websocket.WebSocket()
-    ws.connect(os.getenv("DEPLOYED_WEBSOCKET_URL"))
-    ws.send(data)
-    print(ws.recv())
-    ws.close()
-
-def spring_cleaning():
-    cwd = os.getcwd()
-    # print('CWD: ', cwd)
-    list_of_filenames = glob("soundbytes/*")
-    # print(f'LIST OF FILE NAMES: {list_of_filenames}')
-    cur_files = os.listdir(os.curdir)
-    # print(f'CURRENT FILES: {cur_files}')
-    for file in list_of_filenames:
-        # print(f'FILE: {file}')
-        if 'starter.txt' in file:
-            continue
-
-        timestamp = file.split('_')[1].split('.')[0]
-        if int(timestamp) < int(time.time()):
-            # print(f'REMOVED FILE--{file}')
-            os.remove(f'{os.getcwd()}/{file}')
-
-def analyze_audio():
+        print(f"An exception occurred checkpointing the station statistics in journal.  It is {e}.")
+
+def publish(pairs):
+    """
+    Journals each analyzed capture's results with the track title it was captured under.
+    """
+    for capture, audio_stats in pairs:
+        # None is a failed analysis; a snippet the gate rejected as silent or noise has a status but no values
+        if audio_stats is not None and 'tempo' in audio_stats:
+            journal(capture.station, audio_stats, capture.title)
+
+def analyze_audio(station_names):
     """
     This method is the core of what's going on here.
 
-    In step 1 the audio is retrieved from the (currently 3) radio stations and saved to a WAV file.  These processes
-    are run simultaneously using the Process module and it's necessary to add them to an array, start everything in that 
-    array, then end them.  
-    
-    The audio file names are tracked then passed into step 2 of the method, which analyzes them for audio characteristics including 
-    loudness, mean pitch, and tempo. 
+    It is called by the scheduler with the stations that are due.  In step 1 their audio is captured straight into memory.  All
+    captures run concurrently on one event loop and every one stops on its own once it holds CAPTURE_SECONDS of complete mp3/aac frames, so nothing has to
+    be terminated and no file is left behind.
+
+    Each capture is passed into step 2 as soon as it is complete, while the other stations are still being captured.  The
+    analysis worker pool decodes the captures in memory through ffmpeg and analyzes them for audio characteristics including
+    loudness, mean pitch, and tempo, with the stations spread across cores and the tempo models already loaded.  Results are
+    appended to the outbox, a journal on disk from which they are sent over the websocket publisher's open connection in the
+    background, so this method never waits on the network and no result is lost while the server is down.
     """
 
-    time_to_leave = str(int(time.time()) + 120)
+    # Step 1: Capture audio into memory
+    # Step 2: Decode and analyze each batch of captures on the warm worker pool, then journal the results for sending (see publish)
+    _, failures = engine.run({station: stations[station] for station in station_names},
+                             analysis_pool.analyze, on_results=publish)
+    for station, e in failures.items():
+        print(f"An exception occurred capturing {station} in analyze_audio.  It is {e}.")
 
-    # create processes for three different stations then run them
-    processes = []
-    files = []
+def start_analysis_pool(preload_models):
+    """
+    Starts the analysis worker pool.  Every worker loads the tempo models named in preload_models before the first tick, so that the first burst of analyses doesn't pay for them.
+    """
+    global analysis_pool
+    analysis_pool = AnalysisPool(
+        processes=ANALYSIS_WORKERS,
+        models=preload_models,
+        max_jobs_per_worker=ANALYSIS_JOBS_PER_WORKER,
+        record_timings=metrics.enabled())
+    analysis_pool.on_telemetry = metrics.record_worker_telemetry
+    print(f'Started {analysis_pool.processes} analysis workers')
+
+def analyze_on_schedule(preload_models):
+    """
+    Analyzes bursts of snippets on the schedule in the stations config, on the analysis worker pool.
+    """
+    start_analysis_pool(preload_models)
+    scheduler = Scheduler(analyze_audio, stations, max_workers=SCHEDULER_WORKERS)
+
+    metrics.track_queue('captures', lambda: engine.queue_depth)
+    metrics.track_queue('analysis', lambda: analysis_pool.pending)
+    metrics.track_queue('scheduled', lambda: scheduler.stats()['busy'])
 
-    station_names = ['DDR', 'BFF', 'KOOP']
+    try:
+        scheduler.run_forever(report_every=3600)
+    finally:
+        scheduler.stop(wait=False)
+        analysis_pool.terminate()
+        engine.close()
 
-    # Step 1: Write audio to files
-    for station in station_names:
-        audio_type = stations[station]['audio_type']
-        file_name = f'soundbytes/{station}_{time_to_leave}.{audio_type}'
-        files.append(file_name)
-        process = Process(
-            target=stream_to_audio_file, 
-            name="Write stream to mp3 or aac", 
-            args=(stations[station]['stream_url'], file_name))
-        processes.append(process)
+def analyze_on_track_changes(preload_models):
+    """
+    Analyzes each track once instead of sampling at fixed minutes.  Every enabled station's stream is kept open with ICY metadata requested, and when its StreamTitle changes, CAPTURE_SECONDS of the new track are captured from the open connection once TRACK_SETTLE_SECONDS have passed, analyzed on the worker pool and journaled with the title.  A station whose title doesn't change within its cadence, e.g. a long mix, is sampled once per cadence anyway, and stations whose servers send no metadata are left to the schedule in the stations config, as in the default mode.  The analyses saved compared with the schedule are logged every hour.
+    """
+    start_analysis_pool(preload_models)
+    enabled = {station: settings for station, settings in stations.items() if settings['enabled']}
+    watcher = TrackWatcher(seconds=CAPTURE_SECONDS, settle_seconds=TRACK_SETTLE_SECONDS,
+                           fallback_seconds={station: settings['cadence'] for station, settings in enabled.items()},
+                           repeat_seconds=TRACK_REPEAT_SECONDS, health=health)
+    watching = threading.Thread(target=watcher.run_forever, name='track-watcher', daemon=True,
+                                args=(enabled, analysis_pool.analyze, publish, enabled))
 
-    # Start reading of radio stream
-    for process in processes:
-        process.start()
-    
-    # Let it write for 6 seconds
-    time.sleep(6)
+    def analyze_without_metadata(station_names):
+        station_names = [station for station in station_names if station in watcher.without_metadata]
+        if station_names:
+            analyze_audio(station_names)
 
-    # Terminate processes and also seal off files
-    for process in processes:
-        process.terminate()
+    scheduler = Scheduler(analyze_without_metadata, stations, max_workers=SCHEDULER_WORKERS)
 
-    # Step 2: Analyze audio in file
-    for file in files:
-        wav_file = audio_file_to_wav(file) 
+    metrics.track_queue('captures', lambda: engine.queue_depth)
+    metrics.track_queue('analysis', lambda: analysis_pool.pending)
+    metrics.track_queue('scheduled', lambda: scheduler.stats()['busy'])
 
-        try:
-            station = wav_file.split(".")[0].split("_")[0].split("/")[1].lower()
-            audio_stats = get_audio_characteristics(wav_file)  # analyze
-            audio_stats_encoded = json.dumps({'audio_values' : {**audio_stats, 'station' : station}}).encode('utf-8')
-            
-            send_via_ws(audio_stats_encoded)
-            
-        except Exception as e:
-            print(f"An exception occurred in write_stream within yellows_radar.py.  It is {e}.")
+    print(f'Watching the track titles of {len(enabled)} stations')
+    watching.start()
+    try:
+        scheduler.run_forever(report_every=3600)
+    finally:
+        watcher.stop()
+        watching.join()
+        scheduler.stop(wait=False)
+        analysis_pool.terminate()
+        engine.close()
 
-def schedule_audio_analyses():
+def analyze_adaptively(model_name):
     """
-    Every six minutes four calls are made, separated by 20 second intervals, to analyze the audio of a radio station.  The thinking here is that by separating them by 20 seconds only they'll be proximate enough to be analyzing the same thing (i.e. the same song) and therefore we can expect similar values to be returned, hence making us more sure that any outliers detected are indeed outliers.
+    Analyzes every station once per cycle of the stations config, listening only as long as its tempo needs.  Each station's stream is decoded and its tempo evaluated as the audio arrives, and the capture stops as soon as the tempo is confident and stable, typically after about 7 seconds of clear-beat music, or after ADAPTIVE_MAX_SECONDS on material without a clear beat.  The confidence replaces the bursts of snippets taken to be more sure of the values, so only the first tick of each burst is kept, and it is journaled with the values.
+    """
+    # imported here so that the other modes never load librosa and scipy in the daemon process
+    from radio.adaptive import AdaptiveCapture
+
+    adaptive = AdaptiveCapture(threshold=ADAPTIVE_CONFIDENCE, max_seconds=ADAPTIVE_MAX_SECONDS,
+                               model_name=model_name, max_concurrency=CAPTURE_CONCURRENCY, health=health)
+
+    def analyze(station_names):
+        _, failures = adaptive.run({station: stations[station] for station in station_names}, journal)
+        for station, e in failures.items():
+            print(f"An exception occurred capturing {station} in analyze_adaptively.  It is {e}.")
 
-    After each of these the audio files that were written and subsequently analyzed are removed.
+    scheduler = Scheduler(analyze, {station: {**settings, 'burst': [0]} for station, settings in stations.items()},
+                          max_workers=SCHEDULER_WORKERS)
+    metrics.track_queue('scheduled', lambda: scheduler.stats()['busy'])
+    print(f'Analyzing {len(stations)} stations adaptively')
+    try:
+        scheduler.run_forever(report_every=3600)
+    finally:
+        scheduler.stop(wait=False)
+        adaptive.close()
+
+def listen_continuously(model_name):
+    """
+    Keeps the stream of every enabled station open and journals each station's rolling tempo, loudness and pitch every CONTINUOUS_INTERVAL seconds.  Nothing is spent reconnecting and no change between two ticks is missed; the first values of a station come once about 12 seconds of its audio have filled a tempo window.
     """
+    from radio.continuous import ContinuousEngine
 
-    hourly_radio_analysis_times = ["00:00", "00:20", "00:40", "01:00", "06:00", "06:20", "06:40", "07:00", "12:00", "12:20", "12:40", "13:00", "18:00", "18:20", "18:40", "19:00", "24:00", "24:20", "24:40", "25:00", "30:00", "30:20", "30:40", "31:00", "36:00", "36:20", "36:40", "37:00", "42:00", "42:20", "42:40", "43:00", "48:00", "48:20", "48:40", "49:00", "54:00", "54:20", "54:40", "55:00"]
+    continuous = ContinuousEngine(interval=CONTINUOUS_INTERVAL, model_name=model_name, health=health)
+    enabled = {station: settings for station, settings in stations.items() if settings['enabled']}
+    print(f'Listening continuously to {len(enabled)} stations')
+    continuous.run_forever(enabled, journal)
 
-    hourly_file_cleanup_times = ["03:00", "09:00", "15:00", "21:00", "27:00", "33:00", "39:00", "45:00", "51:00", "57:00"]
+def lights_on(preload_models=('cnn',)):
+    """
+    Starts the daemon.
+
+    By default each station is analyzed on the cadence and burst pattern set in the stations config, e.g. four analyses 20 seconds apart every six minutes.  Analyzing a station a few times in quick succession means the analyses are likely to cover the same song, so similar values can be expected and any outliers detected are more likely to be real.  The stations' cycles are spread across the six minutes instead of all starting at the same second, so the load is spread too.  With ANALYSIS_MODE=continuous the stations are followed continuously instead, see listen_continuously, with ANALYSIS_MODE=adaptive each capture lasts as long as the station's tempo needs, see analyze_adaptively, and with ANALYSIS_MODE=tracks each new track is analyzed once, see analyze_on_track_changes.
+    """
+    global publisher, outbox, statistics
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    if METRICS_PORT:
+        metrics.enable(METRICS_PORT)
 
-    for time in hourly_radio_analysis_times:
-        schedule.every().hour.at(time).do(analyze_audio)
+    publisher = WebSocketPublisher(os.getenv("DEPLOYED_WEBSOCKET_URL"))
+    publisher.on_send = metrics.observe_send
+    publisher.on_failure = lambda e: metrics.count_failure('publish')
+    publisher.start()
+    outbox = Outbox(OUTBOX_DIR, publisher, batched=PUBLISH_BATCHED, fsync=OUTBOX_FSYNC).start()
+    metrics.track_queue('publisher', lambda: publisher.queue_depth)
+    metrics.track_queue('outbox', lambda: outbox.stats()['backlog'])
 
-    for time in hourly_file_cleanup_times:
-        schedule.every().hour.at(time).do(spring_cleaning)   
+    # the snippets of a burst are consolidated into one value; in the other modes every result stands alone
+    burst_gap = 0.
+    if ANALYSIS_MODE == 'bursts':
+        gaps = [b - a for settings in stations.values() for a, b in zip(settings['burst'], settings['burst'][1:])]
+        burst_gap = max(gaps, default=0) + 2 * CAPTURE_SECONDS
+    statistics = StationStatistics(window_seconds=STATS_WINDOW_DAYS * 86400, burst_gap=burst_gap)
+    if os.path.exists(STATS_CHECKPOINT) and statistics.restore(STATS_CHECKPOINT):
+        print(f'Restored the statistics of {len(statistics.stations)} stations')
 
-def lights_on():
-    schedule_audio_analyses()
-    
-    while True:
-        schedule.run_pending()
-        time.sleep(10)
+    try:
+        if ANALYSIS_MODE == 'continuous':
+            listen_continuously(preload_models[0])
+        elif ANALYSIS_MODE == 'adaptive':
+            analyze_adaptively(preload_models[0])
+        elif ANALYSIS_MODE == 'tracks':
+            analyze_on_track_changes(preload_models)
+        else:
+            analyze_on_schedule(preload_models)
+    finally:
+        health_stats = health.stats()
+        print(f"Station health: {health_stats['healthy']} healthy, {health_stats['probing']} probing, "
+              f"{health_stats['open']} skipped for failing")
+        outbox.stop()
+        publisher.stop()
+        try:
+            statistics.checkpoint(STATS_CHECKPOINT)
+        except Exception as e:
+            print(f"An exception occurred checkpointing the station statistics in lights_on.  It is {e}.")
 
 if __name__=="__main__":
     lights_on()
\ No newline at end of file
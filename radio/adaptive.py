@@ -0,0 +1,285 @@
+"""
+Adaptive captures that stop once the tempo is certain.
+
+A fixed capture listens for 6 s whatever the audio is, and bursts of several
+snippets are needed to be more sure of the values.  An adaptive capture
+instead decodes the stream as it arrives into a
+:class:`audio_characteristics.rolling.RollingAnalyzer` and has the tempo model
+evaluate the latest audio every ``check_seconds``.  The predictions are
+averaged, weighted by how much of the model's 256-frame window they saw, and
+the capture stops once the average puts at least ``threshold`` of its
+probability within 2 BPM of its peak and the peak has not moved for
+``stable_checks`` evaluations.  Ambiguous material, e.g. no clear beat or a
+tempo the model can't tell from its double, keeps listening up to
+``max_seconds``.
+
+Every result carries the ``confidence`` it was reached with and the
+``seconds`` of audio captured.  Clear-beat music
+stops after a few seconds, so less of the stream is downloaded, decoded and
+predicted than with a fixed capture.
+
+The due evaluations of all stations are predicted together in one batch on a
+single model thread, so the model never runs concurrently.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import time
+
+import aiohttp
+
+from audio_characteristics.rolling import RollingAnalyzer
+from audio_characteristics.tempo import get_classifier
+from radio import metrics
+from radio.capture import READ_SIZE
+from radio.continuous import CHANNELS, SAMPLE_RATE, feed_analyzer
+from radio.loop import EventLoopThread
+
+logger = logging.getLogger(__name__)
+
+
+class _Listener:
+    """
+    State of one station's adaptive capture.
+    """
+
+    def __init__(self, station, check_seconds):
+        self.station = station
+        self.analyzer = RollingAnalyzer(SAMPLE_RATE, CHANNELS, half_life=None, source=station)
+        self.next_check = check_seconds
+        self.due = asyncio.Event()
+        self.tempi = []
+        self.confidence = None
+
+    def on_block(self):
+        if self.analyzer.duration >= self.next_check:
+            self.due.set()
+
+
+class AdaptiveCapture:
+    """
+    Captures stations until their tempo is confident and stable, and reports their values with the confidence.
+    """
+
+    def __init__(self, threshold=.6, stable_checks=2, stable_bpm=2, min_seconds=4.5, max_seconds=20.,
+                 check_seconds=1.5, model_name='cnn', max_concurrency=100, block_seconds=.5, connect_timeout=5.,
+                 read_timeout=10., read_size=READ_SIZE, max_workers=None, health=None):
+        """
+        :param threshold: confidence, between 0 and 1, at which a capture may stop
+        :param stable_checks: consecutive evaluations whose tempo must agree before a capture stops
+        :param stable_bpm: how far those tempi may differ
+        :param min_seconds: seconds of audio captured at least
+        :param max_seconds: seconds of audio after which a capture stops however uncertain it is
+        :param check_seconds: seconds of audio between two evaluations of a station
+        :param model_name: tempo model, loaded in this process
+        :param max_concurrency: streams read at the same time
+        :param block_seconds: seconds of PCM handed to a station's analyzer at once
+        :param connect_timeout: seconds to establish a connection
+        :param read_timeout: seconds allowed between two reads
+        :param max_workers: threads running the analyzers, see :class:`concurrent.futures.ThreadPoolExecutor`
+        :param health: optional :class:`radio.health.StationHealth`, see :class:`radio.ingest.IngestEngine`
+        """
+        self.threshold = threshold
+        self.stable_checks = stable_checks
+        self.stable_bpm = stable_bpm
+        self.min_seconds = min_seconds
+        self.max_seconds = max_seconds
+        self.check_seconds = check_seconds
+        self.model_name = model_name
+        self.max_concurrency = max_concurrency
+        self.block_bytes = int(block_seconds * SAMPLE_RATE) * CHANNELS * 4
+        self.read_size = read_size
+        self.health = health
+        self.timeout = aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout)
+        # a stream delivering slower than real time is given up on
+        self.stream_timeout = 2 * max_seconds + connect_timeout
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='adaptive')
+        # one thread runs the model, so predictions never run concurrently, even across bursts
+        self._model_executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='adaptive-model')
+        self._counts = {'captures': 0, 'confident': 0, 'at_max': 0, 'ended': 0, 'failures': 0,
+                        'evaluations': 0, 'seconds': 0.}
+        # run() runs every burst on this loop, sharing one session and max_concurrency, see radio.ingest
+        self._runner = EventLoopThread('adaptive')
+        self._session = None
+        self._semaphore = None
+
+    def _evaluate(self, listener, prediction, weight, classifier):
+        analyzer = listener.analyzer
+        analyzer.add_predictions([prediction], [weight])
+        listener.confidence = analyzer.confidence()
+        listener.tempi.append(analyzer.tempo(classifier))
+        recent = listener.tempi[-self.stable_checks:]
+        stable = len(recent) == self.stable_checks and max(recent) - min(recent) <= self.stable_bpm
+        return (analyzer.duration >= self.min_seconds and stable and listener.confidence >= self.threshold)
+
+    async def _evaluate_due(self, classifier, requests):
+        """
+        Predicts the latest window of every station asking for an evaluation, in one batch per round.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await requests.get()]
+            while not requests.empty():
+                batch.append(requests.get_nowait())
+            start = time.perf_counter()
+            windows = [(listener, future, listener.analyzer.latest_window()) for listener, future in batch]
+            features = [window for _, _, (window, _) in windows]
+            try:
+                predictions = await loop.run_in_executor(self._model_executor, classifier.estimate_batch, features)
+            except Exception as e:
+                for _, future, _ in windows:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (listener, future, (_, weight)), prediction in zip(windows, predictions):
+                if not future.done():
+                    future.set_result(self._evaluate(listener, prediction[0], weight, classifier))
+            self._counts['evaluations'] += len(batch)
+            metrics.observe_stage('adaptive_evaluation', None, time.perf_counter() - start)
+
+    async def _listen(self, session, listener, config, requests):
+        """
+        Captures until the evaluations are confident, the maximum is reached or the stream ends.
+
+        :return: ``'confident'``, ``'at_max'`` or ``'ended'``
+        """
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        async with session.get(config['stream_url']) as response:
+            if self.health is not None:
+                self.health.record_ttfb(listener.station, time.perf_counter() - start)
+            response.raise_for_status()
+            feeding = asyncio.ensure_future(feed_analyzer(
+                response, config['audio_type'], listener.analyzer, self._executor, self.block_bytes,
+                self.read_size, on_block=listener.on_block))
+            try:
+                while True:
+                    due = asyncio.ensure_future(listener.due.wait())
+                    await asyncio.wait((due, feeding), return_when=asyncio.FIRST_COMPLETED)
+                    due.cancel()
+                    ended = feeding.done()
+                    if ended:
+                        # raise a failed stream's exception, or evaluate what there is of an ended one
+                        feeding.result()
+                        if listener.analyzer.latest_window() is None:
+                            raise ConnectionError('stream ended before any audio was decoded')
+                    listener.due.clear()
+                    future = loop.create_future()
+                    await requests.put((listener, future))
+                    if await future:
+                        return 'confident'
+                    if ended:
+                        return 'ended'
+                    if listener.analyzer.duration >= self.max_seconds:
+                        return 'at_max'
+                    listener.next_check = min(listener.analyzer.duration + self.check_seconds, self.max_seconds)
+                    listener.on_block()
+            finally:
+                feeding.cancel()
+                await asyncio.gather(feeding, return_exceptions=True)
+
+    async def _capture(self, session, semaphore, classifier, requests, station, config, on_result, results,
+                       failures):
+        if self.health is not None and not self.health.allow(station):
+            logger.debug(f'Skipping {station}, its circuit is open')
+            return
+        listener = _Listener(station, self.check_seconds)
+        start = time.perf_counter()
+        async with semaphore:
+            try:
+                outcome = await asyncio.wait_for(self._listen(session, listener, config, requests),
+                                                 self.stream_timeout)
+            except Exception as e:
+                failures[station] = e
+                self._counts['failures'] += 1
+                metrics.count_failure('capture', station)
+                logger.warning(f'Capturing {station} failed: {e!r}')
+                if self.health is not None:
+                    self.health.record_failure(station, e)
+                return
+        if self.health is not None:
+            self.health.record_success(station)
+        analyzer = listener.analyzer
+        self._counts['captures'] += 1
+        self._counts[outcome] += 1
+        self._counts['seconds'] += analyzer.duration
+        metrics.observe_stage('adaptive_capture', station, time.perf_counter() - start)
+        values = analyzer.values(classifier)
+        if values is None:
+            logger.info(f'{station} was silent for the {analyzer.duration:.1f}s captured')
+            return
+        values.update(confidence=round(listener.confidence, 2), seconds=round(analyzer.duration, 1))
+        logger.debug(f'{station}: {values["tempo"]} BPM at confidence {listener.confidence:.2f} '
+                     f'after {analyzer.duration:.1f}s ({outcome})')
+        results[station] = values
+        if on_result is not None:
+            try:
+                on_result(station, values)
+            except Exception as e:
+                logger.error(f'Handling the values of {station} failed: {e!r}')
+
+    async def run_burst(self, stations, on_result=None):
+        """
+        Captures every station until it is confident or reaches ``max_seconds``.
+
+        :param stations: dict of station name to ``{'stream_url', 'audio_type'}``
+        :param on_result: optional callable taking a station name and a dict of its ``tempo``,
+            ``loudness``, ``pitch``, ``confidence`` and the ``seconds`` of audio it
+            took, called as soon as the station is done
+        :return: ``(results, failures)`` - dicts of station name to its values and to
+            the exception that stopped its capture; silent stations and stations
+            skipped for their health are in neither
+
+        Every burst must run on the same event loop, as with
+        :meth:`radio.ingest.IngestEngine.run_burst`; :meth:`run` takes care of that.
+        """
+        loop = asyncio.get_running_loop()
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=0, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        session, semaphore = self._session, self._semaphore
+        classifier = await loop.run_in_executor(self._model_executor, get_classifier, self.model_name)
+        requests = asyncio.Queue()
+        results, failures = {}, {}
+        evaluator = asyncio.ensure_future(self._evaluate_due(classifier, requests))
+        try:
+            await asyncio.gather(*(self._capture(session, semaphore, classifier, requests, station, config,
+                                                 on_result, results, failures)
+                                   for station, config in stations.items()))
+        finally:
+            evaluator.cancel()
+            await asyncio.gather(evaluator, return_exceptions=True)
+        return results, failures
+
+    def run(self, stations, on_result=None):
+        """
+        Blocking wrapper around :meth:`run_burst` for callers without an event
+        loop.  Bursts run from any number of threads share the loop, connections
+        and ``max_concurrency``.
+        """
+        return self._runner.run(self.run_burst(stations, on_result))
+
+    async def aclose(self):
+        """
+        Closes the session of bursts awaited directly, on their loop.
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = self._semaphore = None
+
+    def close(self):
+        if self._runner.running:
+            self._runner.run(self.aclose())
+            self._runner.stop()
+        self._executor.shutdown(wait=False)
+        self._model_executor.shutdown(wait=False)
+
+    def stats(self):
+        """
+        :return: dict with counts of ``captures`` (of which ``confident``, ``at_max`` and
+            ``ended`` early by the stream), ``failures`` and ``evaluations``, the
+            total ``seconds`` of audio captured and the mean per capture
+        """
+        captures = self._counts['captures']
+        return {**self._counts, 'mean_seconds': self._counts['seconds'] / captures if captures else 0.}
@@ -0,0 +1,364 @@
+"""
+Bulk analysis of archived recordings.
+
+Profiles every file given (directories are searched recursively, glob
+patterns are expanded, and ``@list.txt`` reads paths and patterns from a file)
+with the same pipeline as the daemon.  Files are split into fixed-length
+segments, which are spread over a pool of worker processes with the tempo
+models loaded, a few consecutive segments per job so each job runs the model
+once.  Results are written as they arrive, to JSON lines or, for an output
+ending in ``.parquet``, to a directory of parquet files (needs pyarrow).
+
+Progress is saved in a checkpoint next to the output every time the written
+results are flushed.  Running the same command again after a crash drops
+whatever was written after the last checkpoint and continues with the
+segments not in it, so every segment ends up in the output exactly once.
+An output that exists without its checkpoint isn't touched unless
+``--overwrite`` is given.
+
+    python -m radio.backfill archive/ 'shows/**/*.mp3' --output results.jsonl
+    python -m radio.backfill @recordings.txt --output results.parquet --segment-seconds 30 --workers 8
+"""
+import argparse
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+from radio.workers import _init_worker
+
+logger = logging.getLogger(__name__)
+
+AUDIO_EXTENSIONS = ('.wav', '.flac', '.ogg', '.mp3', '.aac', '.m4a', '.aiff', '.aif')
+
+DEFAULT_SEGMENT_SECONDS = 30.
+# a file's last segment is dropped when it is shorter than this
+MIN_SEGMENT_SECONDS = 3.
+
+COLUMNS = ('path', 'segment', 'start', 'seconds', 'tempo', 'loudness', 'pitch', 'status')
+# a segment's status: the gate's, see audio_characteristics.gate.Status, or 'failed'
+STATUSES = ('ok', 'clipped', 'silent', 'noise', 'failed')
+
+
+def expand_inputs(inputs):
+    """
+    Resolves directories, glob patterns, ``@file`` lists and plain paths to audio files.
+
+    :param inputs: list of inputs as given on the command line
+    :return: list of file paths, in the order given and without duplicates
+    """
+    paths = []
+    for item in inputs:
+        if item.startswith('@'):
+            with open(item[1:]) as f:
+                listed = [line.strip() for line in f]
+            paths.extend(expand_inputs([line for line in listed if line and not line.startswith('#')]))
+        elif os.path.isdir(item):
+            for root, directories, files in os.walk(item):
+                directories.sort()
+                paths.extend(os.path.join(root, name) for name in sorted(files)
+                             if name.lower().endswith(AUDIO_EXTENSIONS))
+        elif glob.has_magic(item):
+            paths.extend(path for path in sorted(glob.glob(item, recursive=True)) if os.path.isfile(path))
+        else:
+            paths.append(item)
+    return list(dict.fromkeys(paths))
+
+
+def plan_segments(path, duration, segment_seconds):
+    """
+    :return: list of ``(path, index, start, seconds)``
+    """
+    segments, start = [], 0.
+    while start < duration:
+        seconds = min(segment_seconds, duration - start)
+        # a short last segment is dropped, unless it is the whole file
+        if seconds < MIN_SEGMENT_SECONDS and segments:
+            break
+        segments.append((path, len(segments), start, seconds))
+        start += segment_seconds
+    return segments
+
+
+def _failed_row(path, index, start, seconds):
+    """
+    :return: result row of a segment that couldn't be profiled
+    """
+    return {'path': path, 'segment': index, 'start': start, 'seconds': seconds,
+            'tempo': None, 'loudness': None, 'pitch': None, 'status': 'failed'}
+
+
+def analyze_segments(segments, model_name='cnn'):
+    """
+    Decodes and profiles segments inside a worker, running the tempo model once for all of them.
+
+    :param segments: list of ``(path, index, start, seconds)``
+    :return: list of result rows, see :data:`COLUMNS`
+    """
+    from audio_characteristics.decode import decode_file
+    from audio_characteristics.profile import get_audio_characteristics_batch
+
+    contexts, rows = [], []
+    for path, index, start, seconds in segments:
+        rows.append(_failed_row(path, index, start, seconds))
+        try:
+            contexts.append((rows[-1], decode_file(path, start, seconds)))
+        except Exception as e:
+            print(f'Exception occurred decoding {path} at {start:g}s in analyze_segments. It is: {e}')
+
+    profiled = get_audio_characteristics_batch([context for _, context in contexts], model_name=model_name)
+    for (row, _), audio_stats in zip(contexts, profiled):
+        # None failed while profiling and keeps its 'failed' status; a snippet the gate rejected has no values
+        if audio_stats is not None:
+            row.update(tempo=audio_stats.get('tempo'), loudness=audio_stats.get('loudness'),
+                       pitch=audio_stats.get('pitch'), status=audio_stats['status'])
+    return rows
+
+
+class _JsonlSink:
+    """
+    Results as JSON lines; the checkpoint records the file size after every flush.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'ab')
+
+    def resume(self, positions):
+        # drop what was written after the last checkpoint
+        offset = positions[-1] if positions else 0
+        self._file.truncate(offset)
+        self._file.seek(offset)
+
+    def write(self, row):
+        self._file.write(json.dumps(row).encode('utf-8') + b'\n')
+
+    def flush(self):
+        """
+        :return: position to record in the checkpoint
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+
+class _ParquetSink:
+    """
+    Results as a directory of parquet files, one per flush; the checkpoint records the file names.
+    """
+
+    def __init__(self, path):
+        import pyarrow
+
+        self.path = path
+        self._schema = pyarrow.schema([('path', pyarrow.string()), ('segment', pyarrow.int32()),
+                                       ('start', pyarrow.float64()), ('seconds', pyarrow.float64()),
+                                       ('tempo', pyarrow.int32()), ('loudness', pyarrow.int32()),
+                                       ('pitch', pyarrow.int32()), ('status', pyarrow.string())])
+        self._rows = []
+        self._parts = 0
+        os.makedirs(path, exist_ok=True)
+
+    def resume(self, positions):
+        # drop parts written after the last checkpoint
+        for name in os.listdir(self.path):
+            if name.startswith('part-') and name not in positions:
+                os.remove(os.path.join(self.path, name))
+        self._parts = len(positions)
+
+    def write(self, row):
+        self._rows.append(row)
+
+    def flush(self):
+        import pyarrow
+        import pyarrow.parquet
+
+        name = f'part-{self._parts:05d}.parquet'
+        table = pyarrow.Table.from_pylist(self._rows, schema=self._schema)
+        pyarrow.parquet.write_table(table, os.path.join(self.path, name + '.tmp'))
+        os.replace(os.path.join(self.path, name + '.tmp'), os.path.join(self.path, name))
+        self._rows = []
+        self._parts += 1
+        return name
+
+    def close(self):
+        pass
+
+
+class Checkpoint:
+    """
+    Append-only record of the segments whose results were flushed to the output.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self.positions = []
+        self._file = open(path, 'ab+')
+        self._file.seek(0)
+        end = 0
+        for line in self._file:
+            try:
+                entry = json.loads(line) if line.endswith(b'\n') else None
+            except ValueError:
+                entry = None
+            if entry is None:
+                break  # a crash while recording left a torn last line
+            self.positions.append(entry['position'])
+            self.done.update((file, index) for file, index in entry['segments'])
+            end += len(line)
+        self._file.truncate(end)
+
+    def record(self, position, segments):
+        self._file.write(json.dumps({'position': position, 'segments': segments}).encode('utf-8') + b'\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.done.update((file, index) for file, index in segments)
+        self.positions.append(position)
+
+    def close(self):
+        self._file.close()
+
+
+class _Progress:
+
+    def __init__(self, files, segments, audio_seconds):
+        self.files = files
+        self.segments = segments
+        self.audio_seconds = audio_seconds
+        self.files_done = 0
+        self.segments_done = 0
+        self.audio_done = 0.
+        self.start = time.perf_counter()
+
+    def report(self, final=False):
+        minutes = (time.perf_counter() - self.start) / 60
+        files_per_minute = self.files_done / minutes if minutes else 0.
+        hours_per_minute = self.audio_done / 3600 / minutes if minutes else 0.
+        remaining = (self.audio_seconds - self.audio_done) / 3600 / hours_per_minute if hours_per_minute else None
+        print(f'{"Done" if final else "Progress"}: {self.files_done}/{self.files} files, '
+              f'{self.segments_done}/{self.segments} segments, '
+              f'{files_per_minute:.1f} files/min, {hours_per_minute:.2f} audio hours/min'
+              + (f', about {remaining:.0f} min left' if remaining is not None and not final else ''))
+
+
+def backfill(inputs, output, segment_seconds=DEFAULT_SEGMENT_SECONDS, workers=None, segments_per_job=8,
+             flush_every=500, report_every=30., model_name='cnn', overwrite=False):
+    """
+    Profiles the segments of every input file not yet in the output's checkpoint.
+
+    :param inputs: see :func:`expand_inputs`
+    :param output: ``.jsonl`` file, or ``.parquet`` directory
+    :param segments_per_job: consecutive segments profiled with one model call
+    :param flush_every: results written between two checkpoints
+    :param report_every: seconds between two progress reports
+    :param overwrite: start over, replacing the output and its checkpoint; without it an output
+        that exists without a checkpoint raises :class:`FileExistsError`, as it wasn't written by a backfill
+    :return: dict with counts of ``files`` and ``segments`` profiled, ``done_before``,
+        segments by status (``ok``, ``clipped`` but profiled, ``silent`` and ``noise`` as rejected by
+        the gate, ``failed``), ``audio_hours`` and ``minutes``
+    """
+    from audio_characteristics.decode import audio_duration
+
+    if overwrite:
+        if os.path.exists(output + '.checkpoint'):
+            os.remove(output + '.checkpoint')
+    elif os.path.exists(output) and not os.path.exists(output + '.checkpoint'):
+        raise FileExistsError(f'{output} exists without a checkpoint, pass --overwrite to replace it')
+    sink = _ParquetSink(output) if output.endswith('.parquet') else _JsonlSink(output)
+    checkpoint = Checkpoint(output + '.checkpoint')
+    sink.resume(checkpoint.positions)
+
+    segments, remaining_per_file, unreadable = [], {}, 0
+    for path in expand_inputs(inputs):
+        try:
+            duration = audio_duration(path)
+        except Exception as e:
+            unreadable += 1
+            logger.warning(f'Skipping {path}: {e}')
+            continue
+        todo = [segment for segment in plan_segments(path, duration, segment_seconds)
+                if (path, segment[1]) not in checkpoint.done]
+        if todo:
+            segments.extend(todo)
+            remaining_per_file[path] = len(todo)
+    already_done = len(checkpoint.done)
+    progress = _Progress(len(remaining_per_file), len(segments), sum(segment[3] for segment in segments))
+    print(f'{len(segments)} segments of {len(remaining_per_file)} files to profile, {already_done} done before'
+          + (f', {unreadable} files unreadable' if unreadable else ''))
+
+    counts = {status: 0 for status in STATUSES}
+    jobs = [segments[i:i + segments_per_job] for i in range(0, len(segments), segments_per_job)]
+    processes = workers or os.cpu_count() or 1
+    threads = max(1, (os.cpu_count() or 1) // processes)
+    unflushed, next_report = [], time.perf_counter() + report_every
+    pool = multiprocessing.get_context('spawn').Pool(processes, initializer=_init_worker,
+                                                     initargs=((model_name,), threads, False))
+    try:
+        for rows in pool.imap_unordered(_analyze_job, [(job, model_name) for job in jobs]):
+            for row in rows:
+                sink.write(row)
+                unflushed.append([row['path'], row['segment']])
+                counts[row['status']] += 1
+                progress.segments_done += 1
+                progress.audio_done += row['seconds']
+                remaining_per_file[row['path']] -= 1
+                if remaining_per_file[row['path']] == 0:
+                    progress.files_done += 1
+            if len(unflushed) >= flush_every:
+                checkpoint.record(sink.flush(), unflushed)
+                unflushed = []
+            if time.perf_counter() >= next_report:
+                progress.report()
+                next_report += report_every
+        if unflushed:
+            checkpoint.record(sink.flush(), unflushed)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        sink.close()
+        checkpoint.close()
+    progress.report(final=True)
+    return {'files': progress.files, 'segments': progress.segments, 'done_before': already_done, **counts,
+            'audio_hours': progress.audio_done / 3600, 'minutes': (time.perf_counter() - progress.start) / 60}
+
+
+def _analyze_job(args):
+    segments, model_name = args
+    try:
+        return analyze_segments(segments, model_name)
+    except Exception as e:
+        # recorded as failed, so a job that can't be profiled doesn't stop this run or the ones resuming it
+        print(f'Exception occurred profiling {len(segments)} segments of {segments[0][0]} in _analyze_job. It is: {e}')
+        return [_failed_row(*segment) for segment in segments]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('inputs', nargs='+', help='audio files, directories, glob patterns or @file lists')
+    parser.add_argument('--output', required=True, help='.jsonl file or .parquet directory')
+    parser.add_argument('--segment-seconds', type=float, default=DEFAULT_SEGMENT_SECONDS)
+    parser.add_argument('--workers', type=int, help='worker processes, one per core by default')
+    parser.add_argument('--segments-per-job', type=int, default=8)
+    parser.add_argument('--flush-every', type=int, default=500, help='results written between two checkpoints')
+    parser.add_argument('--report-every', type=float, default=30., help='seconds between progress reports')
+    parser.add_argument('--model', default='cnn')
+    parser.add_argument('--overwrite', action='store_true', help='replace the output instead of resuming it')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    try:
+        backfill(args.inputs, args.output, args.segment_seconds, args.workers, args.segments_per_job,
+                 args.flush_every, args.report_every, args.model, args.overwrite)
+    except FileExistsError as e:
+        parser.error(str(e))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+"""
+Bounded in-memory capture of compressed radio streams.
+
+A capture reads a station's stream with large reads into a preallocated
+buffer and stops as soon as it holds the requested duration (or byte count)
+of complete codec frames.  The result starts and ends on frame boundaries, so
+the decoder never sees a frame cut in half, and nothing touches the disk.
+"""
+import logging
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# large reads keep the per-chunk Python overhead negligible next to the network
+READ_SIZE = 64 * 1024
+
+# used to size the buffer up front when only a duration is requested
+DEFAULT_MAX_BITRATE = 320000
+
+_MP3_BITRATES = {
+    # (mpeg 1?, layer) -> kbps by bitrate index
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+
+_MP3_SAMPLE_RATES = {
+    # version bits -> sample rate by index
+    3: (44100, 48000, 32000),  # MPEG 1
+    2: (22050, 24000, 16000),  # MPEG 2
+    0: (11025, 12000, 8000),   # MPEG 2.5
+}
+
+_ADTS_SAMPLE_RATES = (96000, 88200, 64000, 48000, 44100, 32000, 24000,
+                      22050, 16000, 12000, 11025, 8000, 7350)
+
+
+def mp3_frame_info(buf, pos):
+    """
+    Parses the MPEG audio frame header at ``pos``.
+
+    :param buf: bytes-like buffer
+    :param pos: offset of the candidate header
+    :return: ``(frame_length, samples, sample_rate)`` or ``None`` if there is no valid header
+    """
+    if pos + 4 > len(buf):
+        return None
+    b0, b1, b2 = buf[pos], buf[pos + 1], buf[pos + 2]
+    if b0 != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+    version = (b1 >> 3) & 0x03
+    layer = 4 - ((b1 >> 1) & 0x03)
+    bitrate_index = b2 >> 4
+    sample_rate_index = (b2 >> 2) & 0x03
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    mpeg1 = version == 3
+    bitrate = _MP3_BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version][sample_rate_index]
+    padding = (b2 >> 1) & 0x01
+
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4, 384, sample_rate
+    if layer == 3 and not mpeg1:
+        return 72 * bitrate // sample_rate + padding, 576, sample_rate
+    return 144 * bitrate // sample_rate + padding, 1152, sample_rate
+
+
+def adts_frame_info(buf, pos):
+    """
+    Parses the ADTS (AAC) frame header at ``pos``.
+
+    :param buf: bytes-like buffer
+    :param pos: offset of the candidate header
+    :return: ``(frame_length, samples, sample_rate)`` or ``None`` if there is no valid header
+    """
+    if pos + 7 > len(buf):
+        return None
+    b0, b1, b2, b3, b4, b5, b6 = (buf[pos + i] for i in range(7))
+    if b0 != 0xFF or (b1 & 0xF6) != 0xF0:
+        return None
+    sample_rate_index = (b2 >> 2) & 0x0F
+    if sample_rate_index >= len(_ADTS_SAMPLE_RATES):
+        return None
+    frame_length = ((b3 & 0x03) << 11) | (b4 << 3) | (b5 >> 5)
+    header_length = 7 if b1 & 0x01 else 9
+    if frame_length < header_length:
+        return None
+    return frame_length, 1024 * ((b6 & 0x03) + 1), _ADTS_SAMPLE_RATES[sample_rate_index]
+
+
+def frame_channels(buf, pos, audio_type):
+    """
+    Reads the channel count from the frame header at ``pos``.
+
+    :return: number of channels, or ``None`` if the header doesn't say (ADTS
+        channel configuration 0 is signalled in-band instead)
+    """
+    if audio_type == 'mp3':
+        # channel mode 3 is single channel, everything else is two
+        return 1 if buf[pos + 3] >> 6 == 3 else 2
+    config = ((buf[pos + 2] & 0x01) << 2) | (buf[pos + 3] >> 6)
+    if config == 0:
+        return None
+    return 8 if config == 7 else config
+
+
+_FRAME_PARSERS = {
+    'mp3': mp3_frame_info,
+    'aac': adts_frame_info,
+}
+
+
+def frame_parser(audio_type):
+    try:
+        return _FRAME_PARSERS[audio_type]
+    except KeyError:
+        raise ValueError(f"Unsupported audio type '{audio_type}'. Expected one of {sorted(_FRAME_PARSERS)}.")
+
+
+def find_frame_start(buf, audio_type, start=0, end=None):
+    """
+    Finds the first frame boundary at or after ``start``.
+
+    A sync word is only accepted if another valid header follows right after
+    the frame, which filters out the false syncs that appear inside frame data.
+
+    :param buf: ``bytes`` or ``bytearray``
+    :return: offset of the first frame, or ``None`` if none could be confirmed yet
+    """
+    parse = frame_parser(audio_type)
+    end = len(buf) if end is None else end
+    pos = start
+    while pos < end:
+        pos = buf.find(b'\xff', pos, end)
+        if pos == -1:
+            return None
+        info = parse(buf, pos)
+        if info is not None and parse(buf, pos + info[0]) is not None:
+            return pos
+        pos += 1
+    return None
+
+
+class Capture:
+    """
+    A frame-aligned run of compressed audio held in memory.
+    """
+
+    def __init__(self, data, audio_type, duration, frames, sample_rate, channels=None, station=None, started_at=None,
+                 title=None):
+        self.data = data
+        self.audio_type = audio_type
+        self.duration = duration
+        self.frames = frames
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.station = station
+        self.started_at = started_at
+        # the stream's ICY StreamTitle while it was captured, if it sends one
+        self.title = title
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return (f'Capture(station={self.station!r}, audio_type={self.audio_type!r}, '
+                f'bytes={len(self.data)}, frames={self.frames}, duration={self.duration:.2f}s)')
+
+
+class FrameAccumulator:
+    """
+    Collects stream chunks into a preallocated buffer and tracks how much
+    complete, frame-aligned audio it holds.
+    """
+
+    def __init__(self, audio_type, capacity, max_bytes=None):
+        self.audio_type = audio_type
+        self.max_bytes = max_bytes
+        self.full = False
+        self._parse = frame_parser(audio_type)
+        self.buffer = bytearray(capacity)
+        self.size = 0
+        self.start = None  # offset of the first confirmed frame
+        self.end = None    # offset just past the last complete frame
+        self.frames = 0
+        self.samples = 0
+        self.sample_rate = None
+
+    @property
+    def duration(self):
+        return self.samples / self.sample_rate if self.sample_rate else 0.
+
+    @property
+    def aligned_bytes(self):
+        return 0 if self.start is None else self.end - self.start
+
+    def feed(self, chunk):
+        """
+        Appends ``chunk`` (growing the buffer if needed) and walks any newly completed frames.
+        """
+        needed = self.size + len(chunk)
+        if needed > len(self.buffer):
+            self.buffer.extend(bytes(max(needed - len(self.buffer), len(self.buffer) // 2)))
+        self.buffer[self.size:needed] = chunk
+        self.size = needed
+
+        if self.start is None:
+            self.start = find_frame_start(self.buffer, self.audio_type, 0, self.size)
+            if self.start is None:
+                return
+            self.end = self.start
+
+        while True:
+            info = self._parse(self.buffer, self.end)
+            if info is None:
+                if self.end + 9 <= self.size:
+                    # lost sync (e.g. a glitch in the stream); resynchronise on the next frame
+                    resync = find_frame_start(self.buffer, self.audio_type, self.end + 1, self.size)
+                    if resync is None:
+                        return
+                    logger.debug(f'Resynchronised {self.audio_type} stream after {resync - self.end} bytes')
+                    # keep the capture contiguous by dropping what was collected before the glitch
+                    self.start = self.end = resync
+                    self.frames = self.samples = 0
+                    continue
+                return
+            frame_length, samples, sample_rate = info
+            if self.max_bytes is not None and self.end + frame_length - self.start > self.max_bytes:
+                self.full = True
+                return
+            if self.end + frame_length > self.size:
+                return
+            self.end += frame_length
+            self.frames += 1
+            self.samples += samples
+            self.sample_rate = sample_rate
+
+    def to_capture(self, station=None, started_at=None, title=None):
+        data = bytes(memoryview(self.buffer)[self.start:self.end]) if self.start is not None else b''
+        channels = frame_channels(data, 0, self.audio_type) if self.frames else None
+        return Capture(data, self.audio_type, self.duration, self.frames, self.sample_rate,
+                       channels=channels, station=station, started_at=started_at, title=title)
+
+
+def capture_stream(station_url, audio_type, seconds=6., max_bytes=None, station=None,
+                   session=None, read_size=READ_SIZE, timeout=(5, 10)):
+    """
+    Reads a stream into memory until it holds ``seconds`` of complete frames
+    or as many whole frames as fit in ``max_bytes``, whichever comes first,
+    then closes the connection.
+
+    :param station_url: stream URL
+    :param audio_type: ``'mp3'`` or ``'aac'`` (ADTS)
+    :param seconds: target duration, or ``None`` to stop on ``max_bytes`` only
+    :param max_bytes: optional byte budget
+    :param station: station name recorded on the capture
+    :param session: optional ``requests.Session`` to reuse connections
+    :param read_size: bytes per read
+    :param timeout: ``(connect, read)`` timeouts passed to requests
+    :return: :class:`Capture`
+    """
+    if seconds is None and max_bytes is None:
+        raise ValueError('capture_stream needs a target duration or a byte count')
+
+    if max_bytes is not None:
+        capacity = max_bytes
+    else:
+        capacity = int(DEFAULT_MAX_BITRATE / 8 * seconds) + read_size
+
+    accumulator = FrameAccumulator(audio_type, capacity, max_bytes=max_bytes)
+    started_at = time.time()
+    get = session.get if session is not None else requests.get
+    with get(station_url, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+        for chunk in r.iter_content(read_size):
+            accumulator.feed(chunk)
+            if seconds is not None and accumulator.duration >= seconds:
+                break
+            if accumulator.full:
+                break
+
+    capture = accumulator.to_capture(station=station, started_at=started_at)
+    logger.debug(f'Captured {capture}')
+    return capture
@@ -0,0 +1,264 @@
+"""
+Continuous analysis of many stations over streams that stay open.
+
+Instead of connecting every few minutes for a 6 s snippet, the engine keeps
+one connection and one ffmpeg decoder open per station and feeds the decoded
+PCM to a :class:`audio_characteristics.rolling.RollingAnalyzer`, which only
+processes the newest audio.  At a fixed interval the tempo windows completed
+by all stations since the last update are predicted in a single batch, and
+every station's current tempo, loudness and pitch are handed to a callback.
+The cost of an update therefore depends on the audio received in the
+interval, not on how long the streams have been open.
+
+A station whose stream fails is reconnected with exponential backoff; its
+analysis starts over on the new connection.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import random
+import time
+
+import aiohttp
+
+from audio_characteristics.decode import StreamDecoder
+from audio_characteristics.rolling import RollingAnalyzer
+from audio_characteristics.tempo import get_classifier
+from radio import metrics
+from radio.capture import READ_SIZE
+from radio.health import wait_until_allowed
+
+logger = logging.getLogger(__name__)
+
+# every stream is decoded to this rate, a multiple of tempo-cnn's 11025 Hz
+SAMPLE_RATE = 44100
+CHANNELS = 2
+
+
+async def feed_analyzer(response, audio_type, analyzer, executor, block_bytes, read_size=READ_SIZE, on_block=None):
+    """
+    Decodes a stream response and feeds its PCM to a :class:`RollingAnalyzer`
+    until the stream ends or the task is cancelled.
+
+    :param response: open ``aiohttp`` response of the stream
+    :param executor: runs ``analyzer.add`` off the event loop
+    :param block_bytes: bytes of float PCM handed to the analyzer at once
+    :param on_block: optional callable, called on the event loop after every block the analyzer took
+    """
+    loop = asyncio.get_running_loop()
+    async with StreamDecoder(audio_type, sr=SAMPLE_RATE, channels=CHANNELS) as decoder:
+
+        async def feed():
+            # ended on a read timeout too, or the decoder would wait for more audio forever
+            try:
+                async for chunk in response.content.iter_chunked(read_size):
+                    await decoder.write(chunk)
+            finally:
+                decoder.end()
+
+        feeding = asyncio.ensure_future(feed())
+        try:
+            while True:
+                pcm = await decoder.read(block_bytes)
+                if pcm is None:
+                    break
+                # one block at a time per station keeps its audio in order
+                await loop.run_in_executor(executor, analyzer.add, pcm)
+                if on_block is not None:
+                    on_block()
+            await feeding
+        finally:
+            feeding.cancel()
+
+
+class ContinuousEngine:
+    """
+    Follows stations continuously and reports their values at a fixed interval.
+    """
+
+    def __init__(self, interval=30., half_life=60., model_name='cnn', block_seconds=.5, connect_timeout=5.,
+                 read_timeout=10., initial_backoff=1., max_backoff=60., read_size=READ_SIZE, max_workers=None,
+                 health=None):
+        """
+        :param interval: seconds between two updates
+        :param half_life: see :class:`audio_characteristics.rolling.RollingAnalyzer`
+        :param model_name: tempo model, loaded in this process
+        :param block_seconds: seconds of PCM handed to a station's analyzer at once
+        :param connect_timeout: seconds to establish a connection
+        :param read_timeout: seconds allowed between two reads
+        :param initial_backoff: seconds before the first reconnect attempt
+        :param max_backoff: upper bound of the reconnect delay
+        :param max_workers: threads running the analyzers, see :class:`concurrent.futures.ThreadPoolExecutor`
+        :param health: optional :class:`radio.health.StationHealth`; a station whose circuit is
+            open isn't reconnected until it may be probed, see :func:`radio.health.wait_until_allowed`
+        """
+        self.interval = interval
+        self.half_life = half_life
+        self.model_name = model_name
+        self.block_bytes = int(block_seconds * SAMPLE_RATE) * CHANNELS * 4
+        self.timeout = aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout)
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.read_size = read_size
+        self.health = health
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='rolling')
+        # one thread runs the model, so predictions never run concurrently
+        self._model_executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='rolling-model')
+        self._analyzers = {}
+        self._loop = None
+        self._stopping = None
+        self._counts = {'connects': 0, 'failures': 0, 'updates': 0, 'windows': 0, 'published': 0}
+        self._last_update = {'seconds': 0., 'inference_seconds': 0., 'windows': 0}
+
+    async def _analyze_stream(self, station, response, audio_type):
+        analyzer = RollingAnalyzer(SAMPLE_RATE, CHANNELS, half_life=self.half_life, source=station)
+        self._analyzers[station] = analyzer
+        reported = False
+
+        def on_block():
+            # a station that answers and then sends nothing is not healthy, its first decoded block is the success
+            nonlocal reported
+            if not reported:
+                reported = True
+                self.health.record_success(station)
+
+        try:
+            await feed_analyzer(response, audio_type, analyzer, self._executor, self.block_bytes, self.read_size,
+                                on_block=on_block if self.health is not None else None)
+        finally:
+            if self._analyzers.get(station) is analyzer:
+                del self._analyzers[station]
+        raise ConnectionError('stream ended')
+
+    async def _follow(self, session, station, config):
+        backoff = self.initial_backoff
+        while not self._stopping.is_set():
+            if not await wait_until_allowed(self.health, station, self._stopping):
+                continue
+            connected_at = time.monotonic()
+            try:
+                async with session.get(config['stream_url']) as response:
+                    if self.health is not None:
+                        self.health.record_ttfb(station, time.monotonic() - connected_at)
+                    response.raise_for_status()
+                    self._counts['connects'] += 1
+                    await self._analyze_stream(station, response, config['audio_type'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._counts['failures'] += 1
+                metrics.count_failure('stream', station)
+                if self.health is not None:
+                    self.health.record_failure(station, e)
+                # a stream that ran for a while starts over with a short delay
+                if time.monotonic() - connected_at > self.max_backoff:
+                    backoff = self.initial_backoff
+                delay = backoff * random.uniform(.5, 1.)
+                logger.warning(f'Stream of {station} failed ({e!r}), reconnecting in {delay:.1f}s')
+                backoff = min(backoff * 2, self.max_backoff)
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def update(self, classifier, on_values):
+        """
+        Predicts the windows completed since the last update and reports every station's values.
+
+        :param on_values: callable taking the station name and its values
+        """
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        analyzers = list(self._analyzers.items())
+        pending = [(analyzer, analyzer.take_windows()) for _, analyzer in analyzers]
+        pending = [(analyzer, windows) for analyzer, windows in pending if windows is not None]
+        windows = sum(len(features) for _, features in pending)
+        inference_seconds = 0.
+        if pending:
+            # every window is its own tensor, so each is normalized by its own maximum
+            features = [window[None] for _, stacked in pending for window in stacked]
+            predictions = await loop.run_in_executor(self._model_executor, classifier.estimate_batch, features)
+            inference_seconds = time.perf_counter() - start
+            position = 0
+            for analyzer, stacked in pending:
+                analyzer.add_predictions([prediction[0] for prediction in predictions[position:position + len(stacked)]])
+                position += len(stacked)
+
+        for station, analyzer in analyzers:
+            values = analyzer.values(classifier)
+            if values is None:
+                continue
+            try:
+                on_values(station, values)
+                self._counts['published'] += 1
+            except Exception as e:
+                logger.error(f'Handling the values of {station} failed: {e!r}')
+        seconds = time.perf_counter() - start
+        self._counts['updates'] += 1
+        self._counts['windows'] += windows
+        self._last_update = {'seconds': seconds, 'inference_seconds': inference_seconds, 'windows': windows}
+        metrics.observe_stage('rolling_update', None, seconds)
+
+    async def _update_loop(self, classifier, on_values):
+        next_update = time.monotonic() + self.interval
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), max(0., next_update - time.monotonic()))
+                return
+            except asyncio.TimeoutError:
+                pass
+            next_update += self.interval
+            await self.update(classifier, on_values)
+
+    async def run(self, stations, on_values):
+        """
+        Follows ``stations`` until :meth:`stop` is called.
+
+        :param stations: dict of station name to ``{'stream_url', 'audio_type'}``
+        :param on_values: callable taking a station name and a dict of its
+            ``tempo``, ``loudness`` and ``pitch``, called every ``interval`` seconds
+        """
+        self._stopping = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        classifier = await self._loop.run_in_executor(self._model_executor, get_classifier, self.model_name)
+        connector = aiohttp.TCPConnector(limit=0, ttl_dns_cache=300)
+        async with aiohttp.ClientSession(connector=connector, timeout=self.timeout) as session:
+            followers = [asyncio.ensure_future(self._follow(session, station, config))
+                         for station, config in stations.items()]
+            try:
+                await self._update_loop(classifier, on_values)
+            finally:
+                for follower in followers:
+                    follower.cancel()
+                await asyncio.gather(*followers, return_exceptions=True)
+
+    def run_forever(self, stations, on_values):
+        """
+        Blocking wrapper around :meth:`run` for callers without an event loop.
+        """
+        try:
+            asyncio.run(self.run(stations, on_values))
+        finally:
+            self._executor.shutdown(wait=False)
+            self._model_executor.shutdown(wait=False)
+
+    def stop(self):
+        """
+        Stops :meth:`run`, from any thread.
+        """
+        if self._stopping is not None:
+            self._loop.call_soon_threadsafe(self._stopping.set)
+
+    def stats(self):
+        """
+        :return: dict with the number of open ``streams``, counts of
+            ``connects``, ``failures``, ``updates``, predicted ``windows`` and
+            ``published`` values, and the duration of the last update
+        """
+        return {
+            'streams': len(self._analyzers),
+            **self._counts,
+            'last_update_seconds': self._last_update['seconds'],
+            'last_inference_seconds': self._last_update['inference_seconds'],
+            'last_update_windows': self._last_update['windows'],
+        }
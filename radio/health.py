@@ -0,0 +1,196 @@
+"""
+Per-station health and circuit breaking.
+
+Every capture engine reports each connection attempt of a station here, and
+asks before connecting.  A station is ``healthy`` until it fails
+``failure_threshold`` times in a row; its circuit then opens and it is
+skipped entirely, costing no connection, decode or analysis, for a backoff
+that starts at ``initial_backoff`` seconds.  When the backoff has passed the
+circuit is half-open (``probing``): one attempt is let through.  If it
+succeeds the station is healthy again, if it fails the circuit opens again
+for twice as long, up to ``max_backoff``.
+
+The time to first byte, until the stream's response headers arrive, is kept
+per station as well, so that a slow station can be told from a dead one.
+Both are exposed by :meth:`StationHealth.stats` and as Prometheus metrics.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+
+from radio import metrics
+
+logger = logging.getLogger(__name__)
+
+HEALTHY, PROBING, OPEN = 'healthy', 'probing', 'open'
+STATES = (HEALTHY, PROBING, OPEN)
+
+# weight of the newest time to first byte in its moving average
+TTFB_SMOOTHING = .2
+
+
+class _Station:
+
+    def __init__(self):
+        self.state = HEALTHY
+        self.failures = 0
+        self.backoff = 0.
+        self.retry_at = 0.
+        self.probe_started = None
+        self.last_error = None
+        self.ttfb = None
+        self.last_ttfb = None
+        self.skipped = 0
+
+
+class StationHealth:
+    """
+    Consecutive failures, circuit state and time to first byte of every station.
+    """
+
+    def __init__(self, failure_threshold=3, initial_backoff=30., max_backoff=3600., probe_timeout=120.,
+                 clock=time.monotonic):
+        """
+        :param failure_threshold: consecutive failures that open a station's circuit
+        :param initial_backoff: seconds a circuit stays open the first time
+        :param max_backoff: upper bound of the doubling backoff
+        :param probe_timeout: seconds after which a probe that never reported is given up on and another is let through
+        :param clock: monotonic time source
+        """
+        self.failure_threshold = failure_threshold
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.probe_timeout = probe_timeout
+        self.clock = clock
+        self._stations = {}
+        self._lock = threading.Lock()
+
+    def _station(self, station):
+        health = self._stations.get(station)
+        if health is None:
+            health = self._stations[station] = _Station()
+        return health
+
+    def _set_state(self, station, health, state):
+        health.state = state
+        metrics.set_station_health(station, STATES.index(state), health.failures)
+
+    def allow(self, station):
+        """
+        Whether ``station`` may be connected to now.  A ``True`` for an open
+        circuit whose backoff has passed makes that attempt the probe, so the
+        caller must report its outcome.
+        """
+        now = self.clock()
+        with self._lock:
+            health = self._station(station)
+            if health.state == HEALTHY:
+                return True
+            if health.state == OPEN and now >= health.retry_at:
+                self._set_state(station, health, PROBING)
+                health.probe_started = now
+                return True
+            if health.state == PROBING and now - health.probe_started >= self.probe_timeout:
+                health.probe_started = now
+                return True
+            health.skipped += 1
+            return False
+
+    def retry_in(self, station):
+        """
+        Seconds until ``station`` may be tried again, 0 if it may be now.
+        """
+        with self._lock:
+            health = self._stations.get(station)
+            if health is None or health.state == HEALTHY:
+                return 0.
+            if health.state == PROBING:
+                return max(0., health.probe_started + self.probe_timeout - self.clock())
+            return max(0., health.retry_at - self.clock())
+
+    def record_ttfb(self, station, seconds):
+        """
+        Records the time a connection took to its first byte.
+        """
+        with self._lock:
+            health = self._station(station)
+            health.last_ttfb = seconds
+            health.ttfb = seconds if health.ttfb is None else health.ttfb + TTFB_SMOOTHING * (seconds - health.ttfb)
+        metrics.observe_ttfb(station, seconds)
+
+    def record_success(self, station):
+        with self._lock:
+            health = self._station(station)
+            recovered = health.state != HEALTHY
+            health.failures = 0
+            health.backoff = 0.
+            health.last_error = None
+            self._set_state(station, health, HEALTHY)
+        if recovered:
+            logger.info(f'{station} is healthy again')
+
+    def record_failure(self, station, error):
+        """
+        :param error: exception or message describing the failure
+        """
+        now = self.clock()
+        with self._lock:
+            health = self._station(station)
+            health.failures += 1
+            health.last_error = repr(error) if isinstance(error, BaseException) else str(error)
+            if health.state == PROBING:
+                health.backoff = min(health.backoff * 2, self.max_backoff)
+            elif health.failures >= self.failure_threshold:
+                health.backoff = self.initial_backoff
+            else:
+                metrics.set_station_health(station, STATES.index(health.state), health.failures)
+                return
+            # jitter keeps stations that failed together from probing together
+            delay = health.backoff * random.uniform(.8, 1.)
+            health.retry_at = now + delay
+            self._set_state(station, health, OPEN)
+        logger.warning(f'{station} failed {health.failures} times in a row ({health.last_error}), '
+                       f'skipping it for {delay:.0f}s')
+
+    def status(self, station):
+        """
+        :return: dict with the station's ``state``, ``consecutive_failures``, ``retry_in``
+            seconds, ``last_error``, ``ttfb`` (moving average) and ``last_ttfb`` in seconds,
+            and the attempts ``skipped`` while its circuit was open
+        """
+        with self._lock:
+            health = self._stations.get(station) or _Station()
+            state, failures, error = health.state, health.failures, health.last_error
+            ttfb, last_ttfb, skipped = health.ttfb, health.last_ttfb, health.skipped
+        return {'state': state, 'consecutive_failures': failures, 'retry_in': self.retry_in(station),
+                'last_error': error, 'ttfb': ttfb, 'last_ttfb': last_ttfb, 'skipped': skipped}
+
+    def stats(self):
+        """
+        :return: dict with the number of stations in each state and the ``stations``' :meth:`status`
+        """
+        with self._lock:
+            stations = list(self._stations)
+        statuses = {station: self.status(station) for station in stations}
+        counts = {state: sum(status['state'] == state for status in statuses.values()) for state in STATES}
+        return {**counts, 'stations': statuses}
+
+
+async def wait_until_allowed(health, station, stopping):
+    """
+    For engines that keep a connection per station open: asks ``health`` whether
+    ``station`` may be connected to, and if its circuit is open, waits until it may
+    be probed or ``stopping`` is set.
+
+    :param health: :class:`radio.health.StationHealth`, or ``None`` to always allow
+    :return: ``True`` if the station may be connected to now, ``False`` after waiting
+    """
+    if health is None or health.allow(station):
+        return True
+    try:
+        await asyncio.wait_for(stopping.wait(), max(health.retry_in(station), .1))
+    except asyncio.TimeoutError:
+        pass
+    return False
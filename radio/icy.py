@@ -0,0 +1,106 @@
+"""
+Shoutcast/Icecast in-stream metadata ("ICY").
+
+A client that sends ``Icy-MetaData: 1`` gets an ``icy-metaint`` header back,
+and the server then inserts a metadata block after every ``metaint`` bytes of
+audio: one byte giving the block's length in units of 16 bytes, followed by
+that many bytes of ``StreamTitle='Artist - Title';StreamUrl='...';`` padded
+with NULs.  Most servers only send a block when the metadata changed and a
+zero length byte otherwise.
+
+:class:`IcyDemuxer` splits such a stream back into audio and titles.  The
+audio is returned as views of the chunks it was given, so stripping the
+metadata doesn't copy the stream; only the metadata blocks themselves are
+collected.
+"""
+import re
+
+ICY_HEADERS = {'Icy-MetaData': '1'}
+
+_STREAM_TITLE = re.compile(rb"StreamTitle='(.*?)';", re.DOTALL)
+
+
+def parse_stream_title(block):
+    """
+    :param block: metadata block without its length byte, NUL padding allowed
+    :return: the ``StreamTitle``, stripped, or ``None`` if the block has none
+    """
+    match = _STREAM_TITLE.search(bytes(block).rstrip(b'\0'))
+    if match is None:
+        return None
+    raw = match.group(1)
+    try:
+        title = raw.decode('utf-8')
+    except UnicodeDecodeError:
+        # older servers send latin-1
+        title = raw.decode('latin-1')
+    return title.strip()
+
+
+def metaint_of(headers):
+    """
+    :param headers: response headers, case-insensitive
+    :return: the ``icy-metaint`` interval in bytes, or ``None`` if the server doesn't interleave metadata
+    """
+    try:
+        metaint = int(headers.get('icy-metaint', ''))
+    except ValueError:
+        return None
+    return metaint if metaint > 0 else None
+
+
+class IcyDemuxer:
+    """
+    Separates the audio of an ICY stream from its metadata blocks, chunk by chunk.
+    """
+
+    def __init__(self, metaint):
+        """
+        :param metaint: audio bytes between two metadata blocks, from :func:`metaint_of`
+        """
+        self.metaint = metaint
+        self.title = None
+        self.audio_bytes = 0
+        self._until_metadata = metaint
+        self._metadata = bytearray()
+        self._metadata_length = None  # bytes of the current block still to come
+
+    def feed(self, chunk):
+        """
+        :param chunk: bytes-like, as read from the stream
+        :return: ``(audio, titles)`` - list of memoryviews of ``chunk`` holding audio,
+            and the titles of the metadata blocks completed in it, in order
+        """
+        view = memoryview(chunk)
+        audio, titles = [], []
+        position = 0
+        while position < len(view):
+            if self._until_metadata:
+                end = min(len(view), position + self._until_metadata)
+                audio.append(view[position:end])
+                self._until_metadata -= end - position
+                self.audio_bytes += end - position
+                position = end
+            elif self._metadata_length is None:
+                self._metadata_length = view[position] * 16
+                position += 1
+                if self._metadata_length == 0:
+                    self._end_block(titles)
+            else:
+                end = min(len(view), position + self._metadata_length)
+                self._metadata += view[position:end]
+                self._metadata_length -= end - position
+                position = end
+                if self._metadata_length == 0:
+                    self._end_block(titles)
+        return audio, titles
+
+    def _end_block(self, titles):
+        if self._metadata:
+            title = parse_stream_title(self._metadata)
+            if title is not None:
+                self.title = title
+                titles.append(title)
+            self._metadata = bytearray()
+        self._metadata_length = None
+        self._until_metadata = self.metaint
@@ -0,0 +1,210 @@
+"""
+Asyncio capture engine for many concurrent station streams.
+
+All stations of a burst are captured concurrently on one event loop, up to a
+concurrency limit, over a shared connection pool with per-stream deadlines.
+The loop, the pool with its DNS cache and the concurrency limit belong to the
+engine and are shared by every burst, including bursts started at the same
+time from different threads.
+Every finished capture goes onto a bounded queue that the analysis stage
+drains in batches while the remaining stations are still being captured, so
+capture and analysis overlap instead of running one after the other.
+"""
+import asyncio
+import logging
+import time
+
+import aiohttp
+
+from radio import metrics
+from radio.capture import DEFAULT_MAX_BITRATE, READ_SIZE, FrameAccumulator
+from radio.icy import ICY_HEADERS, IcyDemuxer, metaint_of
+from radio.loop import EventLoopThread
+
+logger = logging.getLogger(__name__)
+
+
+class IngestEngine:
+    """
+    Captures bursts of snippets from many stations and feeds them to an analysis callable.
+    """
+
+    def __init__(self, seconds=6., max_concurrency=100, connection_limit=200, queue_size=64,
+                 analysis_batch_size=16, connect_timeout=5., read_timeout=10., stream_timeout=None,
+                 read_size=READ_SIZE, health=None):
+        """
+        :param seconds: duration of each capture
+        :param max_concurrency: streams read at the same time
+        :param connection_limit: open connections in the pool
+        :param queue_size: captures waiting for analysis before capturing pauses
+        :param analysis_batch_size: most captures handed to the analysis callable at once
+        :param connect_timeout: seconds to establish a connection
+        :param read_timeout: seconds allowed between two reads
+        :param stream_timeout: seconds for a whole capture, ``2 * seconds + connect_timeout`` by default
+        :param health: optional :class:`radio.health.StationHealth`; stations whose circuit is
+            open are skipped, and every capture's time to first byte and outcome is reported to it
+        """
+        self.seconds = seconds
+        self.max_concurrency = max_concurrency
+        self.connection_limit = connection_limit
+        self.queue_size = queue_size
+        self.analysis_batch_size = analysis_batch_size
+        self.timeout = aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout)
+        self.stream_timeout = stream_timeout or 2 * seconds + connect_timeout
+        self.read_size = read_size
+        self.health = health
+        # queues of the bursts currently running, for queue_depth
+        self._queues = set()
+        # run() runs every burst on this loop; the session and semaphore are created on it by the first burst
+        self._runner = EventLoopThread('ingest')
+        self._session = None
+        self._semaphore = None
+
+    @property
+    def queue_depth(self):
+        """
+        Captures waiting for analysis, over all running bursts.
+        """
+        return sum(queue.qsize() for queue in list(self._queues))
+
+    async def capture(self, session, station, station_url, audio_type):
+        """
+        Captures ``self.seconds`` of complete frames from one station, with
+        the track title if the stream sends ICY metadata.
+
+        :return: :class:`radio.capture.Capture`
+        """
+        accumulator = FrameAccumulator(audio_type, int(DEFAULT_MAX_BITRATE / 8 * self.seconds) + self.read_size)
+        started_at, start = time.time(), time.perf_counter()
+        demuxer = None
+        async with session.get(station_url, headers=ICY_HEADERS) as response:
+            if self.health is not None:
+                self.health.record_ttfb(station, time.perf_counter() - start)
+            response.raise_for_status()
+            metaint = metaint_of(response.headers)
+            if metaint is not None:
+                demuxer = IcyDemuxer(metaint)
+            async for chunk in response.content.iter_chunked(self.read_size):
+                if demuxer is None:
+                    accumulator.feed(chunk)
+                else:
+                    for audio in demuxer.feed(chunk)[0]:
+                        accumulator.feed(audio)
+                if accumulator.duration >= self.seconds:
+                    break
+        capture = accumulator.to_capture(station=station, started_at=started_at,
+                                         title=demuxer.title if demuxer is not None else None)
+        if not capture.frames:
+            raise ConnectionError('the stream ended without a complete audio frame')
+        metrics.observe_capture(station, len(capture), time.perf_counter() - start)
+        return capture
+
+    async def _produce(self, session, semaphore, queue, station, config, failures):
+        if self.health is not None and not self.health.allow(station):
+            logger.debug(f'Skipping {station}, its circuit is open')
+            return
+        async with semaphore:
+            try:
+                capture = await asyncio.wait_for(
+                    self.capture(session, station, config['stream_url'], config['audio_type']),
+                    self.stream_timeout)
+            except Exception as e:
+                failures[station] = e
+                metrics.count_failure('capture', station)
+                logger.warning(f'Capturing {station} failed: {e!r}')
+                if self.health is not None:
+                    self.health.record_failure(station, e)
+                return
+        if self.health is not None:
+            self.health.record_success(station)
+        await queue.put(capture)
+
+    async def _consume(self, queue, analyze, on_results, results):
+        loop = asyncio.get_running_loop()
+        while True:
+            capture = await queue.get()
+            if capture is None:
+                return
+            batch = [capture]
+            done = False
+            while len(batch) < self.analysis_batch_size and not queue.empty():
+                capture = queue.get_nowait()
+                if capture is None:
+                    done = True
+                    break
+                batch.append(capture)
+            # analysis blocks (e.g. waiting on the worker pool), keep it off the event loop
+            try:
+                analyzed = await loop.run_in_executor(None, analyze, batch)
+            except Exception as e:
+                # keep draining the queue, or the producers would wait on it forever
+                logger.error(f'Analysing {len(batch)} captures failed: {e!r}')
+                for capture in batch:
+                    metrics.count_failure('analysis', capture.station)
+                analyzed = [None] * len(batch)
+            pairs = list(zip(batch, analyzed))
+            results.extend(pairs)
+            if on_results is not None:
+                try:
+                    on_results(pairs)
+                except Exception as e:
+                    logger.error(f'Handling analysis results failed: {e!r}')
+            if done:
+                return
+
+    async def run_burst(self, stations, analyze, on_results=None):
+        """
+        Captures one snippet from every station and analyses them as they arrive.
+
+        :param stations: dict of station name to ``{'stream_url', 'audio_type'}``
+        :param analyze: callable taking a list of captures and returning a
+            list of results, e.g. :meth:`radio.workers.AnalysisPool.analyze`
+        :param on_results: optional callable receiving each analysed batch as
+            a list of ``(capture, result)`` pairs as soon as it is ready
+        :return: ``(results, failures)`` - all ``(capture, result)`` pairs and a
+            dict of station name to the exception that stopped its capture;
+            stations skipped for their health are in neither
+
+        Every burst of an engine must run on the same event loop, the one its
+        first burst ran on; :meth:`run` takes care of that.
+        """
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.connection_limit, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        queue = asyncio.Queue(self.queue_size)
+        self._queues.add(queue)
+        results, failures = [], {}
+        try:
+            consumer = asyncio.ensure_future(self._consume(queue, analyze, on_results, results))
+            await asyncio.gather(*(self._produce(self._session, self._semaphore, queue, station, config, failures)
+                                   for station, config in stations.items()))
+            await queue.put(None)
+            await consumer
+        finally:
+            self._queues.discard(queue)
+        return results, failures
+
+    def run(self, stations, analyze, on_results=None):
+        """
+        Blocking wrapper around :meth:`run_burst` for callers without an event
+        loop.  Bursts run from any number of threads share the engine's loop,
+        connections and ``max_concurrency``.
+        """
+        return self._runner.run(self.run_burst(stations, analyze, on_results))
+
+    async def aclose(self):
+        """
+        Closes the session of an engine whose bursts were awaited directly, on their loop.
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = self._semaphore = None
+
+    def close(self):
+        """
+        Closes the session and stops the loop :meth:`run` started.
+        """
+        if self._runner.running:
+            self._runner.run(self.aclose())
+            self._runner.stop()
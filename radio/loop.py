@@ -0,0 +1,60 @@
+"""
+An asyncio event loop on its own thread, shared by blocking callers.
+
+``asyncio.run`` starts a new event loop per call, so nothing bound to a loop
+- an aiohttp session with its connection pool and DNS cache, or a semaphore
+capping concurrent streams - can outlive the call.  An engine that keeps an
+:class:`EventLoopThread` instead runs every call on the same loop, however
+many threads call it, so such state lasts for the engine's lifetime.
+"""
+import asyncio
+import threading
+
+
+class EventLoopThread:
+    """
+    Event loop running on a daemon thread, started by the first :meth:`run`.
+    """
+
+    def __init__(self, name):
+        """
+        :param name: name of the thread
+        """
+        self.name = name
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._loop is not None
+
+    def _start(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=loop.run_forever, name=self.name, daemon=True)
+                self._thread.start()
+                self._loop = loop
+            return self._loop
+
+    def run(self, coroutine):
+        """
+        Runs ``coroutine`` on the loop and blocks until it is done, from any thread but the loop's own.
+
+        :return: its result
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self._start()).result()
+
+    def stop(self):
+        """
+        Stops the loop and waits for its thread.  A later :meth:`run` starts a new one.
+        """
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+        if loop is None:
+            return
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
@@ -0,0 +1,166 @@
+"""
+Prometheus metrics for the analysis daemon.
+
+Metrics are off until :func:`enable` is called; until then every function
+here returns after checking one global, so the hooks can stay in the hot
+path.  Capture and publishing are measured in this process.  Decoding and the
+analysis stages run in the worker processes, which time them with
+:mod:`audio_characteristics.timing` and send the timings back with their
+results, see :func:`record_worker_telemetry`.
+
+When a port is given the metrics are served over HTTP for Prometheus to scrape.
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+# capture sizes: 6 s is ~48 KiB at 64 kbit/s and ~240 KiB at 320 kbit/s
+BYTE_BUCKETS = tuple(2 ** 10 * kib for kib in (16, 32, 64, 96, 128, 192, 256, 384, 512))
+SECOND_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 7.5, 10., 15., 30.)
+
+_metrics = None
+
+
+class _Metrics:
+
+    def __init__(self, registry):
+        from prometheus_client import Counter, Gauge, Histogram
+
+        self.capture_bytes = Histogram(
+            'audio_capture_bytes', 'Bytes of complete frames per capture', ['station'],
+            buckets=BYTE_BUCKETS, registry=registry)
+        self.capture_seconds = Histogram(
+            'audio_capture_seconds', 'Wall time of a capture, from connecting to the last frame', ['station'],
+            buckets=SECOND_BUCKETS, registry=registry)
+        self.stage_seconds = Histogram(
+            'audio_analysis_stage_seconds', 'Time spent in an analysis stage per snippet', ['stage', 'station'],
+            buckets=SECOND_BUCKETS, registry=registry)
+        self.send_seconds = Histogram(
+            'audio_websocket_send_seconds', 'Time to send one message to the websocket server',
+            buckets=SECOND_BUCKETS, registry=registry)
+        self.failures = Counter(
+            'audio_failures', 'Failures by stage', ['stage', 'station'], registry=registry)
+        self.gate = Counter(
+            'audio_gate_snippets', 'Snippets checked by the silence/clipping/noise gate', ['status'],
+            registry=registry)
+        self.cache_hits = Counter(
+            'audio_result_cache_hits', 'Snippets answered from the result cache', registry=registry)
+        self.cache_misses = Counter(
+            'audio_result_cache_misses', 'Snippets not found in the result cache', registry=registry)
+        self.cache_seconds_saved = Counter(
+            'audio_result_cache_saved_seconds', 'Analysis time saved by the result cache', registry=registry)
+        self.model_load_seconds = Gauge(
+            'audio_model_load_seconds', 'Time a worker took to load a tempo model', ['model'], registry=registry)
+        self.model_rss_bytes = Gauge(
+            'audio_model_rss_bytes', 'Worker memory growth from loading a tempo model', ['model'], registry=registry)
+        self.queue_depth = Gauge(
+            'audio_queue_depth', 'Items waiting in a queue', ['queue'], registry=registry)
+        self.ttfb_seconds = Histogram(
+            'audio_stream_ttfb_seconds', 'Time from requesting a stream to its first byte', ['station'],
+            buckets=SECOND_BUCKETS, registry=registry)
+        self.station_health = Gauge(
+            'audio_station_health', 'Circuit state of a station: 0 healthy, 1 probing, 2 open', ['station'],
+            registry=registry)
+        self.station_failures = Gauge(
+            'audio_station_consecutive_failures', 'Failures of a station since its last success', ['station'],
+            registry=registry)
+
+
+def enable(port=None, addr='127.0.0.1', registry=None):
+    """
+    Turns metrics on and, if ``port`` is given, serves them over HTTP.
+
+    :param registry: ``prometheus_client`` registry, the default one if ``None``
+    """
+    global _metrics
+    if _metrics is not None:
+        return
+    from prometheus_client import REGISTRY, start_http_server
+
+    registry = registry or REGISTRY
+    _metrics = _Metrics(registry)
+    if port:
+        start_http_server(port, addr=addr, registry=registry)
+        logger.info(f'Serving metrics on http://{addr}:{port}/metrics')
+
+
+def enabled():
+    return _metrics is not None
+
+
+def observe_capture(station, size, seconds):
+    if _metrics is None:
+        return
+    _metrics.capture_bytes.labels(station).observe(size)
+    _metrics.capture_seconds.labels(station).observe(seconds)
+
+
+def observe_stage(stage, station, seconds):
+    if _metrics is None:
+        return
+    _metrics.stage_seconds.labels(stage, station or '').observe(seconds)
+
+
+def observe_send(seconds):
+    if _metrics is None:
+        return
+    _metrics.send_seconds.observe(seconds)
+
+
+def observe_ttfb(station, seconds):
+    if _metrics is None:
+        return
+    _metrics.ttfb_seconds.labels(station).observe(seconds)
+
+
+def set_station_health(station, state, failures):
+    """
+    :param state: index into :data:`radio.health.STATES`
+    """
+    if _metrics is None:
+        return
+    _metrics.station_health.labels(station).set(state)
+    _metrics.station_failures.labels(station).set(failures)
+
+
+def count_failure(stage, station=None):
+    if _metrics is None:
+        return
+    _metrics.failures.labels(stage, station or '').inc()
+
+
+def track_queue(queue, depth):
+    """
+    Reports a queue's depth, read when the metrics are scraped.
+
+    :param depth: callable returning the number of items waiting
+    """
+    if _metrics is None:
+        return
+    _metrics.queue_depth.labels(queue).set_function(depth)
+
+
+def record_worker_telemetry(telemetry):
+    """
+    Applies what an analysis worker measured, see :func:`radio.workers._analyze_chunk`.
+    """
+    if _metrics is None:
+        return
+    for stage, station, seconds in telemetry['stages']:
+        _metrics.stage_seconds.labels(stage, station or '').observe(seconds)
+    for stage, station in telemetry['failures']:
+        _metrics.failures.labels(stage, station or '').inc()
+    for counter, delta in telemetry['counters'].items():
+        if not delta:
+            continue
+        if counter.startswith('gate_'):
+            _metrics.gate.labels(counter[len('gate_'):]).inc(delta)
+        elif counter == 'cache_hits':
+            _metrics.cache_hits.inc(delta)
+        elif counter == 'cache_misses':
+            _metrics.cache_misses.inc(delta)
+        elif counter == 'cache_seconds_saved':
+            _metrics.cache_seconds_saved.inc(delta)
+    for model, stats in telemetry['models'].items():
+        _metrics.model_load_seconds.labels(model).set(stats['load_seconds'])
+        _metrics.model_rss_bytes.labels(model).set(stats['rss_bytes'])
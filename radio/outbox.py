@@ -0,0 +1,534 @@
+"""
+Disk-backed outbox for analysis results.
+
+Every result is appended to a local journal before it is published, so
+results made while the websocket server is unreachable are kept and sent once
+it is back, and the daemon can answer questions about recent values itself.
+
+The journal is a directory of append-only segment files of JSON lines, each
+named after the sequence number of its first record.  Appending only puts the
+record on an in-memory list; a writer thread writes what has accumulated in
+one batch and fsyncs it according to the configured policy.  A flusher thread
+reads the journal through memory maps from the first record not yet sent and
+hands records to the publisher, keeping a few messages in flight, so a backlog
+after an outage is replayed as fast as the connection allows.  The sequence
+number of the last sent record is saved in a cursor file; records are
+delivered at least once.  A write or read that fails, e.g. on a full disk, is
+retried with backoff, and a line that isn't a record is skipped and logged.
+
+Segments whose records have all been sent are deleted once they are older
+than the retention period, or earlier when the journal outgrows its size cap.
+"""
+import bisect
+import collections
+import json
+import logging
+import mmap
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = '.log'
+CURSOR_FILE = 'cursor'
+
+FSYNC_POLICIES = ('batch', 'interval', 'none')
+
+# seconds between two compactions
+COMPACT_INTERVAL = 60.
+
+# seconds before writing or reading the journal is tried again after an error, doubling up to the maximum
+RETRY_DELAY = .5
+MAX_RETRY_DELAY = 30.
+
+# fields every journaled record has
+RECORD_KEYS = frozenset(('seq', 'ts', 'station', 'audio_values'))
+
+
+class _Segment:
+
+    def __init__(self, path, first_seq):
+        self.path = path
+        self.first_seq = first_seq
+        self.last_seq = first_seq - 1
+        self.last_ts = None
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+        # offsets of lines that aren't records, each logged once
+        self.unreadable = set()
+        self._map = None
+
+    def read_from(self, offset):
+        """
+        Records from byte ``offset`` to the last complete line.
+
+        :return: list of ``(end offset, record)``, with ``None`` for a line that isn't a record
+        """
+        if self.size <= offset:
+            return []
+        if self._map is None or len(self._map) < self.size:
+            self.close()
+            with open(self.path, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        records = []
+        while offset < self.size:
+            end = self._map.find(b'\n', offset, self.size)
+            if end < 0:
+                break
+            try:
+                record = json.loads(self._map[offset:end])
+            except ValueError:
+                record = None
+            if not isinstance(record, dict) or not RECORD_KEYS <= record.keys():
+                record = None
+                if offset not in self.unreadable:
+                    self.unreadable.add(offset)
+                    logger.warning(f'Skipping the unreadable line at byte {offset} of {self.path}')
+            records.append((end + 1, record))
+            offset = end + 1
+        return records
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+class Outbox:
+    """
+    Append-only journal of ``audio_values`` records that delivers them through
+    a :class:`radio.publisher.WebSocketPublisher`.
+    """
+
+    def __init__(self, directory, publisher=None, batched=False, fsync='interval', fsync_interval=1.,
+                 flush_interval=.1, segment_bytes=8 * 2 ** 20, retention=24 * 3600., max_bytes=2 ** 30,
+                 max_batch=200, max_in_flight=4, history_size=500):
+        """
+        :param directory: where the segments and the cursor are kept
+        :param publisher: publisher the records are sent through, or ``None`` to only journal them
+        :param batched: send records as ``audio_values_batch`` messages of up to
+            ``max_batch`` records instead of one ``audio_values`` message each
+        :param fsync: ``batch`` to fsync every written batch, ``interval`` to fsync
+            at most every ``fsync_interval`` seconds, ``none`` to leave it to the OS
+        :param flush_interval: seconds the writer waits to gather a batch
+        :param segment_bytes: size at which a new segment is started
+        :param retention: seconds sent records are kept for :meth:`history`
+        :param max_bytes: size of the journal beyond which the oldest segments
+            are deleted, even if not all their records were sent
+        :param max_in_flight: messages handed to the publisher and not yet sent
+        :param history_size: records per station kept in memory for :meth:`history`
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f'fsync must be one of {FSYNC_POLICIES}, got {fsync!r}')
+        self.directory = directory
+        self.publisher = publisher
+        self.batched = batched
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.flush_interval = flush_interval
+        self.segment_bytes = segment_bytes
+        self.retention = retention
+        self.max_bytes = max_bytes
+        self.max_batch = max_batch
+        self.max_in_flight = max_in_flight
+
+        self._lock = threading.Lock()
+        self._pending = []
+        self._written = threading.Condition(self._lock)
+        self._in_flight = threading.Semaphore(max_in_flight)
+        self._stopping = threading.Event()
+        self._threads = []
+        self._history = collections.defaultdict(lambda: collections.deque(maxlen=history_size))
+        self._counts = {'appended': 0, 'written': 0, 'sent': 0, 'dropped': 0, 'fsyncs': 0,
+                        'write_errors': 0, 'read_errors': 0}
+
+        os.makedirs(directory, exist_ok=True)
+        self._segments = self._open_segments()
+        self._file = open(self._segments[-1].path, 'ab')
+        self._last_fsync = time.monotonic()
+        self._dirty = False
+        self._next_seq = self._segments[-1].last_seq + 1
+        self._sent_seq = self._read_cursor()
+        self._saved_seq = self._sent_seq
+        # the flusher's read position: the segment by its first sequence number, which compaction
+        # doesn't change, and a byte offset in it; a dropped message rewinds it to _rewind_seq
+        self._read_first_seq, self._read_offset = self._locate(self._sent_seq + 1)
+        self._rewind_seq = None
+        # the last record handed to the publisher; a message counts as sent once the one before it was
+        self._handed_seq = self._sent_seq
+
+    # recovery
+
+    def _open_segments(self):
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+        segments = [_Segment(os.path.join(self.directory, name), int(name[:-len(SEGMENT_SUFFIX)]))
+                    for name in names]
+        if not segments:
+            segments = [_Segment(self._segment_path(1), 1)]
+            open(segments[0].path, 'ab').close()
+        cutoff = time.time() - self.retention
+        for segment in segments:
+            self._truncate_torn_write(segment)
+            for _, record in segment.read_from(0):
+                if record is None:
+                    continue
+                segment.last_seq, segment.last_ts = record['seq'], record['ts']
+                if record['ts'] >= cutoff:
+                    self._history[record['station']].append((record['ts'], record['audio_values']))
+        return segments
+
+    def _truncate_torn_write(self, segment):
+        # a crash can leave half a line at the end of the last segment
+        if segment.size == 0:
+            return
+        with open(segment.path, 'rb+') as f:
+            f.seek(max(0, segment.size - 2 ** 20))
+            tail = f.read()
+            end = tail.rfind(b'\n') + 1
+            complete = segment.size - len(tail) + end
+            if complete < segment.size:
+                logger.warning(f'Dropping {segment.size - complete} bytes of an incomplete record in {segment.path}')
+                f.truncate(complete)
+                segment.size = complete
+
+    def _segment_path(self, first_seq):
+        return os.path.join(self.directory, f'{first_seq:016d}{SEGMENT_SUFFIX}')
+
+    def _read_cursor(self):
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE)) as f:
+                return json.load(f)['seq']
+        except FileNotFoundError:
+            return 0
+
+    def _save_cursor(self, seq):
+        path = os.path.join(self.directory, CURSOR_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'seq': seq}, f)
+        os.replace(path + '.tmp', path)
+        self._saved_seq = seq
+
+    def _segment_index(self, first_seq):
+        """
+        :return: index of the segment holding sequence number ``first_seq``, the first one if it was deleted
+        """
+        return max(0, bisect.bisect_right([segment.first_seq for segment in self._segments], first_seq) - 1)
+
+    def _locate(self, seq):
+        """
+        :return: ``(first sequence number of the segment, byte offset)`` of record ``seq``,
+            or of the end of the journal
+        """
+        segment = self._segments[self._segment_index(seq)]
+        offset = 0
+        for end, record in segment.read_from(0):
+            if record is not None and record['seq'] >= seq:
+                break
+            offset = end
+        return segment.first_seq, offset
+
+    # writing
+
+    def append(self, audio_values):
+        """
+        Adds a result to the journal and returns immediately.
+
+        :param audio_values: dict of audio characteristics including the station
+        """
+        with self._lock:
+            record = {'seq': self._next_seq, 'ts': time.time(), 'station': audio_values.get('station', ''),
+                      'audio_values': audio_values}
+            self._next_seq += 1
+            self._pending.append(record)
+            self._counts['appended'] += 1
+            self._history[record['station']].append((record['ts'], audio_values))
+
+    def _write_loop(self):
+        next_compaction = time.monotonic() + COMPACT_INTERVAL
+        delay = self.flush_interval
+        while True:
+            stopping = self._stopping.wait(delay)
+            with self._lock:
+                batch, self._pending = self._pending, []
+            try:
+                if batch:
+                    self._write(batch)
+                    batch = []
+                if self._dirty and (self.fsync == 'batch' or time.monotonic() - self._last_fsync >= self.fsync_interval):
+                    self._sync()
+                if self._segments[-1].size >= self.segment_bytes:
+                    with self._lock:
+                        self._roll()
+                if not stopping and time.monotonic() >= next_compaction:
+                    next_compaction = time.monotonic() + COMPACT_INTERVAL
+                    self.compact()
+                delay = self.flush_interval
+            except Exception as e:
+                # the batch goes back ahead of what was appended since, and is written on the next attempt
+                with self._lock:
+                    self._pending[:0] = batch
+                    self._counts['write_errors'] += 1
+                delay = min(max(delay * 2, RETRY_DELAY), MAX_RETRY_DELAY)
+                if stopping:
+                    logger.error(f'Writing the journal failed on stopping, {len(self._pending)} records are lost: {e!r}')
+                else:
+                    logger.error(f'Writing the journal failed, retrying in {delay:.1f}s: {e!r}')
+            if stopping:
+                return
+
+    def _write(self, batch):
+        data = b''.join(json.dumps(record, separators=(',', ':')).encode() + b'\n' for record in batch)
+        try:
+            self._file.write(data)
+            self._file.flush()
+        except Exception:
+            self._reopen()
+            raise
+        self._dirty = self.fsync != 'none'
+        with self._lock:
+            segment = self._segments[-1]
+            segment.size += len(data)
+            segment.last_seq, segment.last_ts = batch[-1]['seq'], batch[-1]['ts']
+            self._counts['written'] += len(batch)
+            self._written.notify_all()
+
+    def _reopen(self):
+        # a failed write can leave part of the batch in the file, cut it off so that the retry doesn't tear a line
+        try:
+            self._file.close()
+        except OSError:
+            pass
+        segment = self._segments[-1]
+        self._file = open(segment.path, 'ab')
+        self._file.truncate(segment.size)
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._last_fsync = time.monotonic()
+        self._dirty = False
+        self._counts['fsyncs'] += 1
+
+    def _roll(self):
+        if self._dirty:
+            self._sync()
+        first_seq = self._segments[-1].last_seq + 1
+        path = self._segment_path(first_seq)
+        file = open(path, 'ab')
+        self._file.close()
+        self._file = file
+        self._segments.append(_Segment(path, first_seq))
+
+    # delivery
+
+    def _flush_loop(self):
+        delay = RETRY_DELAY
+        while not self._stopping.is_set():
+            try:
+                self._flush()
+                delay = RETRY_DELAY
+            except Exception as e:
+                # what was read and not handed over is read again
+                with self._lock:
+                    self._counts['read_errors'] += 1
+                    self._rewind(self._handed_seq + 1)
+                logger.error(f'Reading the journal failed, retrying in {delay:.1f}s: {e!r}')
+                if self._stopping.wait(delay):
+                    return
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+
+    def _flush(self):
+        with self._lock:
+            written = self._counts['written']
+        records = self._read_unsent()
+        if not records:
+            self._maybe_save_cursor()
+            with self._lock:
+                if self._counts['written'] == written:
+                    self._written.wait(1.)
+            return
+        step = self.max_batch if self.batched else 1
+        for start in range(0, len(records), step):
+            chunk = records[start:start + step]
+            while not self._in_flight.acquire(timeout=.5):
+                if self._stopping.is_set():
+                    return
+            if self._rewind_seq is not None:
+                # a message was dropped, the rest is read again from its first record
+                self._in_flight.release()
+                break
+            try:
+                if self.batched:
+                    message = json.dumps({'audio_values_batch': [record['audio_values'] for record in chunk]})
+                else:
+                    message = json.dumps({'audio_values': chunk[0]['audio_values']})
+            except Exception:
+                self._in_flight.release()
+                raise
+            first, last = chunk[0]['seq'], chunk[-1]['seq']
+            with self._lock:
+                previous, self._handed_seq = self._handed_seq, last
+            self.publisher.publish_message(
+                message, on_sent=lambda previous=previous, last=last, n=len(chunk): self._sent(previous, last, n),
+                on_dropped=lambda first=first: self._dropped(first))
+        self._maybe_save_cursor()
+
+    def _read_unsent(self):
+        """
+        Reads up to a few batches of written records after the last one handed to the publisher.
+        """
+        limit = self.max_batch * self.max_in_flight
+        records = []
+        with self._lock:
+            if self._rewind_seq is not None:
+                self._read_first_seq, self._read_offset = self._locate(self._rewind_seq)
+                self._handed_seq = self._rewind_seq - 1
+                self._rewind_seq = None
+        while len(records) < limit:
+            # compaction never deletes the segment being read, but renumbers the list
+            with self._lock:
+                index = self._segment_index(self._read_first_seq)
+                segment, is_last = self._segments[index], index == len(self._segments) - 1
+                if segment.first_seq != self._read_first_seq:
+                    self._read_first_seq, self._read_offset = segment.first_seq, 0
+                offset = self._read_offset
+            for end, record in segment.read_from(offset)[:limit - len(records)]:
+                if record is not None:
+                    records.append(record)
+                offset = end
+            with self._lock:
+                self._read_offset = offset
+                if len(records) >= limit or is_last:
+                    break
+                if offset >= segment.size:
+                    self._read_first_seq, self._read_offset = self._segments[index + 1].first_seq, 0
+        return records
+
+    def _sent(self, previous, last, records):
+        with self._lock:
+            # messages go out in order, so anything after a gap left by a dropped message
+            # was sent before it, and is sent again once the flusher has rewound
+            if previous <= self._sent_seq:
+                self._sent_seq = max(self._sent_seq, last)
+            self._counts['sent'] += records
+        self._in_flight.release()
+
+    def _dropped(self, first):
+        with self._lock:
+            # a message handed over before a rewind holds records the flusher hands over again anyway
+            again = first > self._handed_seq or (self._rewind_seq is not None and self._rewind_seq <= first)
+            if not again:
+                self._sent_seq = min(self._sent_seq, first - 1)
+                self._rewind(first)
+        if not again:
+            logger.warning(f'The publisher dropped records from {first} on, sending them again')
+        self._in_flight.release()
+
+    def _rewind(self, seq):
+        self._rewind_seq = seq if self._rewind_seq is None else min(self._rewind_seq, seq)
+
+    def _maybe_save_cursor(self):
+        if self._sent_seq != self._saved_seq:
+            self._save_cursor(self._sent_seq)
+
+    # maintenance
+
+    def compact(self):
+        """
+        Deletes segments that are fully sent and past the retention period, and
+        the oldest segments while the journal is larger than ``max_bytes``.
+        Without a publisher, records count as sent once written.
+        """
+        cutoff = time.time() - self.retention
+        with self._lock:
+            sent_seq = self._sent_seq if self.publisher is not None else self._segments[-1].last_seq
+            total = sum(segment.size for segment in self._segments)
+            # never the segment being written, nor the one being read or rewound to
+            last = len(self._segments) - 1
+            if self.publisher is not None:
+                reading = self._read_first_seq if self._rewind_seq is None else min(self._read_first_seq, self._rewind_seq)
+                last = min(last, self._segment_index(reading))
+            removable = 0
+            while removable < last:
+                segment = self._segments[removable]
+                expired = segment.last_seq <= sent_seq and (segment.last_ts or 0) < cutoff
+                if not expired and total <= self.max_bytes:
+                    break
+                if segment.last_seq > sent_seq:
+                    dropped = segment.last_seq - max(sent_seq, segment.first_seq - 1)
+                    self._counts['dropped'] += dropped
+                    logger.warning(f'Journal over {self.max_bytes} bytes, dropped {dropped} unsent records')
+                total -= segment.size
+                removable += 1
+            removed, self._segments = self._segments[:removable], self._segments[removable:]
+        for segment in removed:
+            segment.close()
+            os.remove(segment.path)
+
+    # queries
+
+    def history(self, station, since=None, limit=None):
+        """
+        Recent results of a station, oldest first.
+
+        :param since: only results appended at or after this Unix time
+        :param limit: at most this many of the newest results
+        :return: list of ``(timestamp, audio_values)``
+        """
+        with self._lock:
+            records = list(self._history.get(station, ()))
+        if since is not None:
+            records = records[bisect.bisect_left([ts for ts, _ in records], since):]
+        return records[-limit:] if limit else records
+
+    def stats(self):
+        """
+        :return: dict with ``appended``, ``written``, ``sent``, ``dropped`` and
+            ``fsyncs`` counts, ``write_errors`` and ``read_errors`` retried,
+            ``unreadable`` lines skipped, ``backlog`` (records appended but not
+            yet sent), ``segments`` and ``bytes``
+        """
+        with self._lock:
+            return {
+                **self._counts,
+                'unreadable': sum(len(segment.unreadable) for segment in self._segments),
+                'backlog': self._next_seq - 1 - self._sent_seq,
+                'segments': len(self._segments),
+                'bytes': sum(segment.size for segment in self._segments),
+            }
+
+    # lifecycle
+
+    def start(self):
+        self._threads = [threading.Thread(target=self._write_loop, name='outbox-writer', daemon=True)]
+        if self.publisher is not None:
+            self._threads.append(threading.Thread(target=self._flush_loop, name='outbox-flusher', daemon=True))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self, timeout=5.):
+        """
+        Writes and fsyncs what is pending, saves the cursor and closes the journal.
+        Records not yet sent stay in the journal for the next start.
+        """
+        self._stopping.set()
+        with self._lock:
+            self._written.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        try:
+            if self._dirty:
+                self._sync()
+            self._file.close()
+            self._maybe_save_cursor()
+        except OSError as e:
+            logger.error(f'Closing the journal failed: {e!r}')
+        for segment in self._segments:
+            segment.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
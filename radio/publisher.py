@@ -0,0 +1,234 @@
+"""
+Long-lived WebSocket publisher for analysis results.
+
+A background thread owns one connection to the websocket server and sends
+whatever is put on a bounded queue, reconnecting with exponential backoff when
+the connection drops.  Publishing never blocks the caller: when the queue is
+full the oldest message is dropped and counted.
+"""
+import collections
+import json
+import logging
+import queue
+import random
+import select
+import threading
+import time
+
+import websocket
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class WebSocketPublisher:
+    """
+    Sends JSON messages over a single persistent WebSocket connection.
+
+    Results are sent as ``{'audio_values': {...}}``, the format the server
+    already accepts; a burst published with :meth:`publish_batch` goes out as
+    one ``{'audio_values_batch': [{...}, ...]}`` message.
+    """
+
+    def __init__(self, url, max_queue=1000, connect_timeout=10., initial_backoff=0.5, max_backoff=30.,
+                 latency_window=1000):
+        """
+        :param url: websocket server URL
+        :param max_queue: messages held while the server is slow or unreachable
+        :param connect_timeout: seconds allowed for connecting and for each send
+        :param initial_backoff: seconds before the first reconnect attempt
+        :param max_backoff: upper bound of the reconnect delay
+        :param latency_window: number of recent send latencies kept for :meth:`stats`
+        """
+        self.url = url
+        self.connect_timeout = connect_timeout
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self._queue = queue.Queue(max_queue)
+        self._ws = None
+        self._thread = None
+        # set by stop() so a reconnect backoff gives up instead of waiting out its delay
+        self._stopping = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=latency_window)
+        self._sent = 0
+        self._dropped = 0
+        self._connects = 0
+        self._failures = 0
+        # called with each send latency in seconds, e.g. to feed a metrics histogram
+        self.on_send = None
+        # called with the exception of each failed connect or send
+        self.on_failure = None
+
+    def start(self):
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='websocket-publisher', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=5.):
+        """
+        Sends what is already queued (for up to ``timeout`` seconds) and closes the connection.
+
+        Messages still queued when the server is unreachable are given up
+        rather than retried.
+        """
+        if self._thread is None:
+            return
+        self._put(_STOP)
+        self._stopping.set()
+        self._thread.join(timeout)
+        self._thread = None
+        self._close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def publish(self, audio_values):
+        """
+        Queues one result for sending and returns immediately.
+
+        :param audio_values: dict of audio characteristics including the station
+        """
+        self._put(json.dumps({'audio_values': audio_values}))
+
+    def publish_batch(self, audio_values_list):
+        """
+        Queues the results of one burst as a single message and returns immediately.
+
+        :param audio_values_list: list of audio characteristics dicts
+        """
+        if audio_values_list:
+            self._put(json.dumps({'audio_values_batch': list(audio_values_list)}))
+
+    def publish_message(self, message, on_sent=None, on_dropped=None):
+        """
+        Queues an already encoded message (``str`` or ``bytes``) and returns immediately.
+
+        :param on_sent: optional callable run on the publisher thread once the
+            message has been sent; it is not run if the message is dropped
+        :param on_dropped: optional callable run if the message is dropped from a
+            full queue instead, on the thread publishing the message that pushed it out
+        """
+        self._put(message, on_sent, on_dropped)
+
+    def _put(self, message, on_sent=None, on_dropped=None):
+        while True:
+            try:
+                self._queue.put_nowait((message, on_sent, on_dropped))
+                return
+            except queue.Full:
+                try:
+                    _, _, dropped = self._queue.get_nowait()
+                except queue.Empty:
+                    continue
+                with self._stats_lock:
+                    self._dropped += 1
+                logger.warning('Publisher queue full, dropped the oldest message')
+                if dropped is not None:
+                    dropped()
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    @property
+    def connected(self):
+        return self._ws is not None and self._ws.connected
+
+    def stats(self):
+        """
+        Counters and recent send latencies.
+
+        :return: dict with ``queue_depth``, ``sent``, ``dropped``, ``connects``,
+            ``failures`` and ``latency_p50``/``latency_p99``/``latency_max`` in seconds
+        """
+        with self._stats_lock:
+            latencies = sorted(self._latencies)
+            stats = {
+                'queue_depth': self.queue_depth,
+                'connected': self.connected,
+                'sent': self._sent,
+                'dropped': self._dropped,
+                'connects': self._connects,
+                'failures': self._failures,
+            }
+        for name, fraction in (('latency_p50', .5), ('latency_p99', .99), ('latency_max', 1.)):
+            stats[name] = latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] if latencies else None
+        return stats
+
+    def _run(self):
+        backoff = self.initial_backoff
+        message = None
+        while True:
+            if message is None:
+                message, on_sent, _ = self._queue.get()
+                if message is _STOP:
+                    return
+            try:
+                if not self.connected:
+                    self._connect()
+                start = time.perf_counter()
+                self._ws.send(message)
+                latency = time.perf_counter() - start
+            except Exception as e:
+                with self._stats_lock:
+                    self._failures += 1
+                if self.on_failure is not None:
+                    self.on_failure(e)
+                self._close()
+                # keep the message and retry it once reconnected; jitter avoids reconnect stampedes
+                delay = backoff * random.uniform(.5, 1.)
+                if self._stopping.is_set():
+                    logger.warning(f'WebSocket send to {self.url} failed ({e}) while stopping, giving up on the queue')
+                    return
+                logger.warning(f'WebSocket send to {self.url} failed ({e}), retrying in {delay:.1f}s')
+                if self._stopping.wait(delay):
+                    return
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+
+            backoff = self.initial_backoff
+            message = None
+            with self._stats_lock:
+                self._sent += 1
+                self._latencies.append(latency)
+            if on_sent is not None:
+                on_sent()
+            if self.on_send is not None:
+                self.on_send(latency)
+            # outside the retry above: the message is sent, a broken read must not send it again
+            try:
+                self._drain_replies()
+            except Exception as e:
+                with self._stats_lock:
+                    self._failures += 1
+                if self.on_failure is not None:
+                    self.on_failure(e)
+                logger.warning(f'Reading replies from {self.url} failed ({e}), reconnecting for the next message')
+                self._close()
+
+    def _connect(self):
+        self._ws = websocket.create_connection(self.url, timeout=self.connect_timeout)
+        with self._stats_lock:
+            self._connects += 1
+        logger.info(f'Connected to {self.url}')
+
+    def _drain_replies(self):
+        # the server acknowledges messages; read whatever has arrived without waiting for it
+        sock = self._ws.sock
+        while sock is not None and select.select([sock], [], [], 0)[0]:
+            self._ws.recv()
+
+    def _close(self):
+        if self._ws is not None:
+            try:
+                self._ws.close()
+            except Exception:
+                pass
+            self._ws = None
@@ -0,0 +1,387 @@
+"""
+Config-driven scheduler that spreads station analyses across their interval.
+
+Each station in the config has a cadence (seconds between the starts of two
+cycles) and a burst pattern (offsets of the analyses within a cycle, e.g.
+four analyses 20 seconds apart).  Rather than starting every station at the
+same second, the stations' cycles are offset from one another, evenly across
+the cadence or at random, and every tick can be delayed by a random jitter.
+
+Ticks are kept on a heap and the loop sleeps until exactly the next one is
+due.  Ticks due within ``coalesce`` seconds of each other are handed to the
+job together.  A station whose previous analysis is still running has its
+tick skipped, or postponed until it is free, so work never piles up.
+
+    python -m radio.scheduler --simulate --stations 400 --work-seconds 9
+"""
+import argparse
+import heapq
+import json
+import logging
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = 'stations.json'
+
+DEFAULTS = {
+    'cadence': 360,
+    'burst': [0],
+    'spread': 'even',
+    'jitter': 0,
+    'enabled': True,
+}
+
+SPREADS = ('even', 'random', 'aligned')
+OVERLAP_POLICIES = ('skip', 'postpone')
+
+
+def load_station_config(path=DEFAULT_CONFIG):
+    """
+    Reads the stations config file.
+
+    :param path: JSON file with optional ``defaults`` and a ``stations`` dict of
+        station name to ``stream_url``, ``audio_type`` and any setting to override
+    :return: dict of station name to its settings with the defaults filled in
+    """
+    with open(path) as f:
+        config = json.load(f)
+    return resolve_stations(config.get('stations', {}), config.get('defaults'))
+
+
+def resolve_stations(stations, defaults=None):
+    """
+    Fills in default settings and checks them.
+
+    :return: dict of station name to settings, in config order
+    """
+    defaults = {**DEFAULTS, **(defaults or {})}
+    resolved = {}
+    for name, settings in stations.items():
+        settings = {**defaults, **settings}
+        if settings['cadence'] <= 0:
+            raise ValueError(f"Station {name}: cadence must be positive, got {settings['cadence']}")
+        if not settings['burst'] or min(settings['burst']) < 0:
+            raise ValueError(f"Station {name}: burst must be a non-empty list of offsets >= 0")
+        if settings['spread'] not in SPREADS:
+            raise ValueError(f"Station {name}: spread must be one of {SPREADS}, got {settings['spread']!r}")
+        settings['burst'] = sorted(settings['burst'])
+        resolved[name] = settings
+    return resolved
+
+
+def station_offsets(stations):
+    """
+    Offset of every enabled station's cycle within its cadence.
+
+    An explicit ``offset`` setting wins.  Otherwise ``even`` spreads the
+    stations that share a cadence evenly across it, ``random`` picks a fixed
+    random offset per station and ``aligned`` starts every station at 0.
+    """
+    enabled = [name for name, settings in stations.items() if settings['enabled']]
+    by_cadence = {}
+    for name in enabled:
+        by_cadence.setdefault(stations[name]['cadence'], []).append(name)
+
+    offsets = {}
+    for cadence, names in by_cadence.items():
+        for i, name in enumerate(names):
+            settings = stations[name]
+            if 'offset' in settings:
+                offset = settings['offset']
+            elif settings['spread'] == 'even':
+                offset = i * cadence / len(names)
+            elif settings['spread'] == 'random':
+                # seeded by the name, so a station keeps its slot across restarts
+                offset = random.Random(name).uniform(0, cadence)
+            else:
+                offset = 0.
+            offsets[name] = offset % cadence
+    return offsets
+
+
+def next_tick(settings, offset, after):
+    """
+    First burst time of a station strictly after ``after``.
+
+    Cycles are anchored to the epoch, so a station's slots stay put across restarts.
+    """
+    cadence = settings['cadence']
+    cycle = math.floor((after - offset) / cadence) * cadence + offset
+    # a long burst can run past the cadence into the next cycle, so its ticks interleave with that cycle's
+    first = cycle - cadence * math.ceil(settings['burst'][-1] / cadence)
+    tick = None
+    while tick is None or first < tick:
+        for delay in settings['burst']:
+            if first + delay > after:
+                tick = first + delay if tick is None else min(tick, first + delay)
+                break
+        first += cadence
+    return tick
+
+
+class Scheduler:
+    """
+    Runs a job for every station at its scheduled times.
+    """
+
+    def __init__(self, job, stations, coalesce=1., overlap='skip', max_workers=4, lateness_warning=5.,
+                 stats_window=1000):
+        """
+        :param job: callable taking a list of station names
+        :param stations: dict of station name to settings, e.g. from :func:`load_station_config`
+        :param coalesce: seconds within which due ticks are run as one job
+        :param overlap: ``skip`` or ``postpone`` a tick whose station is still busy
+        :param max_workers: jobs running at the same time
+        :param lateness_warning: seconds late after which a tick is logged
+        :param stats_window: number of recent ticks kept for :meth:`stats`
+        """
+        if overlap not in OVERLAP_POLICIES:
+            raise ValueError(f'overlap must be one of {OVERLAP_POLICIES}, got {overlap!r}')
+        self.job = job
+        self.stations = stations
+        self.offsets = station_offsets(stations)
+        self.coalesce = coalesce
+        self.overlap = overlap
+        self.lateness_warning = lateness_warning
+        self.stats_window = stats_window
+        self._heap = []
+        self._busy = set()
+        # station -> time its postponed tick was due
+        self._postponed = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='scheduled-job')
+        self._lateness = []
+        self._work_seconds = []
+        self._counts = {'ticks': 0, 'jobs': 0, 'skipped': 0, 'postponed': 0, 'failed': 0}
+
+    def start(self, now=None):
+        """
+        Queues the first tick of every enabled station after ``now``.
+        """
+        now = time.time() if now is None else now
+        self._heap = []
+        for name, offset in self.offsets.items():
+            self._push(name, next_tick(self.stations[name], offset, now))
+        return self
+
+    def _push(self, name, due):
+        # jitter only moves when the tick runs; the following tick is still found from its slot
+        jitter = self.stations[name]['jitter']
+        run_at = due + (random.uniform(0, jitter) if jitter else 0.)
+        heapq.heappush(self._heap, (run_at, name, due))
+
+    @property
+    def next_due(self):
+        return self._heap[0][0] if self._heap else None
+
+    def take_due(self, now):
+        """
+        Pops the ticks due by ``now``, together with those within ``coalesce``
+        seconds after the first, and queues each station's following tick.
+
+        :return: list of ``(station, scheduled_at)`` of the stations to run now
+        """
+        due = []
+        if not self._heap or self._heap[0][0] > now:
+            return due
+        horizon = max(now, self._heap[0][0] + self.coalesce)
+        while self._heap and self._heap[0][0] <= horizon:
+            run_at, name, slot = heapq.heappop(self._heap)
+            self._counts['ticks'] += 1
+            if name in self._busy:
+                if self.overlap == 'postpone' and name not in self._postponed:
+                    # runs as soon as the running job finishes, see _release
+                    self._postponed[name] = run_at
+                    self._counts['postponed'] += 1
+                else:
+                    self._counts['skipped'] += 1
+                    logger.warning(f'Skipped {name} tick due at {run_at:.1f}, previous analysis still running')
+                self._push(name, next_tick(self.stations[name], self.offsets[name], slot))
+                continue
+            due.append((name, run_at))
+            self._push(name, next_tick(self.stations[name], self.offsets[name], slot))
+        return due
+
+    def dispatch(self, due, now=None):
+        """
+        Marks the stations busy and runs the job for them on the worker threads.
+        """
+        if not due:
+            return None
+        now = time.time() if now is None else now
+        names = [name for name, _ in due]
+        late = []
+        with self._lock:
+            for name, scheduled in due:
+                lateness = max(0., now - scheduled)
+                self._record(self._lateness, lateness)
+                if lateness > self.lateness_warning:
+                    late.append((name, lateness))
+            self._busy.update(names)
+            self._counts['jobs'] += 1
+        for name, lateness in late:
+            logger.warning(f'{name} tick ran {lateness:.1f}s late')
+        return self._executor.submit(self._run_job, names)
+
+    def _run_job(self, names):
+        start = time.perf_counter()
+        try:
+            self.job(names)
+        except Exception as e:
+            with self._lock:
+                self._counts['failed'] += 1
+            logger.error(f'Scheduled analysis of {names} failed: {e!r}')
+        finally:
+            self._finish(names, time.perf_counter() - start)
+
+    def _finish(self, names, work_seconds):
+        with self._lock:
+            self._record(self._work_seconds, work_seconds)
+            due = self._release(names)
+        self.dispatch(due)
+        self._wake.set()
+
+    def _release(self, names):
+        """
+        Marks stations free again.
+
+        :return: ``(station, scheduled_at)`` of the postponed ticks now ready to run
+        """
+        self._busy.difference_update(names)
+        return [(name, self._postponed.pop(name)) for name in names if name in self._postponed]
+
+    def _record(self, values, value):
+        values.append(value)
+        if len(values) > self.stats_window:
+            del values[:len(values) - self.stats_window]
+
+    def run_forever(self, report_every=None):
+        """
+        Runs ticks as they come due until :meth:`stop` is called.
+
+        :param report_every: seconds between logging :meth:`stats`, never by default
+        """
+        if not self._heap:
+            self.start()
+        next_report = time.time() + report_every if report_every else None
+        while not self._stopped.is_set():
+            now = time.time()
+            with self._lock:
+                due = self.take_due(now)
+            self.dispatch(due, now)
+            if next_report is not None and now >= next_report:
+                logger.info(f'Scheduler stats: {self.stats()}')
+                next_report += report_every
+            wake_at = min((t for t in (self.next_due, next_report) if t is not None), default=None)
+            self._wake.wait(None if wake_at is None else max(0., wake_at - time.time()))
+            self._wake.clear()
+
+    def stop(self, wait=True):
+        self._stopped.set()
+        self._wake.set()
+        self._executor.shutdown(wait=wait)
+
+    def stats(self):
+        """
+        Tick counters, lateness and work time.
+
+        :return: dict with ``ticks``, ``jobs``, ``skipped``, ``postponed``,
+            ``failed``, ``busy``, ``lateness_p50``/``lateness_p99``/``lateness_max``
+            and ``work_p50``/``work_max`` in seconds
+        """
+        with self._lock:
+            stats = {**self._counts, 'busy': len(self._busy)}
+            lateness = sorted(self._lateness)
+            work = sorted(self._work_seconds)
+        for name, values, fraction in (('lateness_p50', lateness, .5), ('lateness_p99', lateness, .99),
+                                       ('lateness_max', lateness, 1.), ('work_p50', work, .5),
+                                       ('work_max', work, 1.)):
+            stats[name] = values[min(len(values) - 1, int(fraction * len(values)))] if values else None
+        return stats
+
+
+def simulate(stations, hours=1., work_seconds=9., coalesce=1., overlap='skip', start=0.):
+    """
+    Plays the schedule forward without running anything, assuming every job
+    takes ``work_seconds``, and measures how many stations are analysed at once.
+
+    :return: dict with ``jobs``, ``ticks``, ``skipped``, ``postponed``,
+        ``peak_concurrency`` (stations being analysed at the same time) and
+        ``mean_concurrency`` over the simulated time
+    """
+    scheduler = Scheduler(None, stations, coalesce=coalesce, overlap=overlap, max_workers=1)
+    scheduler.start(start)
+    end = start + hours * 3600
+    finishing = []  # heap of (finish time, station names)
+    active, peak, busy_seconds = 0, 0, 0.
+    while True:
+        next_due = scheduler.next_due
+        if finishing and (next_due is None or finishing[0][0] <= next_due):
+            now, names = heapq.heappop(finishing)
+            active -= len(names)
+            due = scheduler._release(names)
+        elif next_due is not None and next_due < end:
+            now = next_due
+            due = scheduler.take_due(now)
+        else:
+            break
+        if due:
+            names = [name for name, _ in due]
+            scheduler._busy.update(names)
+            scheduler._counts['jobs'] += 1
+            active += len(names)
+            peak = max(peak, active)
+            busy_seconds += len(names) * work_seconds
+            heapq.heappush(finishing, (now + work_seconds, names))
+
+    scheduler._executor.shutdown()
+    counts = scheduler._counts
+    return {
+        'jobs': counts['jobs'],
+        'ticks': counts['ticks'],
+        'skipped': counts['skipped'],
+        'postponed': counts['postponed'],
+        'peak_concurrency': peak,
+        'mean_concurrency': busy_seconds / (hours * 3600),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate the analysis schedule and report peak concurrency.')
+    parser.add_argument('--simulate', action='store_true', help='required, the scheduler is run from main.py')
+    parser.add_argument('--config', default=DEFAULT_CONFIG)
+    parser.add_argument('--stations', type=int, help='simulate this many copies of the default settings instead')
+    parser.add_argument('--hours', type=float, default=1.)
+    parser.add_argument('--work-seconds', type=float, default=9., help='capture plus analysis time per tick')
+    parser.add_argument('--coalesce', type=float, default=1.)
+    parser.add_argument('--overlap', choices=OVERLAP_POLICIES, default='skip')
+    args = parser.parse_args()
+    if not args.simulate:
+        parser.error('only --simulate is supported from the command line')
+    # skipped ticks are counted in the table, don't log each one
+    logging.basicConfig(level=logging.ERROR)
+
+    with open(args.config) as f:
+        config = json.load(f)
+    if args.stations:
+        stations = {f'station{i}': {} for i in range(args.stations)}
+    else:
+        stations = config.get('stations', {})
+
+    print(f'{"spread":<10}{"jobs":>7}{"skipped":>9}{"postponed":>11}{"peak":>7}{"mean":>8}')
+    for spread in SPREADS:
+        resolved = resolve_stations(stations, {**config.get('defaults', {}), 'spread': spread})
+        result = simulate(resolved, args.hours, args.work_seconds, args.coalesce, args.overlap)
+        print(f'{spread:<10}{result["jobs"]:>7}{result["skipped"]:>9}{result["postponed"]:>11}'
+              f'{result["peak_concurrency"]:>7}{result["mean_concurrency"]:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
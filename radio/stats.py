@@ -0,0 +1,297 @@
+"""
+Per-station statistics of the published values.
+
+To turn a station's tempo, loudness and pitch into percentiles (what the old
+``get_chroma_range`` did with a hand-kept min and max), the engine keeps, for
+every station and metric:
+
+- running moments (count, mean, variance, min and max) of everything seen,
+  updated in O(1) with Welford's method;
+- a sliding window of recent history as a ring of time buckets, each holding
+  a fixed-bin histogram of the metric and the moments of its values.  A query
+  merges the buckets still inside the window: histograms add bin by bin and
+  moments merge with Chan's formula, so old buckets are simply overwritten.
+
+The bins are fixed per metric (1 BPM, 1 LU, 25 Hz), so memory per station
+does not grow with history and percentiles are exact to within a bin.
+
+Every new result is ranked against the window before it is added, and is
+flagged as an outlier when its modified z-score, ``0.6745 * |x - median| /
+MAD``, exceeds a threshold.  Results of a station that arrive within
+``burst_gap`` seconds of each other form a burst, and its consolidated value
+is the median of the results in it that are not outliers.
+
+The whole state is checkpointed to one compressed ``.npz`` file.
+"""
+import collections
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# metric -> (lowest bin edge, highest bin edge, bin width); values outside go into the edge bins.
+# All three are published as integers, so their bins are centred on them, pitch's on multiples of 25 Hz
+METRICS = {
+    'tempo': (29.5, 286.5, 1.),
+    'loudness': (-70.5, 10.5, 1.),
+    'pitch': (-12.5, 22062.5, 25.),
+}
+
+# Iglewicz and Hoaglin's cut-off for the modified z-score
+OUTLIER_Z = 3.5
+
+# results kept per burst, whatever the burst pattern
+MAX_BURST = 16
+
+
+def merge_moments(a, b):
+    """
+    Combines ``(count, mean, m2)`` of two sets of values, m2 being the sum of squared deviations from the mean.
+    """
+    count = a[0] + b[0]
+    if count == 0:
+        return 0., 0., 0.
+    delta = b[1] - a[1]
+    mean = a[1] + delta * b[0] / count
+    return count, mean, a[2] + b[2] + delta ** 2 * a[0] * b[0] / count
+
+
+def bins_of(metric):
+    """
+    :return: number of histogram bins of ``metric``
+    """
+    low, high, width = METRICS[metric]
+    return int(round((high - low) / width))
+
+
+class _MetricHistory:
+    """
+    Moments and bucketed histograms of one metric of one station.
+    """
+
+    def __init__(self, metric, buckets):
+        low, high, width = METRICS[metric]
+        self.low, self.width = low, width
+        self.bins = bins_of(metric)
+        self.centers = low + (np.arange(self.bins) + .5) * width
+        # count, mean, m2, min, max of everything seen
+        self.total = np.array([0., 0., 0., np.inf, -np.inf])
+        self.bucket_ids = np.full(buckets, -1, dtype=np.int64)
+        self.counts = np.zeros((buckets, self.bins), dtype=np.int32)
+        self.moments = np.zeros((buckets, 3))
+
+    def add(self, value, bucket_id):
+        count, mean, m2, low, high = self.total
+        count += 1
+        delta = value - mean
+        mean += delta / count
+        self.total = np.array([count, mean, m2 + delta * (value - mean), min(low, value), max(high, value)])
+
+        slot = bucket_id % len(self.bucket_ids)
+        if self.bucket_ids[slot] != bucket_id:
+            # the slot's bucket has slid out of the window
+            self.bucket_ids[slot] = bucket_id
+            self.counts[slot] = 0
+            self.moments[slot] = 0.
+        self.counts[slot, self._bin(value)] += 1
+        self.moments[slot] = merge_moments(self.moments[slot], (1., value, 0.))
+
+    def _bin(self, value):
+        return min(max(int((value - self.low) // self.width), 0), self.bins - 1)
+
+    def _live(self, bucket_id):
+        return self.bucket_ids > bucket_id - len(self.bucket_ids)
+
+    def window(self, bucket_id):
+        """
+        :return: histogram of the buckets within the window ending at ``bucket_id``
+        """
+        return self.counts[self._live(bucket_id)].sum(axis=0)
+
+    def window_moments(self, bucket_id):
+        """
+        :return: ``(count, mean, m2)`` of the buckets within the window ending at ``bucket_id``
+        """
+        moments = (0., 0., 0.)
+        for slot in np.flatnonzero(self._live(bucket_id)):
+            moments = merge_moments(moments, self.moments[slot])
+        return moments
+
+    def quantile(self, histogram, q):
+        """
+        Value below which ``q`` of the histogram lies, interpolated within its bin.
+        """
+        cumulative = np.cumsum(histogram)
+        target = q * cumulative[-1]
+        index = min(int(np.searchsorted(cumulative, target)), self.bins - 1)
+        below = cumulative[index] - histogram[index]
+        fraction = (target - below) / histogram[index] if histogram[index] else .5
+        return float(self.low + (index + fraction) * self.width)
+
+    def percentile(self, histogram, value):
+        """
+        Share of the histogram below ``value``, between 0 and 1.
+        """
+        index = self._bin(value)
+        fraction = min(max((value - self.low) / self.width - index, 0.), 1.)
+        return float((histogram[:index].sum() + fraction * histogram[index]) / histogram.sum())
+
+    def median_absolute_deviation(self, histogram, median):
+        deviations = np.abs(self.centers - median)
+        order = np.argsort(deviations)
+        cumulative = np.cumsum(histogram[order])
+        index = int(np.searchsorted(cumulative, cumulative[-1] / 2))
+        # a bin's own width bounds how well the deviation of its values is known
+        return max(float(deviations[order[index]]), self.width / 2)
+
+
+class StationStatistics:
+    """
+    Percentiles, outlier flags and burst consolidation of every station's tempo, loudness and pitch.
+    """
+
+    def __init__(self, window_seconds=7 * 86400, buckets=7, min_history=10, outlier_z=OUTLIER_Z, burst_gap=0.):
+        """
+        :param window_seconds: seconds of history percentiles and outliers are measured against
+        :param buckets: buckets the window is divided into; the window slides by one bucket at a time
+        :param min_history: results of a station in the window before it gets percentiles and outlier flags
+        :param outlier_z: modified z-score above which a value is an outlier
+        :param burst_gap: results of a station less than this many seconds apart are one burst; 0 for no bursts
+        """
+        self.bucket_seconds = window_seconds / buckets
+        self.buckets = buckets
+        self.min_history = min_history
+        self.outlier_z = outlier_z
+        self.burst_gap = burst_gap
+        self._stations = {}
+        self._bursts = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    @property
+    def stations(self):
+        return list(self._stations)
+
+    def _history(self, station):
+        history = self._stations.get(station)
+        if history is None:
+            history = self._stations[station] = {metric: _MetricHistory(metric, self.buckets) for metric in METRICS}
+        return history
+
+    def observe(self, station, values, now=None):
+        """
+        Ranks a new result against the station's history, then adds it.
+
+        :param values: dict with the station's ``tempo``, ``loudness`` and ``pitch``
+        :param now: timestamp of the result, the current time by default
+        :return: dict with ``percentiles`` and ``outliers``, each a dict by metric (percentiles
+            between 0 and 1, ``None`` while the history is shorter than ``min_history``), and the
+            ``consolidated`` values of the burst the result belongs to with the number of ``snippets`` in it
+        """
+        now = time.time() if now is None else now
+        bucket_id = int(now // self.bucket_seconds)
+        percentiles, outliers = {}, {}
+        with self._lock:
+            history = self._history(station)
+            for metric, metric_history in history.items():
+                value = float(values[metric])
+                histogram = metric_history.window(bucket_id)
+                percentiles[metric], outliers[metric] = None, False
+                if histogram.sum() >= self.min_history:
+                    percentiles[metric] = round(metric_history.percentile(histogram, value), 3)
+                    median = metric_history.quantile(histogram, .5)
+                    mad = metric_history.median_absolute_deviation(histogram, median)
+                    outliers[metric] = bool(.6745 * abs(value - median) / mad > self.outlier_z)
+                metric_history.add(value, bucket_id)
+            consolidated = self._consolidate(station, values, outliers, now)
+        return {'percentiles': percentiles, 'outliers': outliers, 'consolidated': consolidated}
+
+    def _consolidate(self, station, values, outliers, now):
+        burst = self._bursts.get(station)
+        if burst is None or now - burst[-1][0] >= self.burst_gap:
+            burst = self._bursts[station] = collections.deque(maxlen=MAX_BURST)
+        burst.append((now, values, outliers))
+        consolidated = {}
+        for metric in METRICS:
+            kept = [v[metric] for _, v, flags in burst if not flags[metric]]
+            # if every result is an outlier, the burst itself is the news
+            consolidated[metric] = int(round(np.median(kept or [v[metric] for _, v, _ in burst])))
+        consolidated['snippets'] = len(burst)
+        return consolidated
+
+    def summary(self, station, now=None):
+        """
+        :return: dict by metric of the station's ``count``, ``mean``, ``std``, ``min`` and ``max``
+            of everything seen, and the ``window_count``, ``window_mean``, ``window_std``,
+            ``p5``, ``median`` and ``p95`` of the window, or ``None`` for a station without results
+        """
+        bucket_id = int((time.time() if now is None else now) // self.bucket_seconds)
+        with self._lock:
+            history = self._stations.get(station)
+            if history is None:
+                return None
+            summary = {}
+            for metric, metric_history in history.items():
+                count, mean, m2, low, high = (float(v) for v in metric_history.total)
+                window_count, window_mean, window_m2 = (float(v) for v in metric_history.window_moments(bucket_id))
+                histogram = metric_history.window(bucket_id)
+                quantiles = ([round(metric_history.quantile(histogram, q), 1) for q in (.05, .5, .95)]
+                             if histogram.sum() else [None] * 3)
+                summary[metric] = {'count': int(count), 'mean': mean, 'std': (m2 / count) ** .5 if count else 0.,
+                                   'min': low, 'max': high, 'window_count': int(window_count),
+                                   'window_mean': window_mean,
+                                   'window_std': (window_m2 / window_count) ** .5 if window_count else 0.,
+                                   **dict(zip(('p5', 'median', 'p95'), quantiles))}
+            return summary
+
+    def checkpoint(self, path):
+        """
+        Writes every station's history to ``path`` atomically.
+        """
+        with self._lock:
+            stations = list(self._stations)
+            arrays = {'stations': np.array(stations, dtype=str),
+                      'window': np.array([self.bucket_seconds, self.buckets])}
+            for metric in METRICS:
+                histories = [self._stations[station][metric] for station in stations]
+                arrays[f'{metric}_total'] = np.array([h.total for h in histories]).reshape(-1, 5)
+                arrays[f'{metric}_bucket_ids'] = np.array([h.bucket_ids for h in histories]).reshape(-1, self.buckets)
+                arrays[f'{metric}_moments'] = np.array([h.moments for h in histories]).reshape(-1, self.buckets, 3)
+                # the bins are given, without a station there is nothing to infer them from
+                arrays[f'{metric}_counts'] = np.array([h.counts for h in histories], dtype=np.int32).reshape(
+                    len(stations), self.buckets, bins_of(metric))
+        with self._write_lock, open(path + '.tmp', 'wb') as f:
+            np.savez_compressed(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+
+    def restore(self, path):
+        """
+        Loads a checkpoint written by :meth:`checkpoint`.  A checkpoint with a
+        different window, or from before a change to the bins, is ignored.
+
+        :return: ``True`` if it was loaded
+        """
+        with np.load(path) as checkpoint:
+            if tuple(checkpoint['window']) != (self.bucket_seconds, self.buckets):
+                logger.warning(f'Ignoring {path}, it was written with a different window')
+                return False
+            stations = [str(station) for station in checkpoint['stations']]
+            with self._lock:
+                for metric in METRICS:
+                    counts = checkpoint[f'{metric}_counts']
+                    if len(stations) and counts.shape[2] != bins_of(metric):
+                        logger.warning(f'Ignoring {path}, its {metric} bins differ')
+                        return False
+                for i, station in enumerate(stations):
+                    for metric, metric_history in self._history(station).items():
+                        metric_history.total = checkpoint[f'{metric}_total'][i].copy()
+                        metric_history.bucket_ids = checkpoint[f'{metric}_bucket_ids'][i].copy()
+                        metric_history.moments = checkpoint[f'{metric}_moments'][i].copy()
+                        metric_history.counts = checkpoint[f'{metric}_counts'][i].copy()
+        return True
@@ -0,0 +1,376 @@
+"""
+Analysis triggered by track changes.
+
+Sampling at fixed minutes mostly re-profiles the song that was playing last
+time and can miss a short track entirely.  The :class:`TrackWatcher` keeps
+one connection per station open with ICY metadata requested (see
+:mod:`radio.icy`) and only captures when the ``StreamTitle`` changes: once
+``settle_seconds`` of the new track have passed, so a title sent a little
+ahead of its audio doesn't capture the end of the last song, it captures
+``seconds`` of complete frames from the same connection and hands the
+capture, which carries the title, to the analysis callable.
+
+- A station whose title doesn't change for ``fallback_seconds`` of audio, e.g.
+  a long mix under one show title or a server that never fills in its
+  metadata, is sampled on that interval over the same connection.
+- A title the station switched back to within ``repeat_seconds``, like the
+  station's own name shown between songs, is not analysed again.
+- A station whose server doesn't interleave metadata at all is disconnected
+  and reported through ``on_without_metadata``, so that its caller can
+  sample it on the usual schedule instead.
+
+Stream positions are counted in seconds of audio, from the ``icy-br``
+bitrate header, so a stream that arrives in a burst settles just as long.
+"""
+import asyncio
+import collections
+import logging
+import random
+import time
+
+import aiohttp
+
+from radio import metrics
+from radio.capture import DEFAULT_MAX_BITRATE, READ_SIZE, FrameAccumulator, find_frame_start
+from radio.health import wait_until_allowed
+from radio.icy import ICY_HEADERS, IcyDemuxer, metaint_of
+
+logger = logging.getLogger(__name__)
+
+# assumed when a server doesn't send icy-br, or sends 0
+DEFAULT_BITRATE = 128000
+
+# titles remembered per station for repeat_seconds
+MAX_RECENT_TITLES = 16
+
+# audio kept while looking for the first frame, enough for two of the largest ADTS frames
+MAX_FRAME_BYTES = 2 * 8192
+
+class _Track:
+    """
+    A capture pending or running on a station's connection, from ``at_seconds`` of its audio on.
+    """
+
+    def __init__(self, title, reason, at_seconds):
+        self.title = title
+        self.reason = reason
+        self.at_seconds = at_seconds
+        self.accumulator = None
+        self.started_at = None
+
+
+class _CaptureQueue:
+    """
+    Captures waiting for analysis, at most one per station and ``maxsize`` in all.
+
+    Readers never wait on it, as that would stall their streams: a station's
+    newer capture replaces its one still waiting, whose track is over anyway,
+    and when the queue is full the oldest capture is dropped.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._captures = collections.OrderedDict()
+        self._ready = asyncio.Event()
+
+    def qsize(self):
+        return len(self._captures)
+
+    def put(self, capture):
+        """
+        :return: the capture that was displaced, or ``None``
+        """
+        displaced = self._captures.pop(capture.station, None)
+        if displaced is None and len(self._captures) >= self.maxsize:
+            _, displaced = self._captures.popitem(last=False)
+        self._captures[capture.station] = capture
+        self._ready.set()
+        return displaced
+
+    async def get_batch(self, size):
+        """
+        Waits for captures and takes up to ``size`` of them, oldest first.
+        """
+        while not self._captures:
+            self._ready.clear()
+            await self._ready.wait()
+        batch = []
+        while self._captures and len(batch) < size:
+            batch.append(self._captures.popitem(last=False)[1])
+        return batch
+
+
+class TrackWatcher:
+    """
+    Follows stations' ICY metadata and analyzes each new track once.
+    """
+
+    def __init__(self, seconds=6., settle_seconds=15., fallback_seconds=360., repeat_seconds=1800.,
+                 analysis_batch_size=16, queue_size=64, connect_timeout=5., read_timeout=10., initial_backoff=1., max_backoff=60.,
+                 read_size=READ_SIZE, report_every=3600., health=None):
+        """
+        :param seconds: duration of each capture
+        :param settle_seconds: seconds of a new track's audio skipped before it is captured
+        :param fallback_seconds: seconds of audio without a new title after which a station is sampled
+            anyway; a dict of station name to seconds to set it per station
+        :param repeat_seconds: seconds within which a title the station returns to isn't analyzed again
+        :param analysis_batch_size: most captures handed to the analysis callable at once
+        :param queue_size: captures waiting for analysis, beyond which the oldest is dropped
+        :param connect_timeout: seconds to establish a connection
+        :param read_timeout: seconds allowed between two reads
+        :param initial_backoff: seconds before the first reconnect attempt
+        :param max_backoff: upper bound of the reconnect delay
+        :param report_every: seconds between two log lines with the analyses saved
+        :param health: optional :class:`radio.health.StationHealth`, see :func:`radio.health.wait_until_allowed`
+        """
+        self.seconds = seconds
+        self.settle_seconds = settle_seconds
+        self.fallback_seconds = fallback_seconds
+        self.repeat_seconds = repeat_seconds
+        self.analysis_batch_size = analysis_batch_size
+        self.queue_size = queue_size
+        self.timeout = aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout)
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.read_size = read_size
+        self.report_every = report_every
+        self.health = health
+        self.on_without_metadata = None
+        self.without_metadata = set()
+        self.titles = {}
+        self._recent = collections.defaultdict(collections.OrderedDict)
+        self._loop = None
+        self._stopping = None
+        self._started = None
+        self._counts = {'connects': 0, 'failures': 0, 'title_changes': 0, 'repeats': 0,
+                        'analyses': 0, 'title': 0, 'fallback': 0, 'superseded': 0, 'dropped': 0}
+
+    def _fallback_for(self, station):
+        if isinstance(self.fallback_seconds, dict):
+            return self.fallback_seconds.get(station, 360.)
+        return self.fallback_seconds
+
+    def _is_repeat(self, station, title, now):
+        recent = self._recent[station]
+        analyzed_at = recent.get(title)
+        return analyzed_at is not None and now - analyzed_at < self.repeat_seconds
+
+    def _remember(self, station, title, now):
+        recent = self._recent[station]
+        recent[title] = now
+        recent.move_to_end(title)
+        while len(recent) > MAX_RECENT_TITLES:
+            recent.popitem(last=False)
+
+    async def _watch(self, session, station, config, queue):
+        """
+        Reads one connection of a station, capturing new tracks onto ``queue``, until it fails.
+        """
+        start = time.monotonic()
+        async with session.get(config['stream_url'], headers=ICY_HEADERS) as response:
+            if self.health is not None:
+                self.health.record_ttfb(station, time.monotonic() - start)
+            response.raise_for_status()
+            self._counts['connects'] += 1
+            metaint = metaint_of(response.headers)
+            if metaint is None:
+                return False
+            try:
+                bitrate = int(response.headers.get('icy-br', '').split(',')[0]) * 1000
+            except ValueError:
+                bitrate = 0
+            if bitrate <= 0:
+                bitrate = DEFAULT_BITRATE
+            demuxer = IcyDemuxer(metaint)
+            fallback = self._fallback_for(station)
+            track, first_title = None, True
+            # the audio read until its first complete frame, which makes the station healthy; headers alone don't
+            unconfirmed = bytearray() if self.health is not None else None
+            # a server that sends no titles is sampled once the first settle time has passed
+            last_capture = self.settle_seconds - fallback
+            async for chunk in response.content.iter_chunked(self.read_size):
+                audio, titles = demuxer.feed(chunk)
+                position = demuxer.audio_bytes * 8 / bitrate
+                if unconfirmed is not None and audio:
+                    for view in audio:
+                        unconfirmed += view
+                    if find_frame_start(unconfirmed, config['audio_type']) is not None:
+                        self.health.record_success(station)
+                        unconfirmed = None
+                    else:
+                        del unconfirmed[:-MAX_FRAME_BYTES]
+                for title in titles:
+                    changed = title != self.titles.get(station)
+                    self.titles[station] = title
+                    if changed:
+                        self._counts['title_changes'] += 1
+                    if changed or first_title:
+                        if self._is_repeat(station, title, time.monotonic()):
+                            self._counts['repeats'] += 1
+                        else:
+                            # the track playing when we connect is under way, a new one is given time to
+                            # settle; a capture running into a new track is started over
+                            track = _Track(title, 'title', position + (0. if first_title else self.settle_seconds))
+                    first_title = False
+                if track is None and position - last_capture >= fallback:
+                    track = _Track(demuxer.title, 'fallback', position)
+                if track is None or position < track.at_seconds:
+                    continue
+
+                if track.accumulator is None:
+                    track.accumulator = FrameAccumulator(config['audio_type'],
+                                                         int(DEFAULT_MAX_BITRATE / 8 * self.seconds) + self.read_size)
+                    track.started_at = time.time()
+                for view in audio:
+                    track.accumulator.feed(view)
+                if track.accumulator.duration < self.seconds:
+                    continue
+                capture = track.accumulator.to_capture(station=station, started_at=track.started_at,
+                                                       title=track.title)
+                metrics.observe_capture(station, len(capture), capture.duration)
+                self._counts[track.reason] += 1
+                self._counts['analyses'] += 1
+                if track.title is not None:
+                    self._remember(station, track.title, time.monotonic())
+                logger.debug(f'Captured {station} ({track.reason}): {track.title!r}')
+                displaced = queue.put(capture)
+                if displaced is not None:
+                    self._counts['superseded' if displaced.station == station else 'dropped'] += 1
+                    logger.warning(f'Analysis is behind, skipping the capture of {displaced.station} '
+                                   f'({displaced.title!r})')
+                last_capture, track = position, None
+        return True
+
+    async def _follow(self, session, station, config, queue):
+        backoff = self.initial_backoff
+        while not self._stopping.is_set():
+            if not await wait_until_allowed(self.health, station, self._stopping):
+                continue
+            connected_at = time.monotonic()
+            try:
+                if not await self._watch(session, station, config, queue):
+                    logger.info(f'{station} sends no ICY metadata, it is left to the schedule')
+                    self.without_metadata.add(station)
+                    if self.on_without_metadata is not None:
+                        self.on_without_metadata(station)
+                    return
+                raise ConnectionError('stream ended')
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._counts['failures'] += 1
+                metrics.count_failure('stream', station)
+                if self.health is not None:
+                    self.health.record_failure(station, e)
+                if time.monotonic() - connected_at > self.max_backoff:
+                    backoff = self.initial_backoff
+                delay = backoff * random.uniform(.5, 1.)
+                logger.warning(f'Stream of {station} failed ({e!r}), reconnecting in {delay:.1f}s')
+                backoff = min(backoff * 2, self.max_backoff)
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _consume(self, queue, analyze, on_results):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await queue.get_batch(self.analysis_batch_size)
+            # analysis blocks (e.g. waiting on the worker pool), keep it off the event loop
+            try:
+                analyzed = await loop.run_in_executor(None, analyze, batch)
+            except Exception as e:
+                logger.error(f'Analysing {len(batch)} captures failed: {e!r}')
+                for capture in batch:
+                    metrics.count_failure('analysis', capture.station)
+                continue
+            if on_results is not None:
+                try:
+                    on_results(list(zip(batch, analyzed)))
+                except Exception as e:
+                    logger.error(f'Handling analysis results failed: {e!r}')
+
+    async def _report_loop(self, schedule):
+        while True:
+            await asyncio.sleep(self.report_every)
+            stats = self.stats(schedule)
+            message = (f'{stats["analyses_per_hour"]:.0f} analyses per hour ({stats["title"]} on a new title, '
+                       f'{stats["fallback"]} as fallback, {stats["repeats"]} repeated titles skipped)')
+            if schedule is not None:
+                message += (f' where the fixed schedule runs {stats["fixed_per_hour"]:.0f}: '
+                            f'{stats["saved_per_hour"]:.0f} saved per hour')
+            logger.info(message)
+
+    async def run(self, stations, analyze, on_results=None, schedule=None):
+        """
+        Watches ``stations`` until :meth:`stop` is called.
+
+        :param stations: dict of station name to ``{'stream_url', 'audio_type'}``
+        :param analyze: callable taking a list of captures and returning a
+            list of results, e.g. :meth:`radio.workers.AnalysisPool.analyze`
+        :param on_results: optional callable receiving each analysed batch as
+            a list of ``(capture, result)`` pairs; ``capture.title`` is the track title
+        :param schedule: dict of station name to settings with ``cadence`` and ``burst``, as
+            the scheduler would analyse these stations; the hourly report compares the watcher's
+            analyses with what it would run for the stations that send metadata
+        """
+        self._stopping = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        self._started = time.monotonic()
+        queue = _CaptureQueue(self.queue_size)
+        connector = aiohttp.TCPConnector(limit=0, ttl_dns_cache=300)
+        async with aiohttp.ClientSession(connector=connector, timeout=self.timeout) as session:
+            tasks = [asyncio.ensure_future(self._follow(session, station, config, queue))
+                     for station, config in stations.items()]
+            tasks.append(asyncio.ensure_future(self._consume(queue, analyze, on_results)))
+            tasks.append(asyncio.ensure_future(self._report_loop(schedule)))
+            try:
+                await self._stopping.wait()
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    def run_forever(self, stations, analyze, on_results=None, schedule=None):
+        """
+        Blocking wrapper around :meth:`run` for callers without an event loop.
+        """
+        asyncio.run(self.run(stations, analyze, on_results, schedule))
+
+    def stop(self):
+        """
+        Stops :meth:`run`, from any thread.
+        """
+        if self._stopping is not None:
+            self._loop.call_soon_threadsafe(self._stopping.set)
+
+    def stats(self, schedule=None):
+        """
+        :param schedule: see :meth:`run`
+        :return: dict with counts of ``connects``, ``failures``, ``title_changes``, ``repeats``
+            skipped and ``analyses`` captured (of which ``title`` and ``fallback``), of those the
+            ones ``superseded`` by a newer capture of the station or ``dropped`` from a full
+            queue before analysis, the stations ``without_metadata``, the ``analyses_per_hour``
+            actually analysed and, given ``schedule``, the
+            ``fixed_per_hour`` it runs for the stations that send metadata and the
+            analyses ``saved_per_hour`` compared with it
+        """
+        hours = (time.monotonic() - self._started) / 3600 if self._started else 0.
+        analysed = self._counts['analyses'] - self._counts['superseded'] - self._counts['dropped']
+        per_hour = analysed / hours if hours else 0.
+        stats = {**self._counts, 'without_metadata': sorted(self.without_metadata), 'analyses_per_hour': per_hour}
+        if schedule is not None:
+            # stations without metadata stay on the schedule, nothing is saved on them
+            fixed_per_hour = fixed_analyses_per_hour({station: settings for station, settings in schedule.items()
+                                                      if station not in self.without_metadata})
+            stats.update(fixed_per_hour=fixed_per_hour, saved_per_hour=fixed_per_hour - per_hour)
+        return stats
+
+
+def fixed_analyses_per_hour(stations):
+    """
+    :param stations: dict of station name to settings with ``cadence`` and ``burst``, see
+        :func:`radio.scheduler.load_station_config`
+    :return: analyses per hour the scheduler runs for ``stations``
+    """
+    return sum(len(settings['burst']) * 3600 / settings['cadence'] for settings in stations.values())
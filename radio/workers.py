@@ -0,0 +1,326 @@
+"""
+Pool of long-lived analysis worker processes.
+
+Each worker imports the analysis stack (TensorFlow, librosa) and loads the
+tempo models once when it starts, then analyses captures sent to it through
+the pool's task queue.  Captures from all stations are spread across the
+workers, so a burst takes as long as the slowest core's share rather than the
+sum over stations.  Workers are replaced after a set number of jobs to keep
+memory growth in long-running processes bounded.  A batch that isn't
+analysed within its deadline, e.g. because a worker was killed, fails, and
+the pool is replaced so that the next batches get live workers.
+
+The process that owns the pool never imports the analysis stack itself.
+"""
+import functools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# jobs a worker handles before it is replaced by a fresh process
+DEFAULT_MAX_JOBS_PER_WORKER = 200
+
+# deadline of a batch: a fixed allowance (worker start-up, model loading, queueing) plus a share per capture
+DEFAULT_BATCH_TIMEOUT = 120.
+DEFAULT_SECONDS_PER_CAPTURE = 10.
+
+
+class AnalysisTimeout(RuntimeError):
+    """
+    Raised when a batch isn't analysed within its deadline, or its pool was replaced while it waited.
+    """
+
+
+def _init_worker(models, threads, record_timings):
+    # must run before TensorFlow/BLAS are imported so every worker keeps to its share of the cores
+    for variable in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                     'TF_NUM_INTRAOP_THREADS', 'TEMPO_NUM_THREADS'):
+        os.environ.setdefault(variable, str(threads))
+    os.environ.setdefault('TF_NUM_INTEROP_THREADS', '1')
+
+    if record_timings:
+        from audio_characteristics.timing import start_recording
+        start_recording()
+
+    from audio_characteristics.tempo import preload_classifiers
+    for model_name, stats in preload_classifiers(models).items():
+        logger.info(f"Worker {os.getpid()} loaded '{model_name}' in {stats['load_seconds']:.2f}s "
+                    f"using {stats['rss_bytes'] / 2 ** 20:.1f} MiB")
+
+
+def analyze_captures(captures, model_name='cnn'):
+    """
+    Decodes and profiles a list of captures inside a worker, running the
+    tempo model once for all of them.
+
+    :param captures: list of :class:`radio.capture.Capture`
+    :return: list of audio characteristics dicts with their gate ``status``, see
+        :func:`audio_characteristics.profile.get_audio_characteristics` (``None`` where a capture failed)
+    """
+    from audio_characteristics.decode import decode_capture
+    from audio_characteristics.profile import get_audio_characteristics_batch
+    from audio_characteristics.timing import timer
+
+    contexts, results = [], [None] * len(captures)
+    for i, capture in enumerate(captures):
+        try:
+            with timer('decode', capture.station):
+                contexts.append((i, decode_capture(capture)))
+        except Exception as e:
+            print(f'Exception occurred decoding {capture} in analyze_captures. It is: {e}')
+
+    profiled = get_audio_characteristics_batch([context for _, context in contexts], model_name=model_name)
+    for (i, _), audio_stats in zip(contexts, profiled):
+        results[i] = audio_stats
+    return results
+
+
+# result cache counters summed across workers by AnalysisPool.cache_stats()
+_CACHE_COUNTERS = ('hits', 'misses', 'seconds_saved')
+
+
+def _worker_counters():
+    from audio_characteristics.fingerprint import result_cache
+    from audio_characteristics.gate import gate_counts
+
+    counters = {f'gate_{status}': count for status, count in gate_counts().items()}
+    cache = result_cache()
+    if cache is not None:
+        stats = cache.stats()
+        counters.update({f'cache_{counter}': stats[counter] for counter in _CACHE_COUNTERS})
+    return counters
+
+
+def _analyze_chunk(captures, model_name):
+    """
+    Runs :func:`analyze_captures` and reports what the worker measured along
+    the way, since the parent cannot read it itself.
+
+    :return: ``(results, telemetry)``; telemetry is a dict with ``counters``
+        (how the worker's counters changed), ``stages`` and ``failures`` (see
+        :func:`audio_characteristics.timing.drain`) and ``models`` (see
+        :func:`audio_characteristics.tempo.model_load_stats`)
+    """
+    from audio_characteristics.tempo import model_load_stats
+    from audio_characteristics.timing import drain
+
+    before = _worker_counters()
+    results = analyze_captures(captures, model_name)
+    after = _worker_counters()
+    stages, failures = drain()
+    return results, {
+        'counters': {counter: after[counter] - before.get(counter, 0) for counter in after},
+        'stages': stages,
+        'failures': failures,
+        'models': model_load_stats(),
+    }
+
+
+class AnalysisPool:
+    """
+    Persistent pool of warm analysis workers.
+    """
+
+    def __init__(self, processes=None, models=('cnn',), max_jobs_per_worker=DEFAULT_MAX_JOBS_PER_WORKER,
+                 record_timings=False, batch_timeout=DEFAULT_BATCH_TIMEOUT,
+                 seconds_per_capture=DEFAULT_SECONDS_PER_CAPTURE):
+        """
+        :param processes: number of workers, one per core by default
+        :param models: tempo models every worker loads at start-up
+        :param max_jobs_per_worker: jobs after which a worker is replaced
+        :param record_timings: have the workers time every analysis stage and
+            pass the timings to :attr:`on_telemetry`
+        :param batch_timeout: seconds :meth:`analyze` waits for any batch
+        :param seconds_per_capture: seconds added to ``batch_timeout`` for every capture in the batch
+        """
+        self.processes = processes or os.cpu_count() or 1
+        self.models = tuple(models)
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.record_timings = record_timings
+        self.batch_timeout = batch_timeout
+        self.seconds_per_capture = seconds_per_capture
+        self._counters = {}
+        self._pending = 0
+        self._stats_lock = threading.Lock()
+        # called with each chunk's telemetry (see _analyze_chunk), e.g. to feed metrics
+        self.on_telemetry = None
+        # incremented whenever a stuck pool is replaced; results of an older generation never arrive
+        self._generation = 0
+        self._pool_lock = threading.Lock()
+        self.restarts = 0
+        self._pool = self._start_pool()
+
+    def _start_pool(self):
+        threads = max(1, (os.cpu_count() or 1) // self.processes)
+        # spawn rather than fork: TensorFlow is not fork-safe, and a spawned
+        # worker starts without anything the parent happens to have imported
+        return multiprocessing.get_context('spawn').Pool(
+            self.processes,
+            initializer=_init_worker,
+            initargs=(self.models, threads, self.record_timings),
+            maxtasksperchild=self.max_jobs_per_worker)
+
+    def _restart(self, generation):
+        """
+        Replaces the pool unless another caller already replaced it since ``generation``.
+        """
+        with self._pool_lock:
+            if generation != self._generation:
+                return
+            stuck = self._pool
+            self._generation += 1
+            self._pool = self._start_pool()
+            self.restarts += 1
+        with self._stats_lock:
+            # the stuck pool's chunks will never report
+            self._pending = 0
+        logger.error('Replacing the analysis workers after a batch missed its deadline')
+        stuck.terminate()
+
+    def analyze(self, captures, model_name='cnn'):
+        """
+        Profiles captures in parallel across the workers and waits for the results.
+
+        Captures are split into one chunk per worker; each chunk is decoded and
+        profiled with a single batched tempo model call.  A batch that takes
+        longer than ``batch_timeout`` plus ``seconds_per_capture`` per capture
+        fails, and the workers are replaced, since one of them is likely dead
+        (e.g. killed for memory) and a multiprocessing pool never gives up on
+        a dead worker's job.
+
+        :param captures: list of :class:`radio.capture.Capture`
+        :return: list of audio characteristics dicts in the order of ``captures``
+        :raises AnalysisTimeout: if the batch missed its deadline
+        """
+        captures = list(captures)
+        return self.analyze_async(captures, model_name=model_name).get(
+            self.batch_timeout + self.seconds_per_capture * len(captures))
+
+    def analyze_async(self, captures, model_name='cnn'):
+        """
+        Like :meth:`analyze`, but returns immediately.
+
+        :return: object whose ``get(timeout=None)`` returns the results, and on
+            timeout replaces the pool and raises :class:`AnalysisTimeout`
+        """
+        chunks = _split(list(captures), self.processes)
+        with self._pool_lock:
+            generation = self._generation
+            with self._stats_lock:
+                self._pending += len(chunks)
+            result = self._pool.starmap_async(
+                _analyze_chunk, [(chunk, model_name) for chunk in chunks], chunksize=1,
+                callback=functools.partial(self._add_telemetry, generation),
+                error_callback=functools.partial(self._chunks_failed, generation, len(chunks)))
+        return _FlattenedResult(self, result, generation)
+
+    @property
+    def pending(self):
+        """
+        Chunks of captures queued or being analysed.
+        """
+        return self._pending
+
+    def _add_telemetry(self, generation, chunk_results):
+        with self._stats_lock:
+            if generation == self._generation:
+                self._pending -= len(chunk_results)
+            for _, telemetry in chunk_results:
+                for counter, delta in telemetry['counters'].items():
+                    self._counters[counter] = self._counters.get(counter, 0) + delta
+        if self.on_telemetry is not None:
+            for _, telemetry in chunk_results:
+                self.on_telemetry(telemetry)
+
+    def _chunks_failed(self, generation, chunks, e):
+        # starmap_async fails as a whole, so none of the call's chunks is pending any more
+        logger.error(f'Analysis failed: {e!r}')
+        with self._stats_lock:
+            if generation == self._generation:
+                self._pending -= chunks
+
+    def _counters_with_prefix(self, prefix):
+        with self._stats_lock:
+            return {counter[len(prefix):]: value for counter, value in self._counters.items()
+                    if counter.startswith(prefix)}
+
+    def gate_stats(self):
+        """
+        Snippets checked by the silence/clipping/noise gate across all workers, by status.
+
+        :return: dict of status value to count
+        """
+        return self._counters_with_prefix('gate_')
+
+    def cache_stats(self):
+        """
+        Result cache counters summed across all workers.
+
+        :return: dict with ``hits``, ``misses``, ``hit_rate`` and ``seconds_saved``
+        """
+        stats = {counter: 0 for counter in _CACHE_COUNTERS}
+        stats.update(self._counters_with_prefix('cache_'))
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else None
+        return stats
+
+    def close(self):
+        """
+        Lets the workers finish their jobs, then stops them.
+        """
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        self._pool.terminate()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _FlattenedResult:
+
+    # seconds between two checks whether another caller replaced the pool
+    POLL_SECONDS = 1.
+
+    def __init__(self, pool, result, generation):
+        self._pool = pool
+        self._result = result
+        self._generation = generation
+
+    def ready(self):
+        return self._result.ready()
+
+    def get(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._result.ready():
+            if self._pool._generation != self._generation:
+                raise AnalysisTimeout('the analysis workers were replaced while the batch waited')
+            if deadline is not None and time.monotonic() >= deadline:
+                self._pool._restart(self._generation)
+                raise AnalysisTimeout(f'the batch was not analysed within {timeout:.0f}s')
+            wait = self.POLL_SECONDS if deadline is None else min(self.POLL_SECONDS, deadline - time.monotonic())
+            self._result.wait(max(wait, 0.))
+        return [audio_stats for chunk, _ in self._result.get() for audio_stats in chunk]
+
+
+def _split(items, parts):
+    """
+    Splits items into at most ``parts`` contiguous chunks of near-equal size.
+    """
+    parts = max(1, min(parts, len(items)))
+    size, remainder = divmod(len(items), parts)
+    chunks, start = [], 0
+    for i in range(parts):
+        end = start + size + (1 if i < remainder else 0)
+        chunks.append(items[start:end])
+        start = end
+    return [chunk for chunk in chunks if chunk]
@@ -0,0 +1,95 @@
+import pytest
+
+from radio.capture import FrameAccumulator, find_frame_start
+
+# MPEG 1 layer III, 128 kbps, 44.1 kHz, no padding: 144 * 128000 // 44100 bytes of 1152 samples
+MP3_FRAME_LENGTH = 417
+
+
+def mp3_frame(mono=False):
+    return bytes((0xFF, 0xFB, 0x90, 0xC4 if mono else 0x44)) + bytes(MP3_FRAME_LENGTH - 4)
+
+
+def adts_frame(length=200):
+    # AAC LC, 44.1 kHz, stereo, one raw data block
+    header = bytes((0xFF, 0xF1, 0x50, 0x80 | (length >> 11), (length >> 3) & 0xFF, ((length & 7) << 5) | 0x1F,
+                    0xFC))
+    return header + bytes(length - len(header))
+
+
+def test_find_frame_start_skips_leading_junk():
+    buf = b'\x00\xff\x12\x34' + mp3_frame() * 2
+    assert find_frame_start(buf, 'mp3') == 4
+
+
+def test_find_frame_start_needs_a_second_header():
+    # a sync word is only trusted once the next frame's header confirms it
+    assert find_frame_start(mp3_frame(), 'mp3') is None
+    assert find_frame_start(mp3_frame() + b'\x00' * 8, 'mp3') is None
+    assert find_frame_start(mp3_frame() + mp3_frame()[:4], 'mp3') == 0
+
+
+def test_find_frame_start_adts():
+    assert find_frame_start(b'\xff\x00' + adts_frame() * 2, 'aac') == 2
+
+
+def test_find_frame_start_rejects_unknown_types():
+    with pytest.raises(ValueError):
+        find_frame_start(b'', 'ogg')
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 417, 1000, 64 * 1024])
+def test_accumulator_keeps_whole_frames_only(chunk_size):
+    stream = b'junk' + mp3_frame() * 10 + mp3_frame()[:100]
+    accumulator = FrameAccumulator('mp3', capacity=64)
+    for i in range(0, len(stream), chunk_size):
+        accumulator.feed(stream[i:i + chunk_size])
+
+    assert accumulator.start == 4
+    # the trailing partial frame is left out
+    assert accumulator.frames == 10
+    assert accumulator.aligned_bytes == 10 * MP3_FRAME_LENGTH
+    assert accumulator.duration == pytest.approx(10 * 1152 / 44100)
+
+    capture = accumulator.to_capture(station='test')
+    assert capture.data == mp3_frame() * 10
+    assert capture.frames == 10
+    assert capture.sample_rate == 44100
+    assert capture.channels == 2
+    assert capture.station == 'test'
+
+
+def test_accumulator_stops_at_max_bytes():
+    accumulator = FrameAccumulator('mp3', capacity=64, max_bytes=3 * MP3_FRAME_LENGTH + 10)
+    accumulator.feed(mp3_frame() * 6)
+    assert accumulator.full
+    assert accumulator.frames == 3
+    assert accumulator.aligned_bytes <= accumulator.max_bytes
+
+
+def test_accumulator_resynchronises_after_a_glitch():
+    accumulator = FrameAccumulator('mp3', capacity=64)
+    accumulator.feed(mp3_frame() * 3 + b'\x00' * 50 + mp3_frame(mono=True) * 4)
+    # what came before the glitch is dropped to keep the capture contiguous
+    assert accumulator.start == 3 * MP3_FRAME_LENGTH + 50
+    assert accumulator.frames == 4
+    assert accumulator.to_capture().channels == 1
+
+
+def test_accumulator_without_a_frame_gives_an_empty_capture():
+    accumulator = FrameAccumulator('mp3', capacity=64)
+    accumulator.feed(b'\x00' * 1000)
+    capture = accumulator.to_capture()
+    assert capture.data == b''
+    assert capture.frames == 0
+    assert capture.duration == 0.
+    assert capture.channels is None
+
+
+def test_accumulator_adts():
+    accumulator = FrameAccumulator('aac', capacity=64)
+    accumulator.feed(adts_frame() * 5)
+    capture = accumulator.to_capture()
+    assert capture.frames == 5
+    assert capture.sample_rate == 44100
+    assert capture.channels == 2
@@ -0,0 +1,69 @@
+import pytest
+
+from radio.icy import IcyDemuxer, metaint_of, parse_stream_title
+
+METAINT = 16
+
+
+def metadata_block(text):
+    data = text.encode('utf-8')
+    data += b'\0' * (-len(data) % 16)
+    return bytes((len(data) // 16,)) + data
+
+
+def icy_stream():
+    """
+    :return: ``(stream, audio, titles)`` of three metadata intervals, the second without metadata
+    """
+    audio = [bytes(range(i * METAINT, (i + 1) * METAINT)) for i in range(4)]
+    stream = (audio[0] + metadata_block("StreamTitle='Artist - Title';StreamUrl='';")
+              + audio[1] + b'\0'
+              + audio[2] + metadata_block("StreamTitle='Next – Song';")
+              + audio[3])
+    return stream, b''.join(audio), ['Artist - Title', 'Next – Song']
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, METAINT, METAINT + 1, 1000])
+def test_demuxer_splits_audio_and_titles_across_chunks(chunk_size):
+    stream, audio, titles = icy_stream()
+    demuxer = IcyDemuxer(METAINT)
+    got_audio, got_titles = [], []
+    for i in range(0, len(stream), chunk_size):
+        parts, new_titles = demuxer.feed(stream[i:i + chunk_size])
+        got_audio.extend(bytes(part) for part in parts)
+        got_titles.extend(new_titles)
+
+    assert b''.join(got_audio) == audio
+    assert got_titles == titles
+    assert demuxer.title == titles[-1]
+    assert demuxer.audio_bytes == len(audio)
+
+
+def test_demuxer_returns_views_of_the_chunk():
+    stream, _, _ = icy_stream()
+    parts, _ = IcyDemuxer(METAINT).feed(stream)
+    assert all(isinstance(part, memoryview) for part in parts)
+
+
+def test_demuxer_keeps_the_title_through_empty_blocks():
+    demuxer = IcyDemuxer(METAINT)
+    demuxer.feed(bytes(METAINT) + metadata_block("StreamTitle='A - B';"))
+    _, titles = demuxer.feed(bytes(METAINT) + b'\0' + bytes(METAINT))
+    assert titles == []
+    assert demuxer.title == 'A - B'
+
+
+def test_parse_stream_title():
+    assert parse_stream_title(b"StreamTitle=' Artist - Title ';\0\0\0") == 'Artist - Title'
+    assert parse_stream_title("StreamTitle='Café';".encode('latin-1')) == 'Café'
+    assert parse_stream_title(b"StreamUrl='http://example.com';") is None
+
+
+@pytest.mark.parametrize('headers, metaint', [
+    ({'icy-metaint': '8192'}, 8192),
+    ({'icy-metaint': '0'}, None),
+    ({'icy-metaint': 'none'}, None),
+    ({}, None),
+])
+def test_metaint_of(headers, metaint):
+    assert metaint_of(headers) == metaint
@@ -0,0 +1,119 @@
+import json
+import os
+import threading
+
+import pytest
+
+from radio.outbox import CURSOR_FILE, Outbox
+
+
+class RecordingPublisher:
+    """
+    Stands in for the websocket publisher: keeps every message and reports it
+    sent right away, or never while ``connected`` is false.
+    """
+
+    def __init__(self, connected=True):
+        self.connected = connected
+        self.messages = []
+        self._received = threading.Condition()
+
+    def publish_message(self, message, on_sent=None, on_dropped=None):
+        with self._received:
+            self.messages.append(json.loads(message))
+            self._received.notify_all()
+        if self.connected and on_sent is not None:
+            on_sent()
+
+    def wait_for(self, count, timeout=5.):
+        with self._received:
+            assert self._received.wait_for(lambda: len(self.messages) >= count, timeout), self.messages
+        return self.messages
+
+    def values(self):
+        values = []
+        for message in self.messages:
+            values.extend(message.get('audio_values_batch', [message.get('audio_values')]))
+        return values
+
+
+def results(first, last):
+    return [{'station': 'fm' if i % 2 else 'am', 'tempo': i} for i in range(first, last + 1)]
+
+
+def run(directory, publisher, appended=(), **kwargs):
+    outbox = Outbox(directory, publisher, flush_interval=.01, **kwargs).start()
+    for audio_values in appended:
+        outbox.append(audio_values)
+    return outbox
+
+
+def test_unsent_records_are_replayed_after_a_restart(tmp_path):
+    offline = RecordingPublisher(connected=False)
+    outbox = run(str(tmp_path), offline, results(1, 10), max_in_flight=2)
+    offline.wait_for(2)
+    outbox.stop()
+    assert outbox.stats()['backlog'] == 10
+
+    publisher = RecordingPublisher()
+    outbox = run(str(tmp_path), publisher)
+    publisher.wait_for(10)
+    outbox.stop()
+    assert publisher.values() == results(1, 10)
+    assert outbox.stats()['backlog'] == 0
+
+
+def test_sent_records_are_not_replayed(tmp_path):
+    publisher = RecordingPublisher()
+    outbox = run(str(tmp_path), publisher, results(1, 5))
+    publisher.wait_for(5)
+    outbox.stop()
+    with open(os.path.join(str(tmp_path), CURSOR_FILE)) as f:
+        assert json.load(f) == {'seq': 5}
+
+    publisher = RecordingPublisher()
+    outbox = run(str(tmp_path), publisher, results(6, 8))
+    publisher.wait_for(3)
+    outbox.stop()
+    assert publisher.values() == results(6, 8)
+
+
+@pytest.mark.parametrize('segment_bytes', [100, 8 * 2 ** 20])
+def test_batched_replay_across_segments(tmp_path, segment_bytes):
+    outbox = run(str(tmp_path), None, results(1, 50), segment_bytes=segment_bytes)
+    outbox.stop()
+
+    publisher = RecordingPublisher()
+    outbox = run(str(tmp_path), publisher, batched=True, max_batch=8, segment_bytes=segment_bytes)
+    publisher.wait_for(7)
+    outbox.stop()
+    assert publisher.values() == results(1, 50)
+    assert all(len(message['audio_values_batch']) <= 8 for message in publisher.messages)
+
+
+def test_restart_recovers_history(tmp_path):
+    outbox = run(str(tmp_path), None, results(1, 6))
+    outbox.stop()
+
+    outbox = Outbox(str(tmp_path))
+    assert [values for _, values in outbox.history('fm')] == results(1, 6)[::2]
+    assert [values['tempo'] for _, values in outbox.history('am', limit=2)] == [4, 6]
+    outbox.stop()
+
+
+def test_torn_and_unreadable_lines_are_skipped(tmp_path):
+    outbox = run(str(tmp_path), None, results(1, 3))
+    outbox.stop()
+    segment = os.path.join(str(tmp_path), sorted(os.listdir(str(tmp_path)))[0])
+    with open(segment, 'rb') as f:
+        lines = f.read().splitlines(keepends=True)
+    # a line that isn't a record in the middle, and half a record left by a crash at the end
+    with open(segment, 'wb') as f:
+        f.write(lines[0] + b'not json\n' + b''.join(lines[1:]) + lines[0][:10])
+
+    publisher = RecordingPublisher()
+    outbox = run(str(tmp_path), publisher, results(4, 4))
+    publisher.wait_for(4)
+    outbox.stop()
+    assert publisher.values() == results(1, 4)
+    assert outbox.stats()['unreadable'] == 1
@@ -0,0 +1,37 @@
+import json
+import socket
+import time
+
+from radio.publisher import WebSocketPublisher
+
+
+def unused_url():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return f'ws://127.0.0.1:{sock.getsockname()[1]}'
+
+
+def test_full_queue_drops_the_oldest_message():
+    publisher = WebSocketPublisher(unused_url(), max_queue=2)
+    dropped = []
+    for i in range(4):
+        publisher.publish_message(json.dumps(i), on_dropped=lambda i=i: dropped.append(i))
+    assert dropped == [0, 1]
+    assert publisher.queue_depth == 2
+    assert publisher.stats()['dropped'] == 2
+
+
+def test_stop_does_not_wait_out_the_reconnect_backoff():
+    publisher = WebSocketPublisher(unused_url(), initial_backoff=30.).start()
+    failures = []
+    publisher.on_failure = failures.append
+    publisher.publish({'station': 'fm', 'tempo': 120})
+    deadline = time.monotonic() + 5.
+    while not failures and time.monotonic() < deadline:
+        time.sleep(.01)
+    assert failures
+
+    start = time.monotonic()
+    publisher.stop(timeout=5.)
+    assert time.monotonic() - start < 1.
+    assert publisher.stats()['sent'] == 0
@@ -0,0 +1,91 @@
+import threading
+
+import pytest
+
+from radio.scheduler import Scheduler, next_tick, resolve_stations
+
+
+def stations(**settings):
+    return resolve_stations({name: dict(values) for name, values in settings.items()})
+
+
+@pytest.mark.parametrize('after, tick', [
+    (0., 10.),
+    (10., 30.),
+    (29.9, 30.),
+    (30., 70.),
+    (-45., -30.),
+    (3600., 3610.),
+])
+def test_next_tick_is_strictly_after(after, tick):
+    settings = stations(a={'cadence': 60, 'burst': [0, 20]})['a']
+    assert next_tick(settings, 10., after) == tick
+
+
+def test_next_tick_of_a_burst_longer_than_the_cadence():
+    # each cycle's last analysis runs into the next cycle, interleaved with its first two
+    settings = stations(a={'cadence': 60, 'burst': [0, 50, 80]})['a']
+    ticks, after = [], 0.
+    for _ in range(6):
+        after = next_tick(settings, 0., after)
+        ticks.append(after)
+    assert ticks == [20., 50., 60., 80., 110., 120.]
+
+
+def test_even_spread_offsets_stations():
+    scheduler = Scheduler(lambda names: None, stations(a={'cadence': 60}, b={'cadence': 60}, c={'cadence': 60}))
+    assert scheduler.offsets == {'a': 0., 'b': 20., 'c': 40.}
+    scheduler.stop()
+
+
+def test_take_due_runs_each_station_in_its_slot():
+    scheduler = Scheduler(lambda names: None, stations(a={'cadence': 60}, b={'cadence': 60}), coalesce=0.)
+    scheduler.start(now=0.)
+    assert scheduler.next_due == 30.
+    assert scheduler.take_due(29.) == []
+    assert scheduler.take_due(30.) == [('b', 30.)]
+    assert scheduler.take_due(60.) == [('a', 60.)]
+    assert scheduler.next_due == 90.
+    scheduler.stop()
+
+
+def test_take_due_coalesces_close_ticks():
+    scheduler = Scheduler(lambda names: None, stations(a={'cadence': 60, 'offset': 0},
+                                                       b={'cadence': 60, 'offset': .5},
+                                                       c={'cadence': 60, 'offset': 5}), coalesce=1.)
+    scheduler.start(now=1.)
+    assert scheduler.take_due(5.) == [('c', 5.)]
+    assert scheduler.take_due(60.) == [('a', 60.), ('b', 60.5)]
+    scheduler.stop()
+
+
+@pytest.mark.parametrize('overlap', ['skip', 'postpone'])
+def test_busy_station_is_skipped_or_postponed(overlap):
+    release = threading.Event()
+    finished = threading.Semaphore(0)
+    ran = []
+
+    def job(names):
+        ran.append(names)
+        release.wait(5.)
+        finished.release()
+
+    scheduler = Scheduler(job, stations(a={'cadence': 60}), overlap=overlap)
+    scheduler.start(now=-1.)
+    scheduler.dispatch(scheduler.take_due(0.), now=0.)
+    # the first job still runs when the next tick comes due
+    assert scheduler.take_due(60.) == []
+    release.set()
+    # a postponed tick runs as soon as the first job finishes
+    for _ in range(2 if overlap == 'postpone' else 1):
+        assert finished.acquire(timeout=5.)
+    scheduler.stop()
+
+    counts = scheduler.stats()
+    assert counts['ticks'] == 2
+    if overlap == 'skip':
+        assert counts['skipped'] == 1
+        assert ran == [['a']]
+    else:
+        assert counts['postponed'] == 1
+        assert ran == [['a'], ['a']]
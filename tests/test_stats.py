@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+
+from radio.stats import StationStatistics, merge_moments
+
+DAY = 86400
+
+
+def result(tempo=120, loudness=-14, pitch=440):
+    return {'tempo': tempo, 'loudness': loudness, 'pitch': pitch}
+
+
+def observe_history(statistics, station='fm', count=20, now=1000.):
+    rng = np.random.default_rng(0)
+    for i in range(count):
+        statistics.observe(station, result(tempo=int(rng.integers(115, 126)), loudness=int(rng.integers(-16, -11)),
+                                           pitch=int(rng.integers(16, 20)) * 25), now=now + i)
+
+
+def moments(values):
+    return len(values), values.mean(), ((values - values.mean()) ** 2).sum()
+
+
+def test_merge_moments_matches_numpy():
+    a, b = np.array([1., 2., 4.]), np.array([3., 9.])
+    count, mean, m2 = merge_moments(moments(a), moments(b))
+    both = np.concatenate([a, b])
+    assert count == 5
+    assert mean == pytest.approx(both.mean())
+    assert m2 / count == pytest.approx(both.var())
+    assert merge_moments((0, 0., 0.), (0, 0., 0.)) == (0., 0., 0.)
+
+
+def test_percentiles_wait_for_min_history():
+    statistics = StationStatistics(min_history=10)
+    observed = statistics.observe('fm', result(), now=0.)
+    assert observed['percentiles'] == {'tempo': None, 'loudness': None, 'pitch': None}
+    assert observed['outliers'] == {'tempo': False, 'loudness': False, 'pitch': False}
+
+    observe_history(statistics, count=9, now=1.)
+    observed = statistics.observe('fm', result(tempo=200), now=10.)
+    assert observed['percentiles']['tempo'] == 1.
+    assert 0. <= observed['percentiles']['loudness'] <= 1.
+
+
+def test_outliers_are_flagged_against_the_window():
+    statistics = StationStatistics()
+    observe_history(statistics)
+    observed = statistics.observe('fm', result(tempo=240, loudness=-14, pitch=425), now=2000.)
+    assert observed['outliers'] == {'tempo': True, 'loudness': False, 'pitch': False}
+
+
+def test_burst_is_consolidated_without_its_outliers():
+    statistics = StationStatistics(burst_gap=30.)
+    observe_history(statistics, now=0.)
+    for i, tempo in enumerate((121, 240, 119)):
+        observed = statistics.observe('fm', result(tempo=tempo), now=1000. + 20 * i)
+    assert observed['consolidated']['snippets'] == 3
+    assert observed['consolidated']['tempo'] == 120
+
+    # a result after the gap starts a new burst
+    observed = statistics.observe('fm', result(tempo=122), now=1100.)
+    assert observed['consolidated'] == {**result(tempo=122), 'snippets': 1}
+
+
+def test_old_buckets_slide_out_of_the_window():
+    statistics = StationStatistics(window_seconds=7 * DAY, buckets=7)
+    observe_history(statistics, now=0.)
+    assert statistics.summary('fm', now=DAY)['tempo']['window_count'] == 20
+    summary = statistics.summary('fm', now=8 * DAY)
+    assert summary['tempo']['window_count'] == 0
+    assert summary['tempo']['median'] is None
+    # the running moments keep everything
+    assert summary['tempo']['count'] == 20
+
+
+def test_checkpoint_round_trip(tmp_path):
+    path = str(tmp_path / 'stats.npz')
+    statistics = StationStatistics()
+    observe_history(statistics, station='fm')
+    observe_history(statistics, station='am', count=5)
+    statistics.checkpoint(path)
+
+    restored = StationStatistics()
+    assert restored.restore(path)
+    assert sorted(restored.stations) == ['am', 'fm']
+    for station in ('am', 'fm'):
+        assert restored.summary(station, now=1000.) == statistics.summary(station, now=1000.)
+    # and it keeps ranking where the original left off
+    assert (restored.observe('fm', result(tempo=240), now=2000.)
+            == statistics.observe('fm', result(tempo=240), now=2000.))
+
+
+def test_empty_checkpoint_round_trip(tmp_path):
+    path = str(tmp_path / 'stats.npz')
+    StationStatistics().checkpoint(path)
+    restored = StationStatistics()
+    assert restored.restore(path)
+    assert restored.stations == []
+
+
+def test_checkpoint_of_another_window_is_ignored(tmp_path):
+    path = str(tmp_path / 'stats.npz')
+    statistics = StationStatistics(window_seconds=DAY, buckets=24)
+    observe_history(statistics)
+    statistics.checkpoint(path)
+
+    restored = StationStatistics()
+    assert not restored.restore(path)
+    assert restored.stations == []